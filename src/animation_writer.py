@@ -0,0 +1,281 @@
+"""
+Streaming GIF and APNG writer quantizing frames against a fixed palette.
+
+Pillow's writers behind FuncAnimation.save keep every frame until the file is written,
+which at 300 dpi is 27 MB of RGBA per frame, and search an adaptive palette per frame.
+AnimationWriter quantizes each frame against one palette as it arrives, writes the
+pixels that changed since the previous frame and drops it, so memory use does not
+depend on the number of frames.
+
+The map and line charts only contain a few flat colors and their anti-aliased blends,
+so blend_palette(colors) covers them.
+"""
+
+import itertools
+import os
+import struct
+import zlib
+from io import BytesIO
+
+import numpy as np
+from matplotlib.animation import AbstractMovieWriter
+from matplotlib.colors import to_rgb
+from PIL import GifImagePlugin, Image
+
+
+def blend_palette(colors, max_colors=256):
+    """
+    Palette of `colors` and evenly spaced blends between every pair of them.
+
+    When the blends of every pair do not fit, e.g. for the dozens of line colors of a
+    line race, each color is only blended with the first one, the background.
+
+    Parameters:
+    - colors (list): Matplotlib colors drawn in the frames, background first, e.g. the
+      background, fill, edge and text colors.
+    - max_colors (int): Palette size limit.
+
+    Returns:
+    - np.ndarray: (n, 3) uint8 RGB palette.
+    """
+    base = np.array([to_rgb(color) for color in dict.fromkeys(colors)])
+    pairs = list(itertools.combinations(range(len(base)), 2))
+    if len(base) > max_colors:
+        raise ValueError(f"{len(base)} colors do not fit in a {max_colors} color palette")
+    if (max_colors - len(base)) // max(len(pairs), 1) < 2:
+        pairs = [(0, i) for i in range(1, len(base))]
+    steps = min(32, (max_colors - len(base)) // max(len(pairs), 1))
+
+    weights = np.arange(1, steps + 1)[:, None] / (steps + 1)
+    blends = [base[i] * (1 - weights) + base[j] * weights for i, j in pairs]
+    palette = np.vstack([base, *blends]) if blends else base
+    return np.round(palette * 255).astype("uint8")
+
+
+def padded_palette(palette):
+    """`palette` as the 768 bytes of a 256 color palette, padded with its first color."""
+    padding = np.repeat(palette[:1], 256 - len(palette), axis=0)
+    return np.vstack([palette, padding]).tobytes()
+
+
+class PaletteLookup:
+    """
+    Exact nearest color in a fixed palette, memoized per 24 bit RGB color.
+
+    Only colors not seen in earlier frames are searched, so after the first frame a
+    frame costs a table lookup per pixel. The table takes 32 MB.
+
+    Parameters:
+    - palette (np.ndarray): (n, 3) uint8 RGB palette.
+    """
+
+    def __init__(self, palette):
+        self.palette = np.asarray(palette, dtype="int32")
+        self._index = np.zeros(1 << 24, dtype="uint8")
+        self._known = np.zeros(1 << 24, dtype=bool)
+
+    def __call__(self, rgb):
+        """Palette indices, as a uint8 array, of an (h, w, 3) uint8 RGB array."""
+        packed = (
+            (rgb[..., 0].astype("uint32") << 16)
+            | (rgb[..., 1].astype("uint32") << 8)
+            | rgb[..., 2]
+        )
+        new = np.unique(packed[~self._known[packed]])
+        for start in range(0, len(new), 4096):
+            chunk = new[start : start + 4096]
+            colors = np.stack([chunk >> 16, (chunk >> 8) & 255, chunk & 255], axis=1)
+            distances = ((colors[:, None, :].astype("int32") - self.palette) ** 2).sum(axis=2)
+            self._index[chunk] = distances.argmin(axis=1)
+        self._known[new] = True
+        return self._index[packed]
+
+
+def changed_box(previous, current):
+    """Bounding box (left, top, right, bottom) of the pixels that differ, or None."""
+    if previous is None:
+        return (0, 0, current.shape[1], current.shape[0])
+    diff = previous != current
+    rows = np.flatnonzero(diff.any(axis=1))
+    if not len(rows):
+        return None
+    columns = np.flatnonzero(diff.any(axis=0))
+    return (columns[0], rows[0], columns[-1] + 1, rows[-1] + 1)
+
+
+def png_chunk(chunk_type, data):
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data))
+    )
+
+
+class AnimationWriter:
+    """
+    Write an animation frame by frame to a .gif, .png/.apng or .webp file.
+
+    GIF and APNG frames are written as they are appended. WebP goes through Pillow,
+    whose encoder takes all frames at once, so its frames are kept (quantized, one byte
+    per pixel) until close.
+
+    Parameters:
+    - path (str): Output file; the format follows the extension.
+    - size (tuple): Frame (width, height) in pixels.
+    - palette (np.ndarray): (n, 3) uint8 RGB palette of at most 256 colors, see
+      blend_palette. Every pixel is mapped to its nearest palette color.
+    - fps (float): Frames per second.
+    - loop (int): Number of loops, 0 for forever.
+    """
+
+    def __init__(self, path, size, palette, fps, loop=0):
+        self.path = path
+        self.size = tuple(size)
+        self.palette = np.asarray(palette, dtype="uint8")
+        self.duration = int(1000 / fps)
+        self.loop = loop
+        self.format = os.path.splitext(path)[1].lower().lstrip(".")
+        if self.format not in ("gif", "png", "apng", "webp"):
+            raise ValueError(f"Unsupported animation format: {path}")
+
+        self._lookup = PaletteLookup(self.palette)
+        self._previous = None
+        self._frames = []
+        self._sequence = 0
+        self.n_frames = 0
+        self._file = open(path, "wb") if self.format != "webp" else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def quantize(self, rgba):
+        """Map an RGBA buffer to palette indices, as a P mode image."""
+        width, height = self.size
+        rgb = np.frombuffer(rgba, dtype="uint8").reshape(height, width, 4)[..., :3]
+        frame = Image.frombuffer("L", self.size, self._lookup(rgb), "raw", "L", 0, 1)
+        frame.putpalette(padded_palette(self.palette))
+        return frame
+
+    def append(self, rgba):
+        """Quantize a frame, given as an RGBA buffer of `size`, and add it to the file."""
+        frame = self.quantize(rgba)
+        if self.format == "webp":
+            self._frames.append(frame)
+        else:
+            indices = np.asarray(frame)
+            box = changed_box(self._previous, indices)
+            if box is None:
+                # Unchanged frame: redraw a single pixel to keep the timing
+                box = (0, 0, 1, 1)
+            if self.format == "gif":
+                self._append_gif(frame, box)
+            else:
+                self._append_apng(indices, box)
+            self._previous = indices
+        self.n_frames += 1
+
+    def _append_gif(self, frame, box):
+        if self.n_frames == 0:
+            header, _ = GifImagePlugin.getheader(frame, info={"loop": self.loop})
+            self._file.write(b"".join(header))
+        data = GifImagePlugin.getdata(
+            frame.crop(box), offset=box[:2], duration=self.duration, disposal=1
+        )
+        self._file.write(b"".join(data))
+
+    def _append_apng(self, indices, box):
+        width, height = self.size
+        if self.n_frames == 0:
+            self._file.write(b"\x89PNG\r\n\x1a\n")
+            # 8 bit palette color
+            ihdr = struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)
+            self._file.write(png_chunk(b"IHDR", ihdr))
+            # Frame count unknown yet; patched in close
+            self._actl_offset = self._file.tell()
+            self._file.write(png_chunk(b"acTL", struct.pack(">II", 0, self.loop)))
+            self._file.write(png_chunk(b"PLTE", padded_palette(self.palette)))
+
+        left, top, right, bottom = box
+        self._file.write(
+            png_chunk(
+                b"fcTL",
+                struct.pack(
+                    ">IIIIIHHBB",
+                    self._sequence,
+                    right - left,
+                    bottom - top,
+                    left,
+                    top,
+                    self.duration,
+                    1000,
+                    0,  # dispose: none
+                    0,  # blend: source
+                ),
+            )
+        )
+        self._sequence += 1
+
+        # Scanlines with filter type 0 (none)
+        region = indices[top:bottom, left:right]
+        scanlines = np.hstack([np.zeros((len(region), 1), dtype="uint8"), region])
+        data = zlib.compress(scanlines.tobytes(), 6)
+        if self.n_frames == 0:
+            self._file.write(png_chunk(b"IDAT", data))
+        else:
+            self._file.write(png_chunk(b"fdAT", struct.pack(">I", self._sequence) + data))
+            self._sequence += 1
+
+    def close(self):
+        """Finish the file."""
+        if self.format == "webp":
+            if self._frames:
+                self._frames[0].save(
+                    self.path,
+                    save_all=True,
+                    append_images=self._frames[1:],
+                    duration=self.duration,
+                    loop=self.loop,
+                    lossless=True,
+                )
+            self._frames = []
+            return
+        if self._file.closed:
+            return
+        if self.format == "gif":
+            self._file.write(b";")
+        elif self.n_frames:
+            self._file.write(png_chunk(b"IEND", b""))
+            self._file.seek(self._actl_offset)
+            self._file.write(png_chunk(b"acTL", struct.pack(">II", self.n_frames, self.loop)))
+        self._file.close()
+
+
+class PaletteWriter(AbstractMovieWriter):
+    """
+    Matplotlib movie writer streaming FuncAnimation.save frames to an AnimationWriter.
+
+    Usage: ani.save('map.gif', writer=PaletteWriter(fps=1, palette=blend_palette(colors)))
+    """
+
+    def __init__(self, fps=5, palette=None, loop=0, metadata=None, codec=None, bitrate=None):
+        super().__init__(fps=fps, metadata=metadata, codec=codec, bitrate=bitrate)
+        self.palette = palette
+        self.loop = loop
+
+    def setup(self, fig, outfile, dpi=None):
+        super().setup(fig, outfile, dpi=dpi)
+        self._writer = AnimationWriter(
+            str(outfile), self.frame_size, self.palette, self.fps, self.loop
+        )
+
+    def grab_frame(self, **savefig_kwargs):
+        buf = BytesIO()
+        self.fig.savefig(buf, **{**savefig_kwargs, "format": "rgba", "dpi": self.dpi})
+        self._writer.append(buf.getbuffer())
+
+    def finish(self):
+        self._writer.close()
@@ -0,0 +1,370 @@
+"""
+Micro-benchmarks for the data pipeline and the animations on synthetic data.
+
+Run from src/:
+
+    python benchmarks.py state_frame|rolling_sum|lollipop_summary|animation_writer
+    python benchmarks.py layer_composite
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PatchCollection
+from matplotlib.figure import Figure
+from matplotlib.patches import Polygon
+from PIL import Image
+
+from animation_writer import AnimationWriter, blend_palette
+from data_processing import grouped_rolling_sum, summarise_pop_per_dwelling
+from fred_fetch import build_state_frame
+from layer_composite import LayeredFigure, draw_order, split_outlines
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    """Return the result of `func` and its best wall-clock time over `repeat` runs."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def synthetic_series(n_series, n_periods=480, seed=0):
+    """
+    Monthly series with staggered start dates, like county-level FRED suffixes.
+
+    Parameters:
+    - n_series (int): Number of series.
+    - n_periods (int): Length of the longest series in months.
+    - seed (int): Random seed.
+
+    Returns:
+    - dict: pd.Series keyed by a fake county code.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("1984-01-01", periods=n_periods, freq="MS")
+    columns = {}
+    for i in range(n_series):
+        start = rng.integers(0, n_periods // 4)
+        values = 60 + rng.standard_normal(n_periods - start).cumsum() * 0.2
+        columns[f"C{i:05d}"] = pd.Series(values, index=dates[start:])
+    return columns
+
+
+def insert_columns(columns):
+    """Baseline: column-by-column insertion into an empty DataFrame."""
+    all_data = pd.DataFrame()
+    with warnings.catch_warnings():
+        # The fragmentation warning is the point of the comparison
+        warnings.simplefilter("ignore", pd.errors.PerformanceWarning)
+        for name, series in columns.items():
+            all_data[name] = series
+    return all_data
+
+
+def bench_state_frame(n_series=500):
+    columns = synthetic_series(n_series)
+
+    baseline, baseline_time = timed(insert_columns, columns)
+    concat, concat_time = timed(build_state_frame, columns)
+    concat32, concat32_time = timed(build_state_frame, columns, dtype="float32")
+    pd.testing.assert_frame_equal(baseline, concat)
+
+    print(f"{n_series} series x {len(concat)} dates")
+    print(f"column insertion: {baseline_time * 1000:8.1f} ms")
+    print(f"single concat:    {concat_time * 1000:8.1f} ms")
+    print(f"concat float32:   {concat32_time * 1000:8.1f} ms")
+    print(f"memory float64:   {concat.memory_usage().sum() / 1e6:8.2f} MB")
+    print(f"memory float32:   {concat32.memory_usage().sum() / 1e6:8.2f} MB")
+
+
+def synthetic_migration(scale=100, seed=0):
+    """
+    Wide migration data shaped like the pivoted citizenship frame, `scale` times larger.
+
+    df_citizenship_direction_202312.csv has 46 citizenships over 276 months, so the
+    synthetic frame keeps the 276 months and multiplies the number of citizenships.
+    """
+    rng = np.random.default_rng(seed)
+    months = pd.date_range("2001-01-01", periods=276, freq="MS")
+    citizenships = [f"Citizenship {i}" for i in range(46 * scale)]
+    index = pd.MultiIndex.from_product([months, citizenships], names=["Month", "Citizenship"])
+    df = pd.DataFrame(index=index).reset_index()
+    df["Arrivals"] = rng.integers(0, 3000, len(df)).astype("float64")
+    df["Departures"] = rng.integers(0, 3000, len(df)).astype("float64")
+    df["Net"] = df["Arrivals"] - df["Departures"]
+    return df
+
+
+def rolling_sum_lambda(df, value_cols):
+    """Baseline: one groupby/transform with a Python lambda per column."""
+    return pd.DataFrame(
+        {
+            col: df.groupby("Citizenship")[col].transform(
+                lambda x: x.rolling(window=12, min_periods=12).sum()
+            )
+            for col in value_cols
+        }
+    )
+
+
+def bench_rolling_sum(scale=100):
+    df = synthetic_migration(scale)
+    value_cols = ["Arrivals", "Departures", "Net"]
+
+    baseline, baseline_time = timed(rolling_sum_lambda, df, value_cols, repeat=1)
+    vectorized, vectorized_time = timed(grouped_rolling_sum, df, "Citizenship", value_cols)
+    pd.testing.assert_frame_equal(baseline, vectorized)
+
+    print(f"{len(df)} rows, {df['Citizenship'].nunique()} citizenships")
+    print(f"groupby lambda:      {baseline_time * 1000:8.1f} ms")
+    print(f"grouped_rolling_sum: {vectorized_time * 1000:8.1f} ms")
+
+
+def synthetic_dwellings(n_areas, seed=0):
+    """Merged population and dwellings by area and year, shaped like the PublicHouse extract."""
+    rng = np.random.default_rng(seed)
+    first_years = rng.integers(1950, 2010, n_areas)
+    areas = np.repeat(np.arange(n_areas), 2024 - first_years)
+    years = np.concatenate([np.arange(first, 2024) for first in first_years])
+    dwellings = rng.uniform(1e4, 1e6, len(areas))
+    return pd.DataFrame(
+        {
+            "year": years,
+            "dwellings": dwellings,
+            "area_name": [f"Area {i}" for i in areas],
+            "grouping": [f"Group {i % 7}" for i in areas],
+            "population": dwellings * rng.uniform(1.8, 3.5, len(areas)),
+        }
+    )
+
+
+def summarise_transform(merged_df):
+    """Baseline: one groupby/transform per statistic, then drop_duplicates."""
+    merged_df = merged_df.copy()
+    merged_df["min_year_by_area"] = merged_df.groupby("area_name")["year"].transform("min")
+    merged_df = merged_df[merged_df["min_year_by_area"] <= 1995].copy()
+    merged_df = merged_df[merged_df["year"] >= 1990].copy()
+    merged_df["size"] = merged_df.groupby("area_name").transform("size")
+    merged_df["pop_per_dwelling"] = merged_df["population"] / merged_df["dwellings"]
+    for stat in ["mean", "min", "max", "last"]:
+        merged_df[f"pop_per_dwelling_{stat}"] = merged_df.groupby("area_name")[
+            "pop_per_dwelling"
+        ].transform(stat)
+    summary_df = merged_df[
+        [
+            "area_name",
+            "grouping",
+            "pop_per_dwelling_mean",
+            "pop_per_dwelling_min",
+            "pop_per_dwelling_max",
+            "pop_per_dwelling_last",
+        ]
+    ].drop_duplicates(["area_name", "grouping"])
+    return summary_df.sort_values(by="pop_per_dwelling_last")
+
+
+def bench_lollipop_summary():
+    for n_areas in [1000, 10000, 100000]:
+        merged_df = synthetic_dwellings(n_areas)
+        baseline, baseline_time = timed(summarise_transform, merged_df, repeat=1)
+        summary, summary_time = timed(summarise_pop_per_dwelling, merged_df, repeat=1)
+        pd.testing.assert_frame_equal(
+            baseline.reset_index(drop=True), summary.reset_index(drop=True)
+        )
+        print(
+            f"{n_areas:6d} areas, {len(merged_df):8d} rows: "
+            f"transform {baseline_time * 1000:8.1f} ms, agg {summary_time * 1000:8.1f} ms"
+        )
+
+
+def synthetic_frames(n_frames, size=(3000, 2250), seed=0):
+    """
+    RGBA buffers shaped like 300 dpi map frames: flat palette colors with anti-aliased
+    edges, a block of which changes color every frame.
+    """
+    rng = np.random.default_rng(seed)
+    palette = blend_palette(["#D6604D", "#F4A582", "#FDDBC7", "#92C5DE", "#4393C3", "white"])
+    width, height = size
+    base = palette[rng.integers(0, 6, (height // 150 + 1, width // 150 + 1))]
+    base = base.repeat(150, axis=0).repeat(150, axis=1)[:height, :width]
+    for i in range(n_frames):
+        frame = base.copy()
+        frame[900:1200, 1200:1500] = palette[i % 6]
+        frame[1200, 1200:1500] = palette[6 + i % 100]
+        yield np.dstack([frame, np.full((height, width, 1), 255, "uint8")]).tobytes()
+
+
+def save_with_pillow(path, n_frames, size):
+    """Baseline: what FuncAnimation.save's Pillow writer does."""
+    images = [
+        Image.frombuffer("RGBA", size, buffer, "raw", "RGBA", 0, 1)
+        for buffer in synthetic_frames(n_frames, size)
+    ]
+    images[0].save(path, save_all=True, append_images=images[1:], duration=1000, loop=0)
+
+
+def save_streaming(path, n_frames, size):
+    palette = blend_palette(["#D6604D", "#F4A582", "#FDDBC7", "#92C5DE", "#4393C3", "white"])
+    with AnimationWriter(path, size, palette, fps=1) as writer:
+        for buffer in synthetic_frames(n_frames, size):
+            writer.append(buffer)
+
+
+def _peak_rss_mb():
+    """Peak resident memory of this process in MB."""
+    try:
+        import resource
+    except ImportError:
+        # Windows has no resource module: use the peak working set
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _peak_memory_run(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    return elapsed, _peak_rss_mb()
+
+
+def bench_animation_writer():
+    size = (3000, 2250)
+    with tempfile.TemporaryDirectory() as directory:
+        for n_frames in [5, 20, 40]:
+            for name, func in [("pillow", save_with_pillow), ("streaming", save_streaming)]:
+                path = os.path.join(directory, f"{name}.gif")
+                # A fresh process per run, so that the peak RSS is this run's
+                with ProcessPoolExecutor(1) as executor:
+                    elapsed, peak = executor.submit(
+                        _peak_memory_run, func, path, n_frames, size
+                    ).result()
+                print(
+                    f"{n_frames:3d} frames, {name:9s}: {elapsed:6.1f} s, "
+                    f"peak RSS {peak:7.0f} MB, {os.path.getsize(path) / 1e6:6.2f} MB file"
+                )
+
+
+def synthetic_map(n_cols=16, n_rows=12, seed=0):
+    """
+    Figure shaped like the map animation: jittered polygons whose fills change, their
+    outlines split off above them, an arrow and captions that do not change, and labels.
+
+    Returns:
+    - tuple: (figure, fill collection, labels).
+    """
+    rng = np.random.default_rng(seed)
+    fig = Figure(figsize=(8, 6), dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.set_xlim(0, n_cols)
+    ax.set_ylim(0, n_rows + 2)
+
+    corners = np.array([[0, 0], [1, 0], [1, 1], [0, 1]])
+    polygons = [
+        Polygon([x, y] + corners + rng.uniform(-0.2, 0.2, (4, 2)))
+        for x in range(n_cols)
+        for y in range(n_rows)
+    ]
+    fills = PatchCollection(polygons, edgecolor="white", linewidth=0.8)
+    ax.add_collection(fills)
+    split_outlines(fills)
+
+    ax.text(0.5, n_rows + 1, "Synthetic choropleth", fontsize=20)
+    ax.annotate(
+        "Static caption",
+        xy=(n_cols / 2, n_rows / 2),
+        xytext=(n_cols - 5, n_rows + 1),
+        arrowprops={"arrowstyle": "->", "color": "#666666", "lw": 1.5},
+    )
+    labels = [ax.text(x + 0.5, y + 0.5, "", ha="center", va="center", fontsize=7)
+              for x in range(0, n_cols, 3) for y in range(0, n_rows, 3)]
+    return fig, fills, labels
+
+
+def bench_layer_composite(n_frames=10):
+    fig, fills, labels = synthetic_map()
+    colors = np.array(
+        [[0.84, 0.38, 0.30, 1], [0.96, 0.65, 0.51, 1], [0.57, 0.77, 0.87, 1], [0.26, 0.58, 0.76, 1]]
+    )
+    rng = np.random.default_rng(1)
+
+    def update(frame):
+        fills.set_facecolor(colors[rng.integers(0, len(colors), len(fills.get_paths()))])
+        for i, label in enumerate(labels):
+            label.set_text(f"{(frame * 7 + i) % 100}")
+
+    def draw():
+        fig.canvas.draw()
+        return np.array(fig.canvas.buffer_rgba())
+
+    def painted(hidden):
+        """Pixels painted, on a transparent canvas, by the artists not in `hidden`."""
+        for artist in hidden:
+            artist.set_visible(False)
+        alpha = draw()[..., 3] > 0
+        for artist in hidden:
+            artist.set_visible(True)
+        return alpha
+
+    # Composited frames may only differ from a full draw where a static artist, the
+    # backgrounds aside, and a changing one both paint
+    changing = [fills, *labels]
+    backgrounds = [fig.patch, *(ax.patch for ax in fig.axes)]
+    static = [a for a in draw_order(fig) if not isinstance(a, Axes) and a not in changing]
+    static_painted = painted(changing + backgrounds)
+
+    layered = LayeredFigure(fig, [fills], labels)
+    full_time = composite_time = 0.0
+    overlap_pixels = max_difference = 0
+    for frame in range(n_frames):
+        update(frame)
+        full, seconds = timed(draw, repeat=1)
+        full_time += seconds
+        composite, seconds = timed(layered.render, repeat=1)
+        composite_time += seconds
+        composite = np.frombuffer(composite, "uint8").reshape(full.shape)
+
+        differs = (full != composite).any(axis=-1)
+        overlap = painted(static + backgrounds) & static_painted
+        assert not (differs & ~overlap).any(), f"frame {frame} differs outside the overlaps"
+        overlap_pixels += int(differs.sum())
+        difference = np.abs(full.astype(int) - composite.astype(int)).max()
+        max_difference = max(max_difference, int(difference))
+
+    print(f"{n_frames} frames of {full.shape[1]}x{full.shape[0]}, identical outside overlaps")
+    print(f"full draw:  {full_time / n_frames * 1000:8.1f} ms per frame")
+    print(f"composite:  {composite_time / n_frames * 1000:8.1f} ms per frame")
+    print(
+        f"overlaps:   {overlap_pixels / n_frames:8.0f} pixels per frame differ, "
+        f"by up to {max_difference} levels"
+    )
+
+
+BENCHMARKS = {
+    "state_frame": bench_state_frame,
+    "rolling_sum": bench_rolling_sum,
+    "lollipop_summary": bench_lollipop_summary,
+    "animation_writer": bench_animation_writer,
+    "layer_composite": bench_layer_composite,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmark", choices=list(BENCHMARKS))
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark]()
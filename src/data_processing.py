@@ -1,105 +1,150 @@
+import numpy as np
 import pandas as pd
 
-# Load public data
-data = pd.read_csv("https://github.com/jgleeson/PublicHouse/raw/main/dataset.csv")
+from http_cache import HttpCache
+from pipeline import Stage, run_pipeline
+import processed_store
+from processed_store import dataset_path, save_processed
+
+PUBLIC_HOUSE_URL = "https://github.com/jgleeson/PublicHouse/raw/main/dataset.csv"
+
+
+def grouped_rolling_sum(df, group_col, value_cols, window=12, min_periods=None):
+    """
+    Rolling sums of several columns within each group, in a single vectorized pass.
+
+    Equivalent to df.groupby(group_col)[col].transform(lambda x: x.rolling(window,
+    min_periods).sum()) for every column, with rows taken in their existing order within
+    each group. Sums are differences of a cumulative sum over the rows sorted by group,
+    with NaN treated as missing when counting towards `min_periods`.
+
+    Parameters:
+    - df (pd.DataFrame): Data, ordered in time within each group.
+    - group_col (str): Column identifying the groups, e.g. 'Citizenship'.
+    - value_cols (list): Columns to sum.
+    - window (int): Window length in rows.
+    - min_periods (int): Minimum non-missing values for a result, defaults to `window`.
+
+    Returns:
+    - pd.DataFrame: Rolling sums aligned to df.index, one column per value column.
+    """
+    if min_periods is None:
+        min_periods = window
+
+    codes = pd.factorize(df[group_col])[0]
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    values = df[value_cols].to_numpy(dtype="float64")[order]
+
+    # Cumulative sums and non-missing counts, padded with a leading row of zeros
+    missing = np.isnan(values)
+    padded_sums = np.zeros((len(values) + 1, len(value_cols)))
+    padded_counts = np.zeros((len(values) + 1, len(value_cols)), dtype="int64")
+    np.cumsum(np.where(missing, 0.0, values), axis=0, out=padded_sums[1:])
+    np.cumsum(~missing, axis=0, out=padded_counts[1:])
+
+    # Each window starts `window - 1` rows back, but never before its group's first row
+    rows = np.arange(len(values))
+    group_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    first_row = np.repeat(group_starts, np.diff(np.r_[group_starts, len(values)]))
+    window_start = np.maximum(rows - window + 1, first_row)
+
+    sums = padded_sums[rows + 1] - padded_sums[window_start]
+    counts = padded_counts[rows + 1] - padded_counts[window_start]
+    sums[counts < min_periods] = np.nan
+    # Like groupby, rows with a missing group get no result
+    sums[sorted_codes < 0] = np.nan
+
+    result = np.empty_like(sums)
+    result[order] = sums
+    return pd.DataFrame(result, index=df.index, columns=value_cols)
+
 
 ################################################################################
 # Dataset for lollipop plot
 
-# Create city dataset - Add city states
-# Choose a common year across countries or interpolate if no data
-# add persons per dwelling
-# add Auckland
-
-# df_city = data[data["area_level"].isin(["city-region", "city-state"])].copy()
-
-df_country = data[
-    data["area_level"].isin(["country"])
-].copy()  # add hong kong and Singapore
-
-df_dwellings_country = df_country[df_country["variable"] == "dwellings"][
-    ["year", "value", "area_name", "grouping"]
-].copy()
-df_dwellings_country = df_dwellings_country.rename(columns={"value": "dwellings"})
-
-df_pop_country = df_country[df_country["variable"] == "population"][
-    ["year", "value", "area_name", "grouping"]
-].copy()
-df_pop_country = df_pop_country.rename(columns={"value": "population"})
-
-merged_df = pd.merge(
-    df_dwellings_country, df_pop_country, on=["year", "area_name", "grouping"]
-)
-
-merged_df.sort_values(by=["area_name", "year"]).reset_index(drop=True)
-
-merged_df["min_year_by_area"] = merged_df.groupby("area_name")["year"].transform("min")
-
-merged_df = merged_df[merged_df["min_year_by_area"] <= 1995].copy()
-merged_df = merged_df[merged_df["year"] >= 1990].copy()
-
-merged_df["size"] = merged_df.groupby("area_name").transform("size")
-
-merged_df["pop_per_dwelling"] = merged_df["population"] / merged_df["dwellings"]
-
-merged_df["pop_per_dwelling_mean"] = merged_df.groupby("area_name")[
-    "pop_per_dwelling"
-].transform("mean")
-
-merged_df["pop_per_dwelling_min"] = merged_df.groupby("area_name")[
-    "pop_per_dwelling"
-].transform("min")
-
-merged_df["pop_per_dwelling_max"] = merged_df.groupby("area_name")[
-    "pop_per_dwelling"
-].transform("max")
-
-merged_df["pop_per_dwelling_last"] = merged_df.groupby("area_name")[
-    "pop_per_dwelling"
-].transform("last")
-
+def summarise_pop_per_dwelling(merged_df, max_first_year=1995, start_year=1990, end_year=None):
+    """
+    Persons per dwelling statistics per area, computed in one grouped aggregation.
+
+    Parameters:
+    - merged_df (pd.DataFrame): One row per area and year with 'area_name', 'grouping',
+      'year', 'population' and 'dwellings', in year order within each area.
+    - max_first_year (int): Keep areas whose first observation is no later than this.
+    - start_year (int): First year included in the statistics.
+    - end_year (int): Last year included in the statistics, or None for no limit.
+
+    Returns:
+    - pd.DataFrame: One row per area and grouping with the mean, min, max and last
+      persons per dwelling, sorted by the last value.
+    """
+    first_year = merged_df.groupby("area_name")["year"].min()
+    keep = merged_df["area_name"].isin(first_year.index[first_year <= max_first_year])
+    keep &= merged_df["year"] >= start_year
+    if end_year is not None:
+        keep &= merged_df["year"] <= end_year
+
+    window = merged_df.loc[keep, ["area_name", "grouping"]].assign(
+        pop_per_dwelling=merged_df.loc[keep, "population"] / merged_df.loc[keep, "dwellings"]
+    )
+    stats = window.groupby("area_name", sort=False)["pop_per_dwelling"].agg(
+        ["mean", "min", "max", "last"]
+    )
+    stats.columns = "pop_per_dwelling_" + stats.columns
+
+    # data needed for lollipop plot (persons per dwelling by city)
+    summary_df = window[["area_name", "grouping"]].drop_duplicates().merge(
+        stats, left_on="area_name", right_index=True, how="left"
+    )
+    return summary_df.sort_values(by="pop_per_dwelling_last")
+
+
+def build_lollipop_data(source_url, output_path):
+    """
+    Persons per dwelling summary by country for the lollipop plot.
+
+    Parameters:
+    - source_url (str): PublicHouse dataset url.
+    - output_path (str): Where to write the summary csv.
+    """
+    # Load public data (cached on disk, set HTTP_CACHE_OFFLINE=1 to never download)
+    data = HttpCache().read_csv(source_url)
+
+    # Create city dataset - Add city states
+    # Choose a common year across countries or interpolate if no data
+    # add persons per dwelling
+    # add Auckland
+
+    # df_city = data[data["area_level"].isin(["city-region", "city-state"])].copy()
+
+    df_country = data[
+        data["area_level"].isin(["country"])
+    ].copy()  # add hong kong and Singapore
+
+    df_dwellings_country = df_country[df_country["variable"] == "dwellings"][
+        ["year", "value", "area_name", "grouping"]
+    ].copy()
+    df_dwellings_country = df_dwellings_country.rename(columns={"value": "dwellings"})
+
+    df_pop_country = df_country[df_country["variable"] == "population"][
+        ["year", "value", "area_name", "grouping"]
+    ].copy()
+    df_pop_country = df_pop_country.rename(columns={"value": "population"})
+
+    merged_df = pd.merge(
+        df_dwellings_country, df_pop_country, on=["year", "area_name", "grouping"]
+    )
+
+    summary_df = summarise_pop_per_dwelling(merged_df)
+
+    save_processed(summary_df, output_path)
 
-# data needed for lollipop plot (persons per dwelling by city): index: index:
-summary_df = merged_df[
-    [
-        "area_name",
-        "grouping",
-        "pop_per_dwelling_mean",
-        "pop_per_dwelling_min",
-        "pop_per_dwelling_max",
-        "pop_per_dwelling_last",
-    ]
-].drop_duplicates(["area_name", "grouping"])
-
-summary_df = summary_df.sort_values(by="pop_per_dwelling_last")
-
-summary_df.to_csv("../data/processed/housing_data_202411.csv", index=False)
 
 ################################################################################
-# data needed for facet plot of migration by citizenship 
-
-migration_data = pd.read_csv("../data/raw/df_citizenship_direction_202312.csv")
-
-# check most important groups
-df_rank = migration_data[migration_data["Direction"] == "Net"].copy()
-df_rank["net_sum"] = df_rank.groupby("Citizenship")["Count"].transform(
-    lambda x: x.rolling(window=12, min_periods=12).sum()
-)
-
-# all time
-print(df_rank[(df_rank["net_sum"] > 2000)].sort_values(by="net_sum", ascending=False)[
-    "Citizenship"
-].unique())  # check most important countries
-
-# recent
-print(df_rank[(df_rank["net_sum"] > 2000) & (df_rank["Month"] > "2023-06-01")].sort_values(
-    by="net_sum", ascending=False
-)[
-    "Citizenship"
-].unique())  # check most important countries
+# data needed for facet plot of migration by citizenship
 
 # top inflows by citizenship
-top_citizenships = [
+TOP_CITIZENSHIPS = [
     "New Zealand",
     "India",
     "Philippines",
@@ -115,81 +160,251 @@ top_citizenships = [
     #"Korea, Republic of",
 ]
 
-# Calculate the total for 'TOTAL ALL CITIZENSHIPS'
-total_all = migration_data[migration_data["Citizenship"] == "TOTAL ALL CITIZENSHIPS"]
-
-# Calculate the total for the excluded categories
-excluded_total = (
-    migration_data[migration_data["Citizenship"].isin(top_citizenships)]
-    .groupby(["Month", "Direction"])["Count"]
-    .sum()
-    .reset_index()
-)
-
-# Merge and calculate the new entry for 'Remaining Citizenship'
-remaining_total = total_all.merge(
-    excluded_total, on=["Month", "Direction"], suffixes=("_total", "_excluded")
-)
-remaining_total["Count"] = (
-    remaining_total["Count_total"] - remaining_total["Count_excluded"]
-)
-remaining_total["Citizenship"] = "Other Citizenships"
+DIRECTIONS = pd.CategoricalDtype(["Arrivals", "Departures", "Net"])
+
+
+def read_migration_chunked(
+    input_path,
+    citizenships,
+    chunksize=10000,
+    window=12,
+    rank_threshold=2000,
+    recent_start="2023-06-01",
+):
+    """
+    Stream the citizenship migration csv, keeping only what the facet data needs.
+
+    Each chunk is read with parsed dates and categorical columns, then reduced to the
+    rows of `citizenships`. Running totals by (Month, Direction) of 'TOTAL ALL
+    CITIZENSHIPS' and of the kept citizenships give the 'Other Citizenships' remainder,
+    and the rolling net sums used to rank citizenships are carried over chunk boundaries
+    with the last `window - 1` rows of each citizenship. Memory is therefore one chunk
+    plus what is returned, the kept rows and a total per month and direction, which
+    grow with the number of months; the rows of the other citizenships are never held
+    beyond their chunk.
+
+    Parameters:
+    - input_path (str): Raw Stats NZ migration by citizenship and direction.
+    - citizenships (list): Citizenships to keep.
+    - chunksize (int): Rows per chunk.
+    - window (int): Rolling window in months for the ranking.
+    - rank_threshold (float): Rolling net sum a citizenship must exceed to be ranked.
+    - recent_start (str): Months after this date count towards the recent ranking.
+
+    Returns:
+    - tuple: (kept rows, 'Other Citizenships' rows, all-time ranking, recent ranking).
+      The rankings are citizenships ordered by their highest rolling net sum. An input
+      without rows gives empty frames and rankings.
+    """
+    citizenship_dtype = pd.CategoricalDtype(sorted(set(citizenships) | {"Other Citizenships"}))
+    recent_start = pd.Timestamp(recent_start)
+
+    kept = []
+    total_all = None
+    kept_total = None
+    net_carry = None
+    best_all_time = pd.Series(dtype="float64")
+    best_recent = pd.Series(dtype="float64")
+
+    try:
+        reader = pd.read_csv(
+            input_path,
+            parse_dates=["Month"],
+            dtype={"Direction": DIRECTIONS, "Citizenship": "category"},
+            chunksize=chunksize,
+        )
+    except pd.errors.EmptyDataError:
+        # Not even a header: nothing to stream
+        reader = []
+    for chunk in reader:
+        # Rolling net sums for the ranking, continuing from the previous chunk
+        net = chunk.loc[chunk["Direction"] == "Net", ["Month", "Citizenship", "Count"]]
+        net = net.astype({"Citizenship": "object"})
+        if net_carry is not None:
+            net = pd.concat([net_carry, net], ignore_index=True)
+        net["net_sum"] = grouped_rolling_sum(net, "Citizenship", ["Count"])["Count"]
+        net_carry = net.groupby("Citizenship").tail(window - 1)[["Month", "Citizenship", "Count"]]
+
+        ranked = net[net["net_sum"] > rank_threshold]
+        best_all_time = best_all_time.combine(
+            ranked.groupby("Citizenship")["net_sum"].max(), max, fill_value=-np.inf
+        )
+        ranked = ranked[ranked["Month"] > recent_start]
+        best_recent = best_recent.combine(
+            ranked.groupby("Citizenship")["net_sum"].max(), max, fill_value=-np.inf
+        )
+
+        # Running totals for the 'Other Citizenships' remainder
+        chunk_total = (
+            chunk[chunk["Citizenship"] == "TOTAL ALL CITIZENSHIPS"]
+            .groupby(["Month", "Direction"], observed=True)["Count"]
+            .sum()
+        )
+        chunk = chunk[chunk["Citizenship"].isin(citizenships)]
+        chunk_kept_total = chunk.groupby(["Month", "Direction"], observed=True)["Count"].sum()
+        if total_all is None:
+            total_all, kept_total = chunk_total, chunk_kept_total
+        else:
+            total_all = total_all.add(chunk_total, fill_value=0)
+            kept_total = kept_total.add(chunk_kept_total, fill_value=0)
+
+        kept.append(chunk.astype({"Citizenship": citizenship_dtype}))
+
+    if not kept:
+        empty = pd.DataFrame(columns=["Month", "Count", "Direction", "Citizenship"])
+        no_ranking = np.array([], dtype=object)
+        return empty, empty.copy(), no_ranking, no_ranking.copy()
+    kept = pd.concat(kept, ignore_index=True)
+
+    # Only months and directions present in both totals, as with an inner merge
+    totals = pd.concat(
+        [total_all.rename("Count_total"), kept_total.rename("Count_excluded")],
+        axis=1,
+        join="inner",
+    )
+    remaining_total = totals.reset_index()
+    remaining_total["Count"] = (
+        remaining_total["Count_total"] - remaining_total["Count_excluded"]
+    ).astype(kept["Count"].dtype)
+    remaining_total["Citizenship"] = pd.Categorical(
+        ["Other Citizenships"] * len(remaining_total), dtype=citizenship_dtype
+    )
+    remaining_total = remaining_total[["Month", "Count", "Direction", "Citizenship"]]
+
+    return (
+        kept,
+        remaining_total,
+        best_all_time.sort_values(ascending=False).index.to_numpy(),
+        best_recent.sort_values(ascending=False).index.to_numpy(),
+    )
+
+
+def build_migration_data(input_path, output_path):
+    """
+    12-month rolling migration flows for the top citizenships, for the facet plot.
+
+    Parameters:
+    - input_path (str): Raw Stats NZ migration by citizenship and direction.
+    - output_path (str): Where to write the wide facet data csv.
+    """
+    migration_data, remaining_total, rank_all_time, rank_recent = read_migration_chunked(
+        input_path, TOP_CITIZENSHIPS
+    )
+
+    # check most important groups
+    print(rank_all_time)  # all time
+    print(rank_recent)  # recent
+
+    # Append the 'Other Citizenships' remainder to the kept citizenships; the result is
+    # small, so plain strings from here on keep the pivot order and replace simple
+    migration_data = pd.concat([migration_data, remaining_total], ignore_index=True)
+    migration_data = migration_data.astype({"Citizenship": "object", "Direction": "object"})
+
+    # Final dataset for plot in wide format
+    df = migration_data[migration_data["Citizenship"].isin(TOP_CITIZENSHIPS)]
+
+    df = df.pivot(
+        index=["Month", "Citizenship"], columns="Direction", values="Count"
+    ).reset_index()
+
+    # 12-month rolling sums of all directions in one pass
+    df[["arrivals_sum", "departures_sum", "net_sum"]] = grouped_rolling_sum(
+        df, "Citizenship", ["Arrivals", "Departures", "Net"]
+    ).to_numpy()
+
+    df = df[df["Month"] >= "2001-12-01"]
+
+    df['Citizenship'] = df['Citizenship'].replace({
+        "China, People's Republic of": 'China',
+        'Viet Nam': 'Vietnam'
+    })
+
+    # save df to csv and to a Parquet dataset partitioned by citizenship
+    save_processed(df, output_path, partition_cols=["Citizenship"])
 
-# Select the relevant columns
-remaining_total = remaining_total[["Month", "Count", "Direction", "Citizenship"]]
 
-# Append the new entry to the original DataFrame
-migration_data = pd.concat([migration_data, remaining_total], ignore_index=True)
-
-# Final dataset for plot in wide format
-df = migration_data[migration_data["Citizenship"].isin(top_citizenships)]
-
-df = df.pivot(
-    index=["Month", "Citizenship"], columns="Direction", values="Count"
-).reset_index()
+################################################################################
+# Data for anmiation plot
 
-df["arrivals_sum"] = df.groupby("Citizenship")["Arrivals"].transform(
-    lambda x: x.rolling(window=12, min_periods=12).sum()
-)
-df["departures_sum"] = df.groupby("Citizenship")["Departures"].transform(
-    lambda x: x.rolling(window=12, min_periods=12).sum()
-)
-df["net_sum"] = df.groupby("Citizenship")["Net"].transform(
-    lambda x: x.rolling(window=12, min_periods=12).sum()
-)
+def build_homeownership_data(input_path, output_path, output_full_path):
+    """
+    Long format home ownership by state and year, for the map and line animations.
 
-df["Month"] = pd.to_datetime(df["Month"])
+    Parameters:
+    - input_path (str): Wide raw FRED snapshot from extract_fred_data_home_ownership.py.
+    - output_path (str): Where to write the selected animation years.
+    - output_full_path (str): Where to write every year.
+    """
+    housing_data = pd.read_csv(input_path,  index_col=0, parse_dates=True)
 
-df = df[df["Month"] >= "2001-12-01"]
+    housing_data.index = housing_data.index.to_period('Y')
 
-df['Citizenship'] = df['Citizenship'].replace({
-    "China, People's Republic of": 'China',
-    'Viet Nam': 'Vietnam'
-})
+    # Convert the DataFrame from wide to long format
+    df_long = housing_data.reset_index().melt(id_vars='index', var_name='state', value_name='home_ownership')
 
-# save df to csv
-df.to_csv("../data/processed/nz_migration_facet_data_202312.csv", index=False)
+    # Rename the 'index' column to 'year'
+    df_long.rename(columns={'index': 'year'}, inplace=True)
 
+    df_long['year'] = df_long['year'].dt.year
 
-################################################################################
-# Data for anmiation plot
+    df_long_full=df_long.copy()
 
-housing_data = pd.read_csv("../data/raw/homeownership_state_20241124.csv",  index_col=0, parse_dates=True)
+    df_long=df_long[df_long['year'].isin([1984, 1990, 1995, 2000, 2005, 2010, 2015, 2020, 2023])].copy()
 
-housing_data.index = housing_data.index.to_period('Y')
+    save_processed(df_long, output_path, partition_cols=["year"])
 
-# Convert the DataFrame from wide to long format
-df_long = housing_data.reset_index().melt(id_vars='index', var_name='state', value_name='home_ownership')
+    save_processed(df_long_full, output_full_path, partition_cols=["year"])
 
-# Rename the 'index' column to 'year'
-df_long.rename(columns={'index': 'year'}, inplace=True)
 
-df_long['year'] = df_long['year'].dt.year
+################################################################################
+# Pipeline: each stage is called with its inputs followed by its outputs. Every
+# processed csv also gets a Parquet twin (see processed_store.save_processed).
+
+
+def processed_stage(name, func, inputs, outputs):
+    """Stage writing processed csvs with save_processed, their Parquet twins included."""
+    return Stage(
+        name,
+        func,
+        inputs,
+        outputs,
+        code=[processed_store],
+        artifacts=[dataset_path(path) for path in outputs],
+    )
+
+
+STAGES = [
+    processed_stage(
+        "lollipop",
+        build_lollipop_data,
+        inputs=[PUBLIC_HOUSE_URL],
+        outputs=["../data/processed/housing_data_202411.csv"],
+    ),
+    processed_stage(
+        "migration",
+        build_migration_data,
+        inputs=["../data/raw/df_citizenship_direction_202312.csv"],
+        outputs=["../data/processed/nz_migration_facet_data_202312.csv"],
+    ),
+    processed_stage(
+        "homeownership",
+        build_homeownership_data,
+        inputs=["../data/raw/homeownership_state_20241124.csv"],
+        outputs=[
+            "../data/processed/homeownership_state_processed_20241124.csv",
+            "../data/processed/homeownership_state_processed_full_20241124.csv",
+        ],
+    ),
+]
 
-df_long_full=df_long.copy()
 
-df_long=df_long[df_long['year'].isin([1984, 1990, 1995, 2000, 2005, 2010, 2015, 2020, 2023])].copy()
+if __name__ == "__main__":
+    import argparse
 
-df_long.to_csv("../data/processed/homeownership_state_processed_20241124.csv", index=False)
+    parser = argparse.ArgumentParser(description="Rebuild the processed datasets.")
+    parser.add_argument("stages", nargs="*", help="only run these stages")
+    parser.add_argument("--force", action="store_true", help="rebuild even if up to date")
+    parser.add_argument("--jobs", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
 
-df_long_full.to_csv("../data/processed/homeownership_state_processed_full_20241124.csv", index=False)
\ No newline at end of file
+    run_pipeline(STAGES, only=args.stages or None, force=args.force, max_workers=args.jobs)
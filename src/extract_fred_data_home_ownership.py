@@ -2,28 +2,18 @@
 
 import pandas as pd
 import matplotlib.pyplot as plt
-from fredapi import Fred
 from datetime import datetime
 from dotenv import load_dotenv
+import argparse
+import glob
 import os
 
+from fred_fetch import build_state_frame, fetch_series_concurrent, make_fred
+from http_cache import HttpCache
+
 # Set pandas parameters
 pd.set_option("display.max_colwidth", 1000)
 
-# Load environment variables from .env file
-load_dotenv()
-
-FRED_API_KEY = os.getenv("FRED_API_KEY")
-if FRED_API_KEY is None:
-    raise ValueError("FRED_API_KEY environment variable not set")
-
-
-# Search for state indicators
-fred = Fred(api_key=FRED_API_KEY)
-results = fred.search(
-    "Homeownership", limit=10, order_by="popularity", sort_order="desc"
-)
-
 list_states = [
     "WV",
     "FL",
@@ -85,7 +75,14 @@ list_states = [
 
 
 def collect_state_data(
-    api_key, state_codes, series_suffix, observation_start="2000-01-01"
+    api_key,
+    state_codes,
+    series_suffix,
+    observation_start="2000-01-01",
+    max_workers=None,
+    root_url=None,
+    dtype=None,
+    cache=None,
 ):
     """
     Retrieve employment data for each US state from FRED API and compile into a single DataFrame.
@@ -94,40 +91,194 @@ def collect_state_data(
     - api_key (str): Your FRED API key.
     - state_codes (list): List of state codes, e.g., ['TX', 'CA', 'NY', ...].
     - observation_start (str): The start date for retrieving data (YYYY-MM-DD).
+    - max_workers (int): If set, fetch series concurrently with this many workers,
+      rate limited per host and retried with backoff (see fred_fetch).
+    - root_url (str): Override for the FRED API root, e.g. a local fake endpoint.
+    - dtype (str): Optional dtype for the values, e.g. 'float32' to halve memory.
+    - cache (HttpCache): Optional response cache, so unchanged series cost no network I/O.
 
     Returns:
     - pd.DataFrame: DataFrame with employment data for each state, indexed by date.
     """
-    # Initialize FRED client
-    fred = Fred(api_key=api_key)
+    # Buffer the series by state and build the DataFrame once at the end
+    columns = {}
+
+    if max_workers is not None:
+        series_ids = {f"{state_code}{series_suffix}": state_code for state_code in state_codes}
+        results, errors = fetch_series_concurrent(
+            api_key,
+            list(series_ids),
+            observation_start=observation_start,
+            max_workers=max_workers,
+            root_url=root_url,
+            cache=cache,
+        )
+        # Add series in the order of state_codes so the frame matches the serial path
+        for series_id, state_code in series_ids.items():
+            if series_id in results:
+                columns[state_code] = results[series_id]
+            else:
+                print(f"Error retrieving data for {state_code}: {errors[series_id]}")
+        return build_state_frame(columns, dtype=dtype)
 
-    # Create an empty DataFrame to store all state data
-    all_data = pd.DataFrame()
+    # Initialize FRED client
+    fred = make_fred(api_key, root_url=root_url, cache=cache)
 
     # Loop over each state code
     for state_code in state_codes:
         series_id = f"{state_code}{series_suffix}"  # Construct the series ID
         try:
             # Retrieve data for the specific state
-            data = fred.get_series(series_id, observation_start=observation_start)
-            # Add the state's data to the main DataFrame
-            all_data[state_code] = data
+            columns[state_code] = fred.get_series(
+                series_id, observation_start=observation_start
+            )
         except Exception as e:
             print(f"Error retrieving data for {state_code}: {e}")
 
-    return all_data
+    return build_state_frame(columns, dtype=dtype)
+
+
+def find_latest_snapshot(directory, prefix):
+    """
+    Find the most recent dated raw snapshot, e.g. homeownership_state_20241124.csv.
+
+    Parameters:
+    - directory (str): Folder holding the snapshots.
+    - prefix (str): File name before the YYYYMMDD date, e.g. 'homeownership_state_'.
+
+    Returns:
+    - str: Path of the latest snapshot, or None if there is none.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, f"{prefix}[0-9]*.csv")))
+    return paths[-1] if paths else None
+
+
+def update_state_data(
+    api_key,
+    snapshot,
+    state_codes,
+    series_suffix,
+    observation_start="2000-01-01",
+    max_workers=8,
+    root_url=None,
+    cache=None,
+):
+    """
+    Extend a previously collected state DataFrame with observations published since.
+
+    Each series is only asked for observations after its last stored date. States that
+    are missing from the snapshot are retrieved from `observation_start`.
+
+    Parameters:
+    - api_key (str): Your FRED API key.
+    - snapshot (pd.DataFrame): Output of collect_state_data, indexed by date.
+    - state_codes (list): List of state codes, e.g., ['TX', 'CA', 'NY', ...].
+    - observation_start (str): The start date for states not in the snapshot (YYYY-MM-DD).
+    - max_workers (int): Number of concurrent workers.
+    - root_url (str): Override for the FRED API root, e.g. a local fake endpoint.
+    - cache (HttpCache): Optional response cache.
+
+    Returns:
+    - pd.DataFrame: The snapshot with the new observations merged in.
+    """
+    starts = {}
+    series_ids = {}
+    for state_code in state_codes:
+        series_id = f"{state_code}{series_suffix}"
+        series_ids[series_id] = state_code
+        last_date = None
+        if state_code in snapshot.columns:
+            last_date = snapshot[state_code].last_valid_index()
+        if last_date is None:
+            starts[series_id] = observation_start
+        else:
+            starts[series_id] = (last_date + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+
+    results, errors = fetch_series_concurrent(
+        api_key,
+        list(series_ids),
+        observation_start=starts,
+        max_workers=max_workers,
+        root_url=root_url,
+        cache=cache,
+    )
+
+    deltas = {}
+    for series_id, state_code in series_ids.items():
+        if series_id not in results:
+            print(f"Error retrieving data for {state_code}: {errors[series_id]}")
+        elif len(results[series_id]) > 0:
+            deltas[state_code] = results[series_id]
+
+    if not deltas:
+        return snapshot.copy()
+
+    new_rows = sum(len(delta) for delta in deltas.values())
+    print(f"Retrieved {new_rows} new observations for {len(deltas)} series")
+
+    delta_data = build_state_frame(deltas, union=True)
+    columns = list(snapshot.columns) + [
+        state_code for state_code in delta_data.columns if state_code not in snapshot.columns
+    ]
+    return snapshot.combine_first(delta_data)[columns]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only download observations newer than the latest raw snapshot",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="serve FRED responses from the local cache only",
+    )
+    args = parser.parse_args()
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    FRED_API_KEY = os.getenv("FRED_API_KEY")
+    if FRED_API_KEY is None:
+        raise ValueError("FRED_API_KEY environment variable not set")
+
+    # Responses are cached on disk, so re-runs within a day do not hit the API
+    cache = HttpCache(offline=args.offline or None)
+
+    # Search for state indicators; only informative, so skipped offline
+    if not cache.offline:
+        fred = make_fred(FRED_API_KEY, cache=cache)
+        results = fred.search(
+            "Homeownership", limit=10, order_by="popularity", sort_order="desc"
+        )
 
+    snapshot_path = find_latest_snapshot("../data/raw", "homeownership_state_")
 
-data = collect_state_data(
-    api_key=FRED_API_KEY,
-    state_codes=list_states,
-    series_suffix="HOWN",
-    observation_start="1984-01-01",
-)
+    if args.incremental and snapshot_path is not None:
+        snapshot = pd.read_csv(snapshot_path, index_col=0, parse_dates=True)
+        data = update_state_data(
+            api_key=FRED_API_KEY,
+            snapshot=snapshot,
+            state_codes=list_states,
+            series_suffix="HOWN",
+            observation_start="1984-01-01",
+            cache=cache,
+        )
+    else:
+        data = collect_state_data(
+            api_key=FRED_API_KEY,
+            state_codes=list_states,
+            series_suffix="HOWN",
+            observation_start="1984-01-01",
+            max_workers=8,
+            cache=cache,
+        )
 
+    # Get today's date in YYYYMMDD format
+    today_date = datetime.today().strftime("%Y%m%d")
 
-# Get today's date in YYYYMMDD format
-today_date = datetime.today().strftime("%Y%m%d")
+    # Save the data to a CSV file with today's date appended
+    data.to_csv(f"../data/raw/homeownership_state_{today_date}.csv", index=True)
 
-# Save the data to a CSV file with today's date appended
-data.to_csv(f"../data/raw/homeownership_state_{today_date}.csv", index=True)
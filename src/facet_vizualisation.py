@@ -1,14 +1,17 @@
-import pandas as pd
+import sys
 
 import matplotlib.pyplot as plt
 
 from matplotlib.lines import Line2D  # for the legend
 
 import matplotlib.patches as patches  # for the legend
-from pyfonts import load_font
 from matplotlib.ticker import FuncFormatter
 import numpy as np
 
+from font_registry import get_font
+from processed_store import load_processed
+from render_cache import RenderCache, render_key
+
 ### Constants
 
 BLUE = "#2166ACFF"
@@ -21,15 +24,13 @@ GREY20 = "#333333"
 CHARCOAL = "#333333"
 
 # Load the fonts
-font = load_font(
-    "https://github.com/google/fonts/blob/main/ofl/cabincondensed/CabinCondensed-SemiBold.ttf?raw=true"
-)
-other_font = load_font(
-    "https://github.com/google/fonts/blob/main/ofl/cabincondensed/CabinCondensed-Regular.ttf?raw=true"
-)
-other_bold_font = load_font(
-    "https://github.com/google/fonts/blob/main/ofl/cabincondensed/CabinCondensed-Medium.ttf?raw=true"
-)
+font = get_font("CabinCondensed-SemiBold")
+other_font = get_font("CabinCondensed-Regular")
+other_bold_font = get_font("CabinCondensed-Medium")
+
+
+NROW = 3
+NCOL = 3
 
 
 # Custom function to convert y-tick values to 'k' format
@@ -83,120 +84,182 @@ def single_plot(x, y1, y2, name, ax):
     )
 
 
-# load data
-data = pd.read_csv(
-    "../data/processed/nz_migration_facet_data_202312.csv", parse_dates=["Month"]
-)
+def facet_names(data):
+    """
+    Citizenships in facet order: New Zealand first, then by net migration in December
+    2023, largest first.
+    """
+    return ["New Zealand"] + list(
+        data[(data["Month"] == "2023-12-01") & (data["Citizenship"] != "New Zealand")]
+        .sort_values(by="net_sum", ascending=False)["Citizenship"]
+        .unique()
+    )
+
+
+def draw_facet(data, names):
+    """
+    Draws the arrivals and departures of each citizenship in a grid of small multiples.
+
+    Parameters:
+    - data: DataFrame of the facet data, with 'Month', 'Citizenship', 'arrivals_sum'
+      and 'departures_sum' columns.
+    - names: list of citizenships, one panel each in this order, at most NROW * NCOL.
+
+    Returns:
+    - The Matplotlib figure.
+    """
+    if len(names) > NROW * NCOL:
+        raise ValueError(f"At most {NROW * NCOL} citizenships fit the grid, got {len(names)}")
+    df_plot = data[["Month", "Citizenship", "arrivals_sum", "departures_sum"]]
+
+    # Create the figure and axes for subplots
+    fig, axes = plt.subplots(NROW, NCOL, figsize=(12, 10), sharex=True, sharey=True)
+
+    # Flatten axes for easy iteration
+    axes_flat = axes.flatten()
+
+    for i, name in enumerate(names):
+        # Select data for the citizenship in 'name'
+        df_subset = df_plot[df_plot["Citizenship"] == name]
+
+        # Take the corresponding axis
+        ax = axes_flat[i]
+
+        # Take values for x, y1, and y2
+        MONTH = df_subset["Month"].values
+        ARRIVALS = df_subset["arrivals_sum"].values
+        DEPARTURES = df_subset["departures_sum"].values
+
+        # Plot it using the single_plot function
+        single_plot(MONTH, DEPARTURES, ARRIVALS, name, ax)
+
+    # Remove any unused subplots
+    for j in range(len(names), len(axes_flat)):
+        fig.delaxes(axes_flat[j])
+
+    # Create handles for lines.
+    handles = [
+        Line2D([], [], c=color, lw=1.2, label=label)
+        for label, color in zip(["Departures", "Arrivals"], [BLUE, RED])
+    ]
+
+    # Add legend for the lines
+    fig.legend(
+        handles=handles,
+        loc=(0.75, 0.81),  # This coord is bottom-left corner
+        ncol=2,  # 1 row, 2 columns layout
+        columnspacing=1,  # Space between columns
+        handlelength=1.2,  # Line length
+        frameon=False,  # No frame
+        prop=other_font,
+        fontsize=14,
+    )
 
-NROW = 3
-NCOL = 3
-NAMES = ["New Zealand"] + list(
-    data[(data["Month"] == "2023-12-01") & (data["Citizenship"] != "New Zealand")]
-    .sort_values(by="net_sum", ascending=False)["Citizenship"]
-    .unique()
-)
-df_plot = data[["Month", "Citizenship", "arrivals_sum", "departures_sum"]]
-
-# Create the figure and axes for subplots
-fig, axes = plt.subplots(NROW, NCOL, figsize=(12, 10), sharex=True, sharey=True)
-
-# Flatten axes for easy iteration
-axes_flat = axes.flatten()
-
-for i, name in enumerate(NAMES):
-    # Select data for the citizenship in 'name'
-    df_subset = df_plot[df_plot["Citizenship"] == name]
-
-    # Take the corresponding axis
-    ax = axes_flat[i]
-
-    # Take values for x, y1, and y2
-    MONTH = df_subset["Month"].values
-    ARRIVALS = df_subset["arrivals_sum"].values
-    DEPARTURES = df_subset["departures_sum"].values
-
-    # Plot it using the single_plot function
-    single_plot(MONTH, DEPARTURES, ARRIVALS, name, ax)
-
-# Remove any unused subplots
-for j in range(len(NAMES), len(axes_flat)):
-    fig.delaxes(axes_flat[j])
-
-
-# Create handles for lines.
-handles = [
-    Line2D([], [], c=color, lw=1.2, label=label)
-    for label, color in zip(["Departures", "Arrivals"], [BLUE, RED])
-]
-
-# Add legend for the lines
-fig.legend(
-    handles=handles,
-    loc=(0.75, 0.81),  # This coord is bottom-left corner
-    ncol=2,  # 1 row, 2 columns layout
-    columnspacing=1,  # Space between columns
-    handlelength=1.2,  # Line length
-    frameon=False,  # No frame
-    prop=other_font,
-    fontsize=14,
-)
-
-
-# Create handles for the area fill with `patches.Patch()`
-outflow = patches.Patch(facecolor=BLUE_LIGHT, alpha=0.3, label="Net outflow")
-inflow = patches.Patch(facecolor=RED_LIGHT, alpha=0.3, label="Net inflow")
-
-fig.legend(
-    handles=[outflow, inflow],
-    loc=(0.75, 0.78),  # This coord is top-right corner
-    ncol=2,  # 1 row, 2 columns layout
-    columnspacing=1,  # Space between columns
-    handlelength=2,  # Area length
-    handleheight=2,  # Area height
-    frameon=False,  # No frame
-    prop=other_font,
-    fontsize=14,
-)
-
-# Title
-fig.text(
-    s="Which migrants are replacing the New Zealand citizens who leave?",
-    x=0.05,
-    y=1.025,
-    color=CHARCOAL,
-    fontsize=30,
-    font=font,
-    ha="left",
-    va="top",
-    fontweight="bold",
-)
-
-# subtitle
-fig.text(
-    s="Long-term migration in New Zealand by citizenship (12-month rolling sum, top 9 citizenships)",
-    x=0.05,
-    y=0.97,
-    color=CHARCOAL,
-    fontsize=17,
-    font=other_bold_font,
-    ha="left",
-    va="top",
-)
-
-# Caption
-fig.text(
-    s="Source: Statistics NZ\nautonomousecon.substack.com",
-    x=0.98,
-    y=-0.05,
-    color=CHARCOAL,
-    fontsize=12,
-    font=other_font,
-    ha="right",
-    va="baseline",
-)
-
-# Adjust layout and show the plot
-plt.tight_layout()
-plt.subplots_adjust(top=0.89, bottom=0.04)
-plt.savefig("../reports/facet_migration", dpi=300, bbox_inches="tight")
-plt.show()
+    # Create handles for the area fill with `patches.Patch()`
+    outflow = patches.Patch(facecolor=BLUE_LIGHT, alpha=0.3, label="Net outflow")
+    inflow = patches.Patch(facecolor=RED_LIGHT, alpha=0.3, label="Net inflow")
+
+    fig.legend(
+        handles=[outflow, inflow],
+        loc=(0.75, 0.78),  # This coord is top-right corner
+        ncol=2,  # 1 row, 2 columns layout
+        columnspacing=1,  # Space between columns
+        handlelength=2,  # Area length
+        handleheight=2,  # Area height
+        frameon=False,  # No frame
+        prop=other_font,
+        fontsize=14,
+    )
+
+    # Title
+    fig.text(
+        s="Which migrants are replacing the New Zealand citizens who leave?",
+        x=0.05,
+        y=1.025,
+        color=CHARCOAL,
+        fontsize=30,
+        font=font,
+        ha="left",
+        va="top",
+        fontweight="bold",
+    )
+
+    # subtitle
+    fig.text(
+        s="Long-term migration in New Zealand by citizenship (12-month rolling sum, top 9 citizenships)",
+        x=0.05,
+        y=0.97,
+        color=CHARCOAL,
+        fontsize=17,
+        font=other_bold_font,
+        ha="left",
+        va="top",
+    )
+
+    # Caption
+    fig.text(
+        s="Source: Statistics NZ\nautonomousecon.substack.com",
+        x=0.98,
+        y=-0.05,
+        color=CHARCOAL,
+        fontsize=12,
+        font=other_font,
+        ha="right",
+        va="baseline",
+    )
+
+    # Adjust layout
+    fig.tight_layout()
+    fig.subplots_adjust(top=0.89, bottom=0.04)
+    return fig
+
+
+def facet_render_key(data, names, dpi=300):
+    """
+    RenderCache key of the image of draw_facet, saved with bbox_inches="tight".
+
+    Parameters:
+    - data, names: As for draw_facet.
+    - dpi (int): Image resolution.
+
+    Returns:
+    - str: Hex digest over the rows drawn, the style and the drawing code.
+    """
+    rows = (
+        data.loc[
+            data["Citizenship"].isin(names),
+            ["Month", "Citizenship", "arrivals_sum", "departures_sum"],
+        ]
+        .sort_values(["Citizenship", "Month"])
+        .reset_index(drop=True)
+    )
+    style = {
+        "names": list(names),
+        "colors": [BLUE, BLUE_LIGHT, RED, RED_LIGHT, GREY40, GREY25, GREY20, CHARCOAL],
+        "fonts": [font, other_font, other_bold_font],
+        "grid": (NROW, NCOL),
+    }
+    return render_key(rows, style, [sys.modules[__name__]], dpi=dpi, bbox_inches="tight")
+
+
+if __name__ == "__main__":
+    # load data
+    data = load_processed(
+        "../data/processed/nz_migration_facet_data_202312.csv",
+        columns=["Month", "Citizenship", "arrivals_sum", "departures_sum", "net_sum"],
+        parse_dates=["Month"],
+    )
+
+    # From the render cache when neither the data nor the style changed
+    names = facet_names(data)
+    cache = RenderCache()
+    fig = cache.savefig(
+        facet_render_key(data, names, dpi=300),
+        lambda: draw_facet(data, names),
+        "../reports/facet_migration",
+        dpi=300,
+        bbox_inches="tight",
+    )
+    print(f"Render cache: {cache.stats()}")
+    if fig is not None:
+        plt.show()
@@ -0,0 +1,140 @@
+"""
+Local stand-in for the FRED series/observations endpoint, used to measure the serial and
+concurrent fetch paths of collect_state_data offline.
+
+Run from src/:  python fake_fred.py --latency 0.2 --workers 8
+"""
+
+import argparse
+import random
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+
+def make_observations(series_id, observation_start="1984-01-01", observation_end="2023-01-01"):
+    """
+    Deterministic annual observations for a series id, in the shape FRED returns.
+
+    Parameters:
+    - series_id (str): FRED series id; seeds the generated values.
+    - observation_start (str): First observation date (YYYY-MM-DD).
+    - observation_end (str): Last observation date (YYYY-MM-DD).
+
+    Returns:
+    - list: (date string, value string) tuples.
+    """
+    rng = random.Random(zlib.crc32(series_id.encode()))
+    level = rng.uniform(50, 75)
+    dates = pd.date_range(observation_start, observation_end, freq="YS")
+    observations = []
+    for date in dates:
+        level += rng.uniform(-1, 1)
+        observations.append((date.strftime("%Y-%m-%d"), f"{level:.1f}"))
+    return observations
+
+
+class FakeFredHandler(BaseHTTPRequestHandler):
+    # latency, failure_rate, rng and lock are set on the server by serve_fake_fred
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        time.sleep(self.server.latency)
+
+        if not url.path.endswith("/series/observations") or "series_id" not in query:
+            self._reply(400, '<error code="400" message="Bad Request."/>')
+            return
+
+        with self.server.lock:
+            self.server.request_count += 1
+            fail = self.server.rng.random() < self.server.failure_rate
+        if fail:
+            # Non-XML body, like a proxy error page: fredapi raises a ParseError
+            self._reply(503, "Service Unavailable", content_type="text/plain")
+            return
+
+        observation_start = query.get("observation_start", "1776-07-04")
+        rows = "".join(
+            f'<observation realtime_start="2024-11-24" realtime_end="2024-11-24" '
+            f'date="{date}" value="{value}"/>'
+            for date, value in make_observations(query["series_id"])
+            if date >= observation_start
+        )
+        self._reply(200, f"<observations>{rows}</observations>")
+
+    def _reply(self, status, body, content_type="text/xml"):
+        payload = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def serve_fake_fred(latency=0.1, failure_rate=0.0, seed=0):
+    """
+    Run a fake FRED endpoint on a free local port for the duration of the block.
+
+    Parameters:
+    - latency (float): Seconds each request sleeps before answering.
+    - failure_rate (float): Probability of answering a request with a transient 503.
+    - seed (int): Seed for the failure draws.
+
+    Yields:
+    - str: Root url to pass as `root_url` to collect_state_data.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeFredHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.failure_rate = failure_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.request_count = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/fred"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    from extract_fred_data_home_ownership import collect_state_data, list_states
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    with serve_fake_fred(latency=args.latency, failure_rate=args.failure_rate) as root_url:
+        timings = {}
+        frames = {}
+        for mode, max_workers in [("serial", None), ("concurrent", args.workers)]:
+            start = time.perf_counter()
+            frames[mode] = collect_state_data(
+                api_key="fake",
+                state_codes=list_states,
+                series_suffix="HOWN",
+                observation_start="1984-01-01",
+                max_workers=max_workers,
+                root_url=root_url,
+            )
+            timings[mode] = time.perf_counter() - start
+
+    print(f"serial:     {timings['serial']:.2f}s")
+    print(f"concurrent: {timings['concurrent']:.2f}s ({args.workers} workers)")
+    print(f"speedup:    {timings['serial'] / timings['concurrent']:.1f}x")
+    if args.failure_rate == 0:
+        pd.testing.assert_frame_equal(frames["serial"], frames["concurrent"])
+        print("frames identical")
@@ -0,0 +1,252 @@
+"""
+Named fonts resolved from a local on-disk cache.
+
+The visualization scripts used to download their fonts from GitHub with
+pyfonts.load_font at import time, on every run. get_font returns a FontProperties that
+finds its file only when matplotlib first draws with it, in the cache below. A font
+missing from the cache is downloaded then, unless offline mode is on, and every cached
+file is checked against the SHA-256 recorded when it was added.
+
+Seed the cache from font files (e.g. on an offline render node), or download every
+registered font, from src/:
+
+    python font_registry.py seed path/to/FiraSans-Light.ttf ...
+    python font_registry.py fetch
+    python font_registry.py list
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+from matplotlib.font_manager import FontProperties
+from matplotlib.ft2font import FT2Font
+
+DEFAULT_FONT_DIR = "../data/cache/fonts"
+
+# Font name (the file stem) mapped to the url it is downloaded from
+FONTS = {
+    "BebasNeue-Regular": "https://github.com/dharmatype/Bebas-Neue/blob/master/fonts/BebasNeue(2018)ByDhamraType/ttf/BebasNeue-Regular.ttf?raw=true",
+    "FiraSans-Light": "https://github.com/bBoxType/FiraSans/blob/master/Fira_Sans_4_3/Fonts/Fira_Sans_TTF_4301/Normal/Roman/FiraSans-Light.ttf?raw=true",
+    "FiraSans-Medium": "https://github.com/bBoxType/FiraSans/blob/master/Fira_Sans_4_3/Fonts/Fira_Sans_TTF_4301/Normal/Roman/FiraSans-Medium.ttf?raw=true",
+    "CabinCondensed-SemiBold": "https://github.com/google/fonts/blob/main/ofl/cabincondensed/CabinCondensed-SemiBold.ttf?raw=true",
+    "CabinCondensed-Regular": "https://github.com/google/fonts/blob/main/ofl/cabincondensed/CabinCondensed-Regular.ttf?raw=true",
+    "CabinCondensed-Medium": "https://github.com/google/fonts/blob/main/ofl/cabincondensed/CabinCondensed-Medium.ttf?raw=true",
+}
+
+
+class FontCacheError(Exception):
+    """Raised when a font is not cached and cannot be downloaded, or fails its check."""
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FontRegistry:
+    """
+    On-disk cache of the fonts in FONTS, with a manifest of their checksums.
+
+    Parameters:
+    - directory (str): Folder holding the font files and `index.json`.
+    - fonts (dict): Font name mapped to its download url.
+    - offline (bool): Never download; fonts must be seeded. Defaults to the
+      FONT_CACHE_OFFLINE environment variable.
+    """
+
+    def __init__(self, directory=DEFAULT_FONT_DIR, fonts=FONTS, offline=None):
+        self.directory = directory
+        self.fonts = fonts
+        if offline is None:
+            offline = os.getenv("FONT_CACHE_OFFLINE", "") not in ("", "0")
+        self.offline = offline
+        self._lock = threading.Lock()
+        # Font name mapped to its verified file, for this process
+        self._resolved = {}
+        self._index_path = os.path.join(directory, "index.json")
+
+    def path(self, name):
+        """
+        Local file of font `name`, downloading it first if needed and allowed.
+
+        The file's checksum is verified the first time it is resolved in a process. Matplotlib
+        copies FontProperties freely, so later calls return the verified path at once.
+        """
+        with self._lock:
+            if name in self._resolved:
+                return self._resolved[name]
+            index = self._load_index()
+            entry = index.get(name)
+            if entry is not None:
+                font_path = os.path.join(self.directory, entry["file"])
+                if os.path.exists(font_path) and file_sha256(font_path) == entry["sha256"]:
+                    self._resolved[name] = font_path
+                    return font_path
+                if self.offline:
+                    raise FontCacheError(f"Cached font {name} is missing or corrupt; seed it again")
+            return self._download(name, index)
+
+    def seed(self, source_path, name=None):
+        """
+        Add a font file to the cache.
+
+        Parameters:
+        - source_path (str): Font file to copy in.
+        - name (str): Font name, defaults to the file stem, e.g. 'FiraSans-Light'.
+
+        Returns:
+        - str: The font name.
+        """
+        name = name or os.path.splitext(os.path.basename(source_path))[0]
+        check_font(source_path)
+        with self._lock:
+            index = self._load_index()
+            extension = os.path.splitext(source_path)[1]
+            self._store(name, source_path, extension, index, os.path.abspath(source_path))
+        return name
+
+    def fetch(self, name):
+        """Download font `name` into the cache, replacing any cached copy."""
+        with self._lock:
+            return self._download(name, self._load_index())
+
+    def cached(self):
+        """Font names in the cache, with their file and checksum."""
+        return self._load_index()
+
+    def _download(self, name, index):
+        if name not in self.fonts:
+            raise FontCacheError(f"Unknown font {name!r}; registered: {', '.join(self.fonts)}")
+        if self.offline:
+            raise FontCacheError(f"Font {name} is not cached and offline mode is on")
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = os.path.join(self.directory, f"{name}.{os.getpid()}.download")
+        try:
+            with urlopen(self.fonts[name], timeout=30) as response, open(tmp_path, "wb") as f:
+                shutil.copyfileobj(response, f)
+            # A failed GitHub download can be an HTML page with status 200
+            check_font(tmp_path)
+            extension = os.path.splitext(urlparse(self.fonts[name]).path)[1]
+            return self._store(name, tmp_path, extension, index, self.fonts[name], move=True)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _store(self, name, source_path, extension, index, source, move=False):
+        os.makedirs(self.directory, exist_ok=True)
+        file_name = name + (extension or ".ttf")
+        font_path = os.path.join(self.directory, file_name)
+        digest = file_sha256(source_path)
+        tmp_path = f"{font_path}.{os.getpid()}.tmp"
+        if move:
+            os.replace(source_path, tmp_path)
+        else:
+            shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, font_path)
+
+        index[name] = {"file": file_name, "sha256": digest, "source": source}
+        self._save_index(index)
+        self._resolved[name] = font_path
+        return font_path
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_index(self, index):
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._index_path)
+
+
+def check_font(path):
+    """Raise FontCacheError unless `path` is a font FreeType can open."""
+    try:
+        FT2Font(path)
+    except (OSError, RuntimeError, ValueError) as e:
+        raise FontCacheError(f"{path} is not a valid font file: {e}") from e
+
+
+class LazyFont(FontProperties):
+    """
+    FontProperties of a registry font, resolving its file when matplotlib first asks.
+
+    Creating one touches neither the disk nor the network, so scripts can define their
+    fonts at import time for free.
+    """
+
+    def __init__(self, name, registry=None):
+        super().__init__()
+        self.name = name
+        self._registry = registry
+
+    def get_file(self):
+        if self._file is None:
+            self.set_file((self._registry or default_registry()).path(self.name))
+        return self._file
+
+    def __repr__(self):
+        return f"LazyFont({self.name!r})"
+
+
+_default_registry = None
+
+
+def default_registry():
+    """The FontRegistry of the default cache directory, created on first use."""
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = FontRegistry()
+    return _default_registry
+
+
+def get_font(name):
+    """
+    Font `name` from the registry, for the `font` argument of matplotlib and
+    highlight_text.
+
+    Parameters:
+    - name (str): A name in FONTS, e.g. 'FiraSans-Light', or of a seeded font.
+
+    Returns:
+    - LazyFont: FontProperties loading the cached file on first use.
+    """
+    return LazyFont(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the local font cache.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    seed_parser = subparsers.add_parser("seed", help="Add font files to the cache")
+    seed_parser.add_argument("paths", nargs="+")
+    fetch_parser = subparsers.add_parser("fetch", help="Download registered fonts")
+    fetch_parser.add_argument("names", nargs="*", help="Defaults to all of them")
+    subparsers.add_parser("list", help="Show registered and cached fonts")
+    args = parser.parse_args()
+
+    registry = FontRegistry()
+    if args.command == "seed":
+        for path in args.paths:
+            print(f"Seeded {registry.seed(path)}")
+    elif args.command == "fetch":
+        for name in args.names or list(FONTS):
+            print(f"Fetched {name} to {registry.fetch(name)}")
+    else:
+        cached = registry.cached()
+        for name in sorted(set(FONTS) | set(cached)):
+            entry = cached.get(name)
+            status = f"cached, sha256 {entry['sha256'][:12]}" if entry else "not cached"
+            print(f"{name:26s} {status}")
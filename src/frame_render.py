@@ -0,0 +1,201 @@
+"""
+Render animation frames in parallel worker processes.
+
+FuncAnimation.save draws every frame on one core. save_animation splits the frames
+across a process pool instead: each worker draws frames on its own copy of the figure
+with the Agg canvas and sends back the raw RGBA buffer, which is what the Pillow writer
+behind FuncAnimation.save grabs, and the frames are encoded in order. The output is
+byte-identical to FuncAnimation(fig, update, frames).save(path, fps=fps).
+
+The pool forks, so the workers inherit the figure and update function the animation
+script built at module level. Without fork (Windows), the frames are rendered one after
+the other in this process instead.
+
+Given the artists the update function changes, the workers instead rasterize the rest of
+the figure once and composite only those artists per frame, see layer_composite. That
+output is no longer byte-identical where static and changing artists overlap.
+"""
+
+import multiprocessing
+import os
+from collections import deque
+from io import BytesIO
+from itertools import islice
+
+import matplotlib as mpl
+import numpy as np
+from matplotlib.colors import to_rgba
+from PIL import Image
+
+from animation_writer import AnimationWriter
+from layer_composite import LayeredFigure
+
+# Set in the parent just before forking, read by the workers
+_figure = None
+_update = None
+_savefig_kwargs = None
+_dynamic = None
+_on_top = None
+# Built by each worker on its first frame
+_layered = None
+
+
+def savefig_kwargs_for(fig, dpi):
+    """The savefig arguments FuncAnimation.save grabs frames with."""
+    facecolor = mpl.rcParams["savefig.facecolor"]
+    if facecolor == "auto":
+        facecolor = fig.get_facecolor()
+    r, g, b, a = to_rgba(facecolor)
+    return {
+        # FuncAnimation.save composites the face color onto white
+        "facecolor": a * np.array([r, g, b]) + 1 - a,
+        "transparent": False,
+        "format": "rgba",
+        "dpi": dpi,
+    }
+
+
+def grab_frame(fig, savefig_kwargs):
+    """Draw `fig` and return its raw RGBA buffer."""
+    buf = BytesIO()
+    with mpl.rc_context({"savefig.bbox": None}):
+        fig.savefig(buf, **savefig_kwargs)
+    return buf.getvalue()
+
+
+def _grab():
+    global _layered
+    if _dynamic is None:
+        return grab_frame(_figure, _savefig_kwargs)
+    if _layered is None:
+        _layered = LayeredFigure(
+            _figure, _dynamic, _on_top, _savefig_kwargs["dpi"], _savefig_kwargs["facecolor"]
+        )
+    return _layered.render()
+
+
+def _render_task(task):
+    history, frames = task
+    for frame in history:
+        _update(frame)
+    buffers = []
+    for frame in frames:
+        _update(frame)
+        buffers.append(_grab())
+    return buffers
+
+
+def render_tasks(frames, workers, replay):
+    """
+    Split `frames` into (history, frames) tasks.
+
+    Without replay every frame is its own task. With replay, for update functions whose
+    output depends on the frames drawn before (e.g. ones that add text to the figure
+    every frame), each worker gets one contiguous run of frames and first replays,
+    without drawing, the updates FuncAnimation.save would have made before it: the
+    initial draw of the first frame and every earlier frame.
+    """
+    frames = list(frames)
+    if not replay:
+        return [([], [frame]) for frame in frames]
+    size = -(-len(frames) // workers)
+    return [
+        (frames[:1] + frames[:start], frames[start : start + size])
+        for start in range(0, len(frames), size)
+    ]
+
+
+def iter_frames(
+    fig, update, frames, dpi=None, workers=None, replay=False, dynamic=None, on_top=()
+):
+    """
+    Render the frames of an animation in a process pool.
+
+    Parameters:
+    - fig: The animation's figure.
+    - update: The animation's update function, called with each frame.
+    - frames: Frames to render, as passed to FuncAnimation.
+    - dpi: Resolution, defaults to the figure's dpi like FuncAnimation.save.
+    - workers (int): Number of processes, defaults to the CPU count. Ignored, rendering
+      in this process, on platforms without fork.
+    - replay (bool): Whether update depends on earlier frames, see render_tasks.
+    - dynamic, on_top (list): The artists update changes, below and above the static
+      ones. With them, the rest of the figure is rasterized once per worker and frames
+      only draw these, see layer_composite.LayeredFigure.
+
+    Yields:
+    - bytes: The RGBA buffer of each frame, in order.
+    """
+    global _figure, _update, _savefig_kwargs, _dynamic, _on_top, _layered
+
+    dpi = dpi or fig.dpi
+    workers = workers or os.cpu_count()
+    _figure, _update, _layered = fig, update, None
+    _dynamic, _on_top = dynamic, on_top
+    _savefig_kwargs = savefig_kwargs_for(fig, dpi)
+
+    if "fork" not in multiprocessing.get_all_start_methods():
+        # The workers could not inherit the figure: render serially, like FuncAnimation.save
+        for task in render_tasks(frames, 1, replay):
+            yield from _render_task(task)
+        return
+
+    tasks = iter(render_tasks(frames, workers, replay))
+    context = multiprocessing.get_context("fork")
+    with context.Pool(workers) as pool:
+        # Keep at most two tasks per worker in flight, so that rendered frames waiting
+        # to be encoded do not pile up in memory
+        pending = deque(
+            pool.apply_async(_render_task, (task,)) for task in islice(tasks, 2 * workers)
+        )
+        while pending:
+            buffers = pending.popleft().get()
+            for task in islice(tasks, 1):
+                pending.append(pool.apply_async(_render_task, (task,)))
+            yield from buffers
+
+
+def frame_size(fig, dpi=None):
+    """Pixel (width, height) of the frames of `fig`, as matplotlib's movie writers compute it."""
+    width, height = fig.get_size_inches()
+    dpi = dpi or fig.dpi
+    return int(width * dpi), int(height * dpi)
+
+
+def save_animation(
+    fig,
+    update,
+    frames,
+    path,
+    fps,
+    dpi=None,
+    workers=None,
+    replay=False,
+    palette=None,
+    dynamic=None,
+    on_top=(),
+):
+    """
+    Render an animation in parallel and save it, like FuncAnimation.save.
+
+    Parameters are as for iter_frames, plus:
+    - path (str): Output file.
+    - fps (float): Frames per second.
+    - palette (np.ndarray): Optional fixed palette, see animation_writer.blend_palette.
+      With a palette the frames are streamed to an AnimationWriter (GIF, APNG or WebP)
+      as they arrive, and without dynamic artists the file is byte-identical to saving with
+      animation_writer.PaletteWriter. Without one, all frames are collected and saved
+      as a GIF like the default Pillow writer does.
+    """
+    size = frame_size(fig, dpi)
+    buffers = iter_frames(fig, update, frames, dpi, workers, replay, dynamic, on_top)
+    if palette is not None:
+        with AnimationWriter(path, size, palette, fps) as writer:
+            for buffer in buffers:
+                writer.append(buffer)
+        return
+
+    images = [Image.frombuffer("RGBA", size, buffer, "raw", "RGBA", 0, 1) for buffer in buffers]
+    images[0].save(
+        path, save_all=True, append_images=images[1:], duration=int(1000 / fps), loop=0
+    )
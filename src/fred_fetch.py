@@ -0,0 +1,231 @@
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+
+import pandas as pd
+from fredapi import Fred
+
+
+class CachedFred(Fred):
+    """
+    FRED client that routes API requests through an HttpCache.
+
+    The API key is left out of the cache key so it never ends up in the cache index.
+
+    Parameters:
+    - api_key (str): Your FRED API key.
+    - cache (HttpCache): Response cache.
+    """
+
+    def __init__(self, api_key, cache):
+        super().__init__(api_key=api_key)
+        self.cache = cache
+
+    # fredapi fetches through the name-mangled private Fred.__fetch_data
+    def _Fred__fetch_data(self, url):
+        try:
+            body = self.cache.fetch(url + "&api_key=" + self.api_key, key=url)
+        except HTTPError as exc:
+            root = ET.fromstring(exc.read())
+            raise ValueError(root.get("message"))
+        return ET.fromstring(body)
+
+
+def make_fred(api_key, root_url=None, cache=None):
+    """
+    Create a FRED client, optionally pointed at another root url and backed by a cache.
+
+    Parameters:
+    - api_key (str): Your FRED API key.
+    - root_url (str): Override for the FRED API root, e.g. a local fake endpoint.
+    - cache (HttpCache): Optional response cache.
+
+    Returns:
+    - Fred: FRED client.
+    """
+    fred = Fred(api_key=api_key) if cache is None else CachedFred(api_key, cache)
+    if root_url is not None:
+        fred.root_url = root_url
+    return fred
+
+
+class HostRateLimiter:
+    """
+    Token bucket rate limiter keyed by host name, shared between worker threads.
+
+    A host gets at most `burst + rate * t` requests in any `t` seconds.
+
+    Parameters:
+    - rate (float): Tokens added per second for each host.
+    - burst (int): Maximum number of tokens a host can accumulate.
+    """
+
+    def __init__(self, rate=1.9, burst=5):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        """Block until a request to `host` is allowed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_retryable(error):
+    """
+    Decide whether a failed FRED request is worth retrying.
+
+    Network errors and unparseable (non-XML) error pages are transient. fredapi turns
+    HTTP errors into a ValueError carrying the API message, of which only rate limiting
+    (HTTP 429) is transient; unknown series ids and bad parameters are not.
+    """
+    if isinstance(error, (OSError, ET.ParseError)):
+        return True
+    if isinstance(error, ValueError):
+        message = str(error)
+        return "429" in message or "Rate Limit" in message
+    return False
+
+
+def get_series_with_retry(
+    fred,
+    series_id,
+    observation_start=None,
+    rate_limiter=None,
+    retries=3,
+    backoff=0.5,
+):
+    """
+    Retrieve a single FRED series, retrying transient failures with exponential backoff.
+
+    Parameters:
+    - fred (Fred): FRED client.
+    - series_id (str): FRED series id, e.g. 'CAHOWN'.
+    - observation_start (str): The start date for retrieving data (YYYY-MM-DD).
+    - rate_limiter (HostRateLimiter): Optional limiter applied before every attempt.
+    - retries (int): Number of retries after the first attempt.
+    - backoff (float): Delay in seconds before the first retry, doubled on each retry.
+
+    Returns:
+    - pd.Series: Observations indexed by date.
+    """
+    host = urlparse(fred.root_url).netloc
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire(host)
+        try:
+            return fred.get_series(series_id, observation_start=observation_start)
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def fetch_series_concurrent(
+    api_key,
+    series_ids,
+    observation_start=None,
+    max_workers=8,
+    requests_per_second=1.9,
+    burst=5,
+    retries=3,
+    backoff=0.5,
+    root_url=None,
+    cache=None,
+):
+    """
+    Retrieve several FRED series using a bounded pool of worker threads.
+
+    The default rate of 1.9 requests per second with a burst of 5 allows at most
+    5 + 60 * 1.9 = 119 requests in any minute, within the FRED API limit of 120 requests
+    per minute.
+
+    Parameters:
+    - api_key (str): Your FRED API key.
+    - series_ids (list): List of FRED series ids.
+    - observation_start (str or dict): The start date for retrieving data (YYYY-MM-DD),
+      or a dict mapping each series id to its own start date.
+    - max_workers (int): Maximum number of requests in flight.
+    - requests_per_second (float): Sustained request rate allowed per host, or None for no limit.
+    - burst (int): Number of requests allowed per host before throttling kicks in.
+    - retries (int): Number of retries for transient failures.
+    - backoff (float): Initial retry delay in seconds.
+    - root_url (str): Override for the FRED API root, e.g. a local fake endpoint.
+    - cache (HttpCache): Optional response cache.
+
+    Returns:
+    - tuple: (results, errors) dicts keyed by series id, holding the retrieved pd.Series
+      and the exception raised for failed series respectively.
+    """
+    fred = make_fred(api_key, root_url=root_url, cache=cache)
+
+    rate_limiter = None
+    if requests_per_second is not None:
+        rate_limiter = HostRateLimiter(rate=requests_per_second, burst=burst)
+
+    if not isinstance(observation_start, dict):
+        observation_start = dict.fromkeys(series_ids, observation_start)
+
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            series_id: executor.submit(
+                get_series_with_retry,
+                fred,
+                series_id,
+                observation_start=observation_start.get(series_id),
+                rate_limiter=rate_limiter,
+                retries=retries,
+                backoff=backoff,
+            )
+            for series_id in series_ids
+        }
+        for series_id, future in futures.items():
+            try:
+                results[series_id] = future.result()
+            except Exception as e:
+                errors[series_id] = e
+
+    return results, errors
+
+
+def build_state_frame(columns, dtype=None, union=False):
+    """
+    Combine retrieved series into one wide DataFrame with a single aligned concat.
+
+    Like inserting the series column by column into an empty DataFrame, every column is
+    aligned to the first series' dates: dates only other series have are dropped.
+
+    Parameters:
+    - columns (dict): Series keyed by column name, in the desired column order.
+    - dtype (str): Optional dtype for the values, e.g. 'float32'.
+    - union (bool): Use the sorted union of all the series' dates instead, like
+      pd.DataFrame(columns).
+
+    Returns:
+    - pd.DataFrame: One column per series, indexed by date.
+    """
+    if not columns:
+        return pd.DataFrame()
+    data = pd.concat(columns, axis=1, join="outer", copy=False)
+    if union:
+        data = data.sort_index()
+    else:
+        data = data.reindex(next(iter(columns.values())).index)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return data
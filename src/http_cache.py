@@ -0,0 +1,174 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pandas as pd
+
+DEFAULT_CACHE_DIR = "../data/cache/http"
+
+
+class OfflineCacheMiss(Exception):
+    """Raised in offline mode when a url has never been downloaded."""
+
+
+class HttpCache:
+    """
+    Content-addressed on-disk cache for HTTP GET responses.
+
+    Bodies are stored once under their SHA-256 hash in `blobs/`; `index.json` maps each
+    cache key to its blob, validators (ETag, Last-Modified) and timestamps. Within `ttl`
+    seconds a cached response is served without touching the network; after that it is
+    revalidated with a conditional request. The least recently used entries are evicted
+    once the blobs exceed `max_bytes`.
+
+    Parameters:
+    - directory (str): Folder holding the cache.
+    - ttl (float): Seconds a response is served without revalidation.
+    - max_bytes (int): Size bound for the stored bodies.
+    - offline (bool): Never touch the network and serve whatever is cached. Defaults to
+      the HTTP_CACHE_OFFLINE environment variable.
+    """
+
+    def __init__(
+        self,
+        directory=DEFAULT_CACHE_DIR,
+        ttl=24 * 60 * 60,
+        max_bytes=512 * 1024 * 1024,
+        offline=None,
+    ):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        if offline is None:
+            offline = os.getenv("HTTP_CACHE_OFFLINE", "") not in ("", "0")
+        self.offline = offline
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        self._index_path = os.path.join(directory, "index.json")
+        self._index = self._load_index()
+
+    def fetch(self, url, key=None):
+        """
+        Return the body for `url`, from the cache when possible.
+
+        Parameters:
+        - url (str): Url to download.
+        - key (str): Cache key, defaults to the url. Use it to keep secrets such as API
+          keys out of the index.
+
+        Returns:
+        - bytes: Response body.
+        """
+        key = key or url
+        with self._lock:
+            entry = self._index.get(key)
+        if entry is not None and not os.path.exists(self._blob_path(entry["sha256"])):
+            # Blob removed behind our back: treat as never downloaded
+            entry = None
+        now = time.time()
+
+        if entry is not None and (self.offline or now - entry["fetched_at"] < self.ttl):
+            return self._read_entry(key, entry)
+        if self.offline:
+            raise OfflineCacheMiss(f"{key} is not cached and offline mode is on")
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            with urlopen(Request(url, headers=headers)) as response:
+                body = response.read()
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except HTTPError as exc:
+            if exc.code != 304 or entry is None:
+                raise
+            # Not modified: keep the stored body and restart its TTL
+            with self._lock:
+                entry["fetched_at"] = now
+                self._save_index()
+            return self._read_entry(key, entry)
+
+        self._store(key, body, etag, last_modified, now)
+        return body
+
+    def read_csv(self, url, **kwargs):
+        """pd.read_csv for a remote csv, going through the cache."""
+        return pd.read_csv(io.BytesIO(self.fetch(url)), **kwargs)
+
+    def stats(self):
+        """Number of entries and total size of the stored bodies."""
+        with self._lock:
+            blobs = {entry["sha256"]: entry["size"] for entry in self._index.values()}
+            return {"entries": len(self._index), "bytes": sum(blobs.values())}
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, "blobs", digest)
+
+    def _read_entry(self, key, entry):
+        with open(self._blob_path(entry["sha256"]), "rb") as f:
+            body = f.read()
+        with self._lock:
+            entry["last_access"] = time.time()
+            self._save_index()
+        return body
+
+    def _store(self, key, body, etag, last_modified, now):
+        digest = hashlib.sha256(body).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+
+        with self._lock:
+            self._index[key] = {
+                "sha256": digest,
+                "size": len(body),
+                "etag": etag,
+                "last_modified": last_modified,
+                "fetched_at": now,
+                "last_access": now,
+            }
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        # Called with the lock held. Blobs can be shared by several keys, so sizes are
+        # counted per blob and a blob is only deleted once no key refers to it.
+        blob_sizes = {entry["sha256"]: entry["size"] for entry in self._index.values()}
+        total = sum(blob_sizes.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            digest = self._index.pop(key)["sha256"]
+            if all(entry["sha256"] != digest for entry in self._index.values()):
+                total -= blob_sizes[digest]
+                try:
+                    os.remove(self._blob_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_index(self):
+        # Called with the lock held; write atomically so readers never see a partial file
+        tmp_path = f"{self._index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
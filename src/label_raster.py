@@ -0,0 +1,183 @@
+"""
+Choropleth fills as an image colored from a precomputed label image.
+
+Recoloring a PatchCollection makes Agg fill every polygon path again on the next draw.
+LabelImage rasterizes an inset's polygons once, at the output resolution, into an image
+of polygon part ids (with the outlines as one more id), and replaces the collection with
+an image of the same extent. A frame's fill colors then become a palette lookup,
+colors[labels], whose cost depends on the number of pixels, not on the number or
+detail of the polygons, so the same path serves thousands of counties.
+
+The raster is not anti-aliased: edges of fills and outlines are hard at pixel level.
+
+Benchmark from src/:  python label_raster.py
+"""
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PathCollection
+from matplotlib.figure import Figure
+from matplotlib.image import AxesImage
+from matplotlib.transforms import IdentityTransform
+
+
+def encode_ids(ids):
+    """RGB colors, as floats, encoding integer ids below 2**24 exactly in 8 bit channels."""
+    ids = np.asarray(ids, dtype="int64")
+    return np.stack([ids >> 16, (ids >> 8) & 255, ids & 255], axis=1) / 255
+
+
+def rasterize_labels(paths, xlim, ylim, size, dpi, edgecolor_id=None, linewidth=0):
+    """
+    Label image of `paths`, non anti-aliased: 0 is background, k + 1 is paths[k].
+
+    Parameters:
+    - paths (list): Polygon paths in data coordinates.
+    - xlim, ylim (tuple): Data limits spanned by the image.
+    - size (tuple): Image (width, height) in pixels.
+    - dpi (float): Resolution the line widths are scaled with.
+    - edgecolor_id (int): Label of the outlines, drawn over the fills; None for none.
+    - linewidth (float): Outline width in points.
+
+    Returns:
+    - np.ndarray: (height, width) int32 labels, the first row at the top (ylim[1]).
+    """
+    width, height = size
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi, facecolor="black")
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    ax.add_collection(
+        PathCollection(
+            paths,
+            facecolors=encode_ids(np.arange(1, len(paths) + 1)),
+            edgecolors="none",
+            antialiaseds=False,
+            transform=ax.transData,
+        )
+    )
+    if edgecolor_id is not None and linewidth > 0:
+        ax.add_collection(
+            PathCollection(
+                paths,
+                facecolors="none",
+                edgecolors=encode_ids([edgecolor_id]),
+                linewidths=linewidth,
+                antialiaseds=False,
+                transform=ax.transData,
+            )
+        )
+    canvas.draw()
+    rgb = np.asarray(canvas.buffer_rgba())[..., :3].astype("int32")
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+class LabelImage(AxesImage):
+    """
+    Image replacing a choropleth PatchCollection, recolored by palette lookup.
+
+    The collection's polygons are rasterized at the figure's dpi and current layout, so
+    create it after the layout is final (e.g. after subplots_adjust) and save at that
+    dpi. Like the collection, it takes one fill color per polygon part.
+
+    Parameters:
+    - collection: PatchCollection of the polygons, e.g. from GeoDataFrame.plot. It is
+      removed from its axes.
+    - dpi (float): Output resolution, defaults to the figure's.
+    """
+
+    def __init__(self, collection, dpi=None):
+        ax = collection.axes
+        ax.apply_aspect()
+        scale = (dpi or ax.figure.dpi) / ax.figure.dpi
+        bbox = ax.get_window_extent()
+        size = (round(bbox.width * scale), round(bbox.height * scale))
+        xlim, ylim = ax.get_xlim(), ax.get_ylim()
+
+        paths = collection.get_paths()
+        edge_id = len(paths) + 1
+        labels = rasterize_labels(
+            paths,
+            xlim,
+            ylim,
+            size,
+            dpi or ax.figure.dpi,
+            edgecolor_id=edge_id,
+            linewidth=collection.get_linewidth()[0],
+        )
+        self.labels = labels.astype("uint16" if edge_id < 2**16 else "int32")
+
+        # Background, one row per polygon part, outlines
+        self._palette = np.zeros((edge_id + 1, 4), dtype="uint8")
+        edgecolor = collection.get_edgecolor()
+        if len(edgecolor):
+            self._palette[edge_id] = np.round(edgecolor[0] * 255)
+        self._rgba = np.empty(self.labels.shape + (4,), dtype="uint8")
+        self._pixels = self._rgba.view("uint32")[..., 0]
+
+        super().__init__(
+            ax,
+            interpolation="nearest",
+            origin="upper",
+            extent=(*xlim, *ylim),
+            zorder=collection.get_zorder(),
+        )
+        self.set_data(self._rgba)
+        self.set_facecolor(collection.get_facecolor())
+        collection.remove()
+        ax.add_image(self)
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
+
+    def set_facecolor(self, rgba):
+        """Fill the polygon parts with (n, 4) RGBA colors, like PatchCollection."""
+        self._palette[1:-1] = np.round(np.asarray(rgba) * 255)
+        # One 32 bit word per RGBA color: a single gather per pixel
+        np.take(self._palette.view("uint32")[:, 0], self.labels, out=self._pixels)
+        self.stale = True
+
+    def make_image(self, renderer, magnification=1.0, unsampled=False):
+        # At the resolution it was rasterized at, the image is drawn as is, without
+        # matplotlib's resampling and its copies of the data
+        x0, y0, x1, y1 = self.get_window_extent(renderer).extents
+        if magnification == 1 and (round(x1 - x0), round(y1 - y0)) == self.labels.shape[::-1]:
+            return self._rgba, x0, y0, IdentityTransform()
+        self.set_data(self._rgba)
+        return super().make_image(renderer, magnification, unsampled)
+
+
+if __name__ == "__main__":
+    import time
+
+    import matplotlib.pyplot as plt
+
+    from map_geometry import load_state_geometry, select_level_of_detail
+
+    gdf = load_state_geometry()
+    contiguous = gdf[gdf["region"] == "contiguous"]
+    xlim, ylim = (-130, -65), (24, 55)
+    rng = np.random.default_rng(0)
+
+    for name, raster in [("polygons", False), ("label image", True)]:
+        fig, ax = plt.subplots(figsize=(10, 6), dpi=300)
+        data = select_level_of_detail(contiguous, ax, xlim, ylim)
+        data.plot(ax=ax, color="grey", edgecolor="white", linewidth=0.5)
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
+        fill = ax.collections[-1]
+        n_parts = len(fill.get_paths())
+        if raster:
+            fill = LabelImage(fill)
+        fig.canvas.draw()
+
+        colors = rng.random((20, n_parts, 4))
+        colors[..., 3] = 1
+        start = time.perf_counter()
+        for frame_colors in colors:
+            fill.set_facecolor(frame_colors)
+            fig.canvas.draw()
+        elapsed = (time.perf_counter() - start) / len(colors)
+        print(f"{name:12s}: {n_parts} polygon parts, {elapsed * 1000:.0f} ms/frame")
+        plt.close(fig)
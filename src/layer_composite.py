@@ -0,0 +1,165 @@
+"""
+Render animation frames by compositing the changing artists onto cached static layers.
+
+In the map animations only the state fills and the number labels change between frames;
+the state outlines, the legend, title, captions and arrows are the same in every frame,
+yet a full figure draw rasterizes them all again. LayeredFigure rasterizes the static
+artists once, at the output resolution:
+
+- the static layer, the whole figure without the dynamic artists, which every frame
+  starts from;
+- the overlay, the static artists drawn after the dynamic ones (e.g. outlines, arrows
+  pointing into a state) on a transparent canvas, which is alpha-composited over the
+  pixels the dynamic artists painted, so that those static artists stay on top.
+
+A frame then costs drawing the dynamic artists onto a copy of the static layer, an
+alpha blend of the overlay where they painted over it and drawing the dynamic artists
+that go on top of everything, such as labels. Every other pixel is the static layer's,
+identical to a full draw. Where a dynamic artist and an overlay pixel meet, blending
+the overlay is not the same arithmetic as drawing the static artist there, so
+anti-aliased edges may differ by a shade: the output is close to, but not
+byte-identical with, a full draw of every frame. benchmarks.py layer_composite checks
+both.
+"""
+
+from operator import methodcaller
+
+import numpy as np
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PathCollection
+
+
+def split_outlines(collection):
+    """
+    Move the edges of a collection to a copy drawn above it, leaving it with the fills.
+
+    A choropleth's outlines never change, only its fills do; split off, the outlines
+    become part of the static layers and frames only fill the polygons.
+
+    Parameters:
+    - collection: PatchCollection of polygons, e.g. from GeoDataFrame.plot.
+
+    Returns:
+    - PathCollection: The outlines, already added to the collection's axes.
+    """
+    outline = PathCollection(
+        collection.get_paths(),
+        facecolors="none",
+        edgecolors=collection.get_edgecolor(),
+        linewidths=collection.get_linewidth(),
+        linestyles=collection.get_linestyle(),
+        transform=collection.get_transform(),
+        zorder=collection.get_zorder(),
+    )
+    collection.axes.add_collection(outline, autolim=False)
+    collection.set_edgecolor("none")
+    return outline
+
+
+def draw_order(fig):
+    """The artists of `fig` and of its axes, in the order a draw paints them."""
+    by_zorder = methodcaller("get_zorder")
+    order = []
+    for artist in sorted(fig.get_children(), key=by_zorder):
+        if artist is fig.patch:
+            continue
+        order.append(artist)
+        if isinstance(artist, Axes):
+            order.extend(
+                sorted((a for a in artist.get_children() if a is not artist.patch), key=by_zorder)
+            )
+    return order
+
+
+class LayeredFigure:
+    """
+    Frame renderer drawing only `dynamic` artists of `fig` per frame.
+
+    The figure's dpi is set to `dpi`, so use it on a figure that is only rendered
+    through it, e.g. the copy in a frame_render worker process.
+
+    Parameters:
+    - fig: The animation's figure, with every artist already created.
+    - dynamic (list): The artists the update function changes that are drawn below the
+      static ones, e.g. fills, in drawing order. Every other artist must look the same
+      in all frames.
+    - on_top (list): The artists the update function changes that are drawn above
+      everything else, e.g. labels, in drawing order.
+    - dpi (float): Output resolution, defaults to the figure's.
+    - facecolor: Figure background of the frames, defaults to the figure's, e.g. the
+      facecolor of frame_render.savefig_kwargs_for.
+    """
+
+    def __init__(self, fig, dynamic, on_top=(), dpi=None, facecolor=None):
+        self.fig = fig
+        self.dynamic = list(dynamic)
+        self.on_top = list(on_top)
+        if dpi is not None:
+            fig.dpi = dpi
+        if facecolor is not None:
+            fig.patch.set_facecolor(facecolor)
+        # Drawing into the Agg renderer directly needs an Agg canvas, whatever the backend
+        if not isinstance(fig.canvas, FigureCanvasAgg):
+            FigureCanvasAgg(fig)
+        self._render_static_layers()
+
+    @property
+    def size(self):
+        """Frame (width, height) in pixels."""
+        return int(self._renderer.width), int(self._renderer.height)
+
+    def _render_static_layers(self):
+        changing = self.dynamic + self.on_top
+        hidden = {id(artist) for artist in changing}
+        order = draw_order(self.fig)
+        first = min((i for i, artist in enumerate(order) if id(artist) in hidden), default=0)
+        # The overlay leaves out the backgrounds and the static artists below the dynamic
+        # ones, whose pixels the dynamic artists cover
+        below = [self.fig.patch] + [ax.patch for ax in self.fig.axes]
+        below += [artist for artist in order[:first] if not isinstance(artist, Axes)]
+        visible = {id(artist): artist.get_visible() for artist in changing + below}
+        for artist in changing:
+            artist.set_visible(False)
+
+        canvas = self.fig.canvas
+        canvas.draw()
+        self._renderer = canvas.get_renderer()
+        self._static = self._renderer.copy_from_bbox(self.fig.bbox)
+        static = np.array(self._renderer.buffer_rgba()).reshape(-1, 4)
+
+        for artist in below:
+            artist.set_visible(False)
+        canvas.draw()
+        overlay = np.asarray(self._renderer.buffer_rgba()).reshape(-1, 4)
+        # Only the overlay's painted pixels are blended per frame, and only those a
+        # dynamic artist painted over, i.e. that differ from the static layer
+        self._overlay_pixels = np.flatnonzero(overlay[:, 3])
+        self._static_pixels = static[self._overlay_pixels]
+        self._overlay_rgb = overlay[self._overlay_pixels, :3].astype("uint32")
+        self._overlay_alpha = overlay[self._overlay_pixels, 3:].astype("uint32")
+
+        for artist in changing + below:
+            artist.set_visible(visible[id(artist)])
+
+    def render(self):
+        """Composite the current state of the dynamic artists; returns the RGBA buffer."""
+        renderer = self._renderer
+        renderer.restore_region(self._static)
+        for artist in self.dynamic:
+            artist.draw(renderer)
+
+        # Blend the overlay in place, in the renderer's own buffer, where the dynamic
+        # artists painted over it; elsewhere the static layer is already exact
+        pixels = np.asarray(renderer.buffer_rgba()).reshape(-1, 4)
+        under = pixels[self._overlay_pixels]
+        painted = (under != self._static_pixels).any(axis=1)
+        index = self._overlay_pixels[painted]
+        alpha = self._overlay_alpha[painted]
+        pixels[index, :3] = (
+            self._overlay_rgb[painted] * alpha + under[painted, :3] * (255 - alpha) + 127
+        ) // 255
+
+        for artist in self.on_top:
+            artist.draw(renderer)
+        return bytes(renderer.buffer_rgba())
@@ -1,36 +1,47 @@
-import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.ticker import FormatStrFormatter
-from highlight_text import fig_text, ax_text
-from pyfonts import load_font
+from highlight_text import fig_text
 from matplotlib.animation import FuncAnimation
 
+from animation_writer import PaletteWriter, blend_palette
+from frame_render import save_animation
+from font_registry import get_font
+from line_race import LineRace
+from processed_store import load_processed
+
 # parameters
 background_color = '#282a36'
 text_color = 'white'
 line_color_1 = "#B6E880"
 line_color_2="#636EFA"
 dpi = 300
+# Processes rendering frames: None for all cores, 1 for FuncAnimation.save; without fork
+# (Windows) the frames are rendered in this process either way
+render_workers = None
+states = ["CA", "NY"]  # states to race, None for all of them
+top_k = None  # show only the k states with the highest rate in each frame, None for all
+title = "Homeownership Rate (%): California vs New York"
+# In-between frames drawn between consecutive years, at 5 years per second: 4 gives a
+# smooth 25 fps animation, 0 one frame per year
+tween_steps = 0
+fps = 5 * (tween_steps + 1)
 
 # Load the fonts
-font = load_font(
-    "https://github.com/google/fonts/blob/main/ofl/cabincondensed/CabinCondensed-SemiBold.ttf?raw=true"
-)
-other_font = load_font(
-    "https://github.com/google/fonts/blob/main/ofl/cabincondensed/CabinCondensed-Regular.ttf?raw=true"
-)
-other_bold_font = load_font(
-    "https://github.com/google/fonts/blob/main/ofl/cabincondensed/CabinCondensed-Medium.ttf?raw=true"
-)
+font = get_font("CabinCondensed-SemiBold")
+other_font = get_font("CabinCondensed-Regular")
+other_bold_font = get_font("CabinCondensed-Medium")
 
 # Load plot data
-plot_data = pd.read_csv("../data/processed/homeownership_state_processed_full_20241124.csv")
+plot_data = load_processed(
+    "../data/processed/homeownership_state_processed_full_20241124.csv",
+    columns=["year", "state", "home_ownership"],
+    filters=[("state", "in", states)] if states else None,
+)
 
-df=plot_data[plot_data["state"].isin(['NY','CA'])]
-df = df.pivot(index='year', columns='state', values='home_ownership').reset_index()
-df.columns.name = None
-df.rename(columns={'CA': 'home_ownership_ca', 'NY': 'home_ownership_ny'}, inplace=True)
-df.set_index('year', inplace=True)
+# (year x state) matrix, pivoted once
+df = plot_data.pivot(index='year', columns='state', values='home_ownership')
+if states:
+    df = df[states]
 
 # Setting up the plot
 fig, ax = plt.subplots(figsize=(10, 6), dpi=dpi)
@@ -39,97 +50,96 @@ ax.set_facecolor(background_color)
 ax.tick_params(axis='y', colors=text_color)
 ax.spines[['left']].set_color(text_color)
 
+# custom axes
+ax.yaxis.set_major_formatter(FormatStrFormatter('%.0f'))
+ax.spines[['top', 'right', 'bottom']].set_visible(False)
+ax.set_xlim(1980, 2023)
+ax.set_xticks([])
+
+# Title
+fig.text(
+    s=title,
+    x=0.13,
+    y=0.95,
+    color=text_color,
+    fontsize=20,
+    font=font,
+    ha="left",
+    va="top",
+    fontweight="bold"
+)
+
+# credit annotation
+fig.text(
+    s="Source: U.S. Census Bureau\nautonomousecon.substack.com",
+    x=0.98,
+    y=0.02,
+    color=text_color,
+    fontsize=12,
+    font=other_font,
+    ha="right",
+    va="baseline",
+)
+
+# The moving parts, created once and updated in place: per state a line, the point at
+# its end and its label next to that point
+race = LineRace(
+    ax,
+    df,
+    colors={"CA": line_color_1, "NY": line_color_2},
+    top_k=top_k,
+    y_min=50,
+)
+
+# date in the background
+year_label = fig_text(
+    0.15, 0.87,
+    '1984 - ',
+    ha='left', va='top',
+    fontsize=30,
+    font=font,
+    color=text_color,
+    fontweight='bold',
+    alpha=0.5,
+    fig=fig
+)
+animated_artists = race.artists + [year_label.annotation_bbox]
+
+
+def init():
+    return animated_artists
+
+
 # Update function for the animation
 def update(frame):
+    # first frame is empty
+    ylim = ax.get_ylim()
+    race.update(frame)
 
-    # skip first frame
-    if frame == 0:
-        return None
-
-    # initialize subset of data
-    subset_df = df.iloc[:frame]
-    ax.clear()
-
-    # create the line chart
-    ax.plot(subset_df.index, subset_df['home_ownership_ca'], color=line_color_1)
-    ax.scatter(subset_df.index[-1], subset_df['home_ownership_ca'].values[-1], color=line_color_1, s=100)
-    
-    # create the line chart
-    ax.plot(subset_df.index, subset_df['home_ownership_ny'], color=line_color_2)
-    ax.scatter(subset_df.index[-1], subset_df['home_ownership_ny'].values[-1], color=line_color_2, s=100)
-    
-    # custom axes
-    ax.yaxis.set_major_formatter(FormatStrFormatter('%.0f'))
-    y_max = max(subset_df['home_ownership_ca'].max(), subset_df['home_ownership_ny'].max())
-    y_min=50
-    ax.set_ylim(y_min, y_max*1.05)
-    ax.spines[['top', 'right', 'bottom']].set_visible(False)
-    ax.set_xlim(1980, 2023)
-    ax.set_xticks([])
-    
-    # create annotation
-    # create annotation next to the last point
-    ax.text(
-        x=subset_df.index[-1] + 0.5,  # Slightly offset the x position to avoid overlap
-        y=subset_df['home_ownership_ca'].values[-1],
-        s="CA",
-        fontsize=14,
-        verticalalignment='center',
-        horizontalalignment='left',
-        color=line_color_1
-    )
-    
-    # create annotation next to the last point
-    ax.text(
-        x=subset_df.index[-1] + 0.5,  # Slightly offset the x position to avoid overlap
-        y=subset_df['home_ownership_ny'].values[-1],
-        s="NY",
-        fontsize=14,
-        verticalalignment='center',
-        horizontalalignment='left',
-        color=line_color_2
-    )
+    year_label.text_areas[0].set_text('1984 - ' + str(round(df.index[int(frame)])))
+    year_label.annotation_bbox.set_visible(frame > 0)
 
-    # date in the background
-    year = df.index[frame]
-    fig_text(
-        0.15, 0.87,
-        '1984 - ' + str(round(year)),
-        ha='left', va='top',
-        fontsize=30,
-        font=font,
-        color=text_color,
-        fontweight='bold',
-        alpha=0.5,
-        fig=fig
-    )
-    
-    # Title
-    fig.text(
-        s="Homeownership Rate (%): California vs New York",
-        x=0.13,
-        y=0.95,
-        color=text_color,
-        fontsize=20,
-        font=font,
-        ha="left",
-        va="top",
-        fontweight="bold"
-    )
+    # The y axis is not blitted: redraw everything when it changes. Saving draws every
+    # frame in full anyway.
+    if ax.get_ylim() != ylim and not fig.canvas.is_saving():
+        fig.canvas.draw()
 
-    # credit annotation
-    fig.text(
-        s="Source: U.S. Census Bureau\nautonomousecon.substack.com",
-        x=0.98,
-        y=0.02,
-        color=text_color,
-        fontsize=12,
-        font=other_font,
-        ha="right",
-        va="baseline",
-    )
+    return animated_artists
+
+
+frames = race.frames(tween_steps)
 
-# create and save animation
-ani = FuncAnimation(fig, update, frames=len(df))
-ani.save('../reports/us_line_home_ownership.gif', fps=5)
+# The chart's colors and their anti-aliased blends, to quantize frames against
+palette = blend_palette([background_color, text_color] + race.colors)
+
+if render_workers == 1:
+    ani = FuncAnimation(fig, update, frames=frames, init_func=init, blit=True)
+    ani.save(
+        '../reports/us_line_home_ownership.gif', writer=PaletteWriter(fps=fps, palette=palette)
+    )
+else:
+    save_animation(
+        fig, update, frames, '../reports/us_line_home_ownership.gif', fps=fps,
+        workers=render_workers, palette=palette,
+    )
 plt.show()
@@ -0,0 +1,200 @@
+"""
+Line chart race: any number of series drawn up to the current frame, optionally only
+the top k by a rank metric, with end-of-line labels kept apart.
+
+The series are pivoted once into a contiguous (frame x series) array. Which series are
+shown in each frame and the running extremes used for the y limits are computed for all
+frames at once, and every frame only moves persistent artists, so hundreds of series
+animate at the speed of a redraw. Fractional frames draw the lines partway to the next
+point, for smooth animations at 24-30 fps.
+"""
+
+import numpy as np
+from matplotlib import colormaps
+
+
+def spread_labels(y, gap):
+    """
+    Move label positions apart so that neighbours are at least `gap` apart.
+
+    For sorted positions, pushing each label up to max(y, previous + gap) gives
+    gap * i + cumulative max of (y - gap * i); pushing down from the top is the mirror
+    image. Both keep consecutive labels `gap` apart, and so does their average, which
+    spreads each cluster of overlapping labels evenly around it and leaves labels
+    without neighbours in place.
+
+    Parameters:
+    - y (np.ndarray): Label positions.
+    - gap (float): Minimum distance, in the units of `y`.
+
+    Returns:
+    - np.ndarray: Adjusted positions, in the order of `y`.
+    """
+    order = np.argsort(y, kind="stable")
+    ascending = y[order]
+    steps = gap * np.arange(len(y))
+    up = steps + np.maximum.accumulate(ascending - steps)
+    down = -(steps + np.maximum.accumulate(-ascending[::-1] - steps))[::-1]
+    adjusted = np.empty(len(y))
+    adjusted[order] = (up + down) / 2
+    return adjusted
+
+
+def top_k_mask(scores, k):
+    """
+    (frame x series) mask of the `k` highest finite scores of each frame.
+
+    Parameters:
+    - scores (np.ndarray): (frame x series) rank metric, NaN where a series has no value.
+    - k (int): Series per frame, or None for every series with a value.
+    """
+    finite = np.isfinite(scores)
+    if k is None or k >= scores.shape[1]:
+        return finite
+    # -inf sorts NaN last; a stable sort keeps ties in column order
+    order = np.argsort(-np.where(finite, scores, -np.inf), axis=1, kind="stable")[:, :k]
+    mask = np.zeros(scores.shape, dtype=bool)
+    np.put_along_axis(mask, order, True, axis=1)
+    return mask & finite
+
+
+class LineRace:
+    """
+    Animated lines for the columns of a wide frame; frame n shows the first n rows.
+
+    A fractional frame n + f shows the first n rows and a point a fraction f of the way
+    to row n + 1, with the y limits blended between those of frames n and n + 1.
+
+    Parameters:
+    - ax: Matplotlib axis to draw on. Its x limits and styling are left to the caller.
+    - wide (pd.DataFrame): Values indexed by x (e.g. year), one column per series.
+    - colors (dict): Color per series; others get colors from `cmap`.
+    - top_k (int): Number of series shown per frame, or None for all of them.
+    - rank_by (np.ndarray): (frame x series) rank metric for top_k, defaults to the
+      values themselves. Row n ranks frame n + 1, whose last point is row n.
+    - y_min (float): Fixed lower y limit, defaults to 95% of the lowest value shown.
+    - label_gap (float): Minimum vertical distance of labels, as a fraction of the y
+      range.
+    - cmap (str): Colormap for series without a color.
+    - line_kw, point_kw, label_kw (dict): Extra properties of the lines, end points and
+      labels.
+    """
+
+    def __init__(
+        self,
+        ax,
+        wide,
+        colors=None,
+        top_k=None,
+        rank_by=None,
+        y_min=None,
+        label_gap=0.04,
+        cmap="tab20",
+        line_kw=None,
+        point_kw=None,
+        label_kw=None,
+    ):
+        self.ax = ax
+        self.names = [str(name) for name in wide.columns]
+        self.x = wide.index.to_numpy(dtype="float64")
+        self.values = np.ascontiguousarray(wide.to_numpy(dtype="float64"))
+        self.y_min = y_min
+        self.label_gap = label_gap
+
+        scores = self.values if rank_by is None else np.asarray(rank_by, dtype="float64")
+        self.visible = top_k_mask(scores, top_k) & np.isfinite(self.values)
+        # Running extremes of each series, for the y limits of any visible subset
+        self.prefix_max = np.fmax.accumulate(self.values, axis=0)
+        self.prefix_min = np.fmin.accumulate(self.values, axis=0)
+
+        colors = colors or {}
+        palette = colormaps[cmap]
+        self.colors = [
+            colors.get(name, palette(i % palette.N)) for i, name in enumerate(self.names)
+        ]
+
+        self.lines, self.points, self.labels = [], [], []
+        for name, color in zip(self.names, self.colors):
+            (line,) = ax.plot([], [], color=color, **(line_kw or {}))
+            (point,) = ax.plot([], [], "o", color=color, markersize=10, **(point_kw or {}))
+            label = ax.text(
+                0,
+                0,
+                name,
+                color=color,
+                verticalalignment="center",
+                horizontalalignment="left",
+                **{"fontsize": 14, **(label_kw or {})},
+            )
+            self.lines.append(line)
+            self.points.append(point)
+            self.labels.append(label)
+        self.artists = self.lines + self.points + self.labels
+
+    def frames(self, steps=0):
+        """
+        Frames of the whole race: 0 to len(wide) - 1, with `steps` evenly spaced
+        in-between frames after each, e.g. 4 for 5 frames per row.
+        """
+        return np.arange((len(self.x) - 1) * (steps + 1) + 1) / (steps + 1)
+
+    def y_limits(self, frame):
+        """(low, high) y limits of `frame`: 5% above and below the values shown so far."""
+        row = max(frame, 1) - 1
+        shown = self.visible[row]
+        if not shown.any():
+            return self.ax.get_ylim()
+        high = np.nanmax(self.prefix_max[row, shown]) * 1.05
+        low = self.y_min
+        if low is None:
+            low = np.nanmin(self.prefix_min[row, shown]) * 0.95
+        return low, high
+
+    def update(self, frame):
+        """Draw the first `frame` rows. Returns the artists that may have changed."""
+        whole = int(frame)
+        fraction = frame - whole if 0 < whole < len(self.x) else 0
+        row = whole - 1
+
+        if whole == 0:
+            shown = np.zeros(len(self.names), dtype=bool)
+        elif fraction:
+            # The end points, partway to the next row; a series missing on either side
+            # jumps at the midpoint
+            shown = self.visible[row + (fraction >= 0.5)]
+            end_x = self.x[row] + fraction * (self.x[row + 1] - self.x[row])
+            end_y = self.values[row] + fraction * (self.values[row + 1] - self.values[row])
+            end_y = np.where(np.isnan(end_y), self.values[row + (fraction >= 0.5)], end_y)
+            shown = shown & np.isfinite(end_y)
+        else:
+            shown = self.visible[row]
+            end_x, end_y = self.x[row], self.values[row]
+
+        ylim = self.y_limits(whole)
+        if fraction:
+            ylim = tuple(np.add(ylim, fraction * np.subtract(self.y_limits(whole + 1), ylim)))
+        if self.ax.get_ylim() != ylim:
+            self.ax.set_ylim(ylim)
+
+        label_y = np.full(len(self.names), np.nan)
+        if shown.any():
+            label_y[shown] = spread_labels(end_y[shown], self.label_gap * (ylim[1] - ylim[0]))
+
+        for i in range(len(self.names)):
+            self.lines[i].set_visible(shown[i])
+            self.points[i].set_visible(shown[i])
+            self.labels[i].set_visible(shown[i])
+            if not shown[i]:
+                continue
+            if fraction:
+                self.lines[i].set_data(
+                    np.append(self.x[:whole], end_x),
+                    np.append(self.values[:whole, i], end_y[i]),
+                )
+            else:
+                # Views into the preallocated arrays, no copies
+                self.lines[i].set_data(self.x[:whole], self.values[:whole, i])
+            self.points[i].set_data([end_x], [end_y[i]])
+            # Slightly offset the x position to avoid overlap
+            self.labels[i].set_position((end_x + 0.5, label_y[i]))
+        return self.artists
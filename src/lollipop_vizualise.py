@@ -1,10 +1,11 @@
 
 # The horizontal plot is made using the hline function
 import matplotlib.pyplot as plt
-import pandas as pd
+
+from processed_store import load_processed
 
 # load data
-data = pd.read_csv(
+data = load_processed(
     "../data/processed/housing_data_202411.csv",
 )
 
@@ -0,0 +1,183 @@
+"""
+Render the static choropleth of us_map_vizualise.py for many years in one run.
+
+Running us_map_vizualise.py once per year reloads the geometry, fonts and data every
+time. render_maps loads them once and draws the years in a pool of worker processes,
+forked so that they share what the parent loaded, and prints how long each image took.
+Without fork (Windows) it draws them one after the other in its own process.
+
+An image is only rendered again when something it depends on changed since it was last
+written: its slice of the data, the drawing code and style (us_map_vizualise.py and
+map_geometry.py), the fonts, the geometry, the title or the resolution. That is the
+image's render cache key, us_map_vizualise.map_render_key; the keys of the images
+written are kept next to them in `.map_batch_state.json`.
+
+From src/:
+
+    python map_batch.py                      # every year
+    python map_batch.py --years 2000 2023 --jobs 4
+    python map_batch.py --force
+"""
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+
+import us_map_vizualise
+from map_geometry import SHAPEFILE_PATH, load_state_geometry
+from pipeline import load_state, save_state
+from processed_store import load_processed
+
+DATA_PATH = "../data/processed/homeownership_state_processed_full_20241124.csv"
+OUTPUT_DIR = "../reports"
+
+# Figure title per metric
+TITLES = {"home_ownership": "Homeownership Rate by State: {year}"}
+
+# Set in the parent before the pool forks, read by the workers
+_geometry = None
+_plot_data = None
+
+
+def output_path(metric, year, output_dir=OUTPUT_DIR):
+    return os.path.join(output_dir, f"{metric}_map_{year}.png")
+
+
+def _render_job(job):
+    year, metric, path, title, dpi = job
+    start = time.perf_counter()
+    plot_data = _plot_data[_plot_data["year"] == year]
+    fig = us_map_vizualise.draw_map(_geometry, plot_data, title, column_to_plot=metric)
+    tmp_path = f"{path}.{os.getpid()}.tmp.png"
+    fig.savefig(tmp_path, dpi=dpi, bbox_inches="tight")
+    plt.close(fig)
+    os.replace(tmp_path, path)
+    return time.perf_counter() - start
+
+
+def _run_jobs(jobs, max_workers):
+    """Yield (path, seconds or the exception raised) of each job as it finishes."""
+    if "fork" not in multiprocessing.get_all_start_methods():
+        # The workers could not share the loaded data: render in this process
+        for path, (job, _) in jobs.items():
+            try:
+                yield path, _render_job(job)
+            except Exception as e:
+                yield path, e
+        return
+
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        futures = {executor.submit(_render_job, job): path for path, (job, _) in jobs.items()}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
+
+def render_maps(
+    years=None,
+    metrics=("home_ownership",),
+    data_path=DATA_PATH,
+    shapefile_path=SHAPEFILE_PATH,
+    output_dir=OUTPUT_DIR,
+    dpi=300,
+    force=False,
+    max_workers=None,
+):
+    """
+    Render the maps of several years and metrics, skipping those that are up to date.
+
+    Parameters:
+    - years (list): Years to render, defaults to every year in the data.
+    - metrics (list): Columns of the data to map, each with a title in TITLES.
+    - data_path (str): Processed csv with 'year', 'state' and the metric columns.
+    - shapefile_path (str): State shapefile, see map_geometry.load_state_geometry.
+    - output_dir (str): Folder the images and the fingerprint file are written to.
+    - dpi (int): Image resolution.
+    - force (bool): Render images even if they are up to date.
+    - max_workers (int): Number of worker processes, defaults to the CPU count. Ignored
+      on platforms without fork, where the maps are rendered in this process.
+
+    Returns:
+    - dict: Image path mapped to 'rendered', 'skipped' or 'failed'.
+    """
+    global _geometry, _plot_data
+
+    unknown = set(metrics) - set(TITLES)
+    if unknown:
+        raise ValueError(f"No title for metrics: {', '.join(sorted(unknown))}")
+
+    start = time.perf_counter()
+    _plot_data = load_processed(data_path, columns=["year", "state", *metrics])
+    _geometry = load_state_geometry(shapefile_path)
+    # Resolve and verify the font files once, before the workers fork
+    us_map_vizualise.font.get_file()
+    us_map_vizualise.other_font.get_file()
+    print(f"Loaded data, geometry and fonts in {time.perf_counter() - start:.2f}s")
+
+    if years is None:
+        years = sorted(_plot_data["year"].unique())
+    os.makedirs(output_dir, exist_ok=True)
+    state_path = os.path.join(output_dir, ".map_batch_state.json")
+    state = load_state(state_path)
+
+    status = {}
+    jobs = {}
+    for metric in metrics:
+        for year in years:
+            path = output_path(metric, year, output_dir)
+            title = TITLES[metric].format(year=year)
+            rows = _plot_data[_plot_data["year"] == year]
+            digest = us_map_vizualise.map_render_key(rows, title, shapefile_path, metric, dpi)
+            if not force and state.get(path) == digest and os.path.exists(path):
+                status[path] = "skipped"
+                print(f"[{os.path.basename(path)}] up to date")
+                continue
+            jobs[path] = ((year, metric, path, title, dpi), digest)
+
+    for path, elapsed in _run_jobs(jobs, max_workers):
+        if isinstance(elapsed, Exception):
+            status[path] = "failed"
+            print(f"[{os.path.basename(path)}] failed: {elapsed!r}")
+            continue
+        status[path] = "rendered"
+        state[path] = jobs[path][1]
+        save_state(state, state_path)
+        print(f"[{os.path.basename(path)}] rendered in {elapsed:.2f}s")
+
+    outcomes = list(status.values())
+    counts = {outcome: outcomes.count(outcome) for outcome in ("rendered", "skipped", "failed")}
+    print(
+        f"{counts['rendered']} rendered, {counts['skipped']} up to date, "
+        f"{counts['failed']} failed in {time.perf_counter() - start:.1f}s"
+    )
+    return status
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render the state map of many years.")
+    parser.add_argument("--years", type=int, nargs="*", help="defaults to every year")
+    parser.add_argument("--metrics", nargs="*", default=["home_ownership"])
+    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--force", action="store_true", help="render even if up to date")
+    parser.add_argument("--jobs", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    render_maps(
+        years=args.years or None,
+        metrics=args.metrics,
+        dpi=args.dpi,
+        force=args.force,
+        max_workers=args.jobs,
+    )
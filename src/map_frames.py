@@ -0,0 +1,168 @@
+"""
+Values, bins and colors of every frame of a choropleth animation, computed up front.
+
+Per frame, the map animations used to filter the long data by year, merge it onto the
+geometry, bin it with pd.cut and map the bins to colors. FrameTable does all of that
+once, for all frames, as (frame x state) arrays in the row order of the geometry, so a
+frame is a row slice. tween_frame_table adds in-between frames, blending the values and
+colors of consecutive frames, for smooth animations at 24-30 fps.
+
+Benchmark from src/:  python map_frames.py
+"""
+
+import numpy as np
+import pandas as pd
+from matplotlib.colors import to_rgba_array
+
+
+class FrameTable:
+    """
+    Per-frame state values, bin codes and fill colors.
+
+    Attributes:
+    - frames (np.ndarray): Frame keys (years, dates, ...), in order.
+    - states (np.ndarray): State codes, in the row order of the geometry.
+    - values (np.ndarray): (frame, state) values, NaN where a state has no data.
+    - codes (np.ndarray): (frame, state) int8 bin codes, -1 for missing or out of bins.
+    - rgba (np.ndarray): (frame, state, 4) fill colors.
+    - keys (np.ndarray): Observation each frame is drawn from, for titles and labels:
+      the frames themselves, or for in-between frames the observation before them.
+    """
+
+    def __init__(self, frames, states, values, codes, rgba, keys=None):
+        self.frames = frames
+        self.states = states
+        self.values = values
+        self.codes = codes
+        self.rgba = rgba
+        self.keys = frames if keys is None else keys
+        self._positions = {frame: i for i, frame in enumerate(frames)}
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __repr__(self):
+        return f"FrameTable({len(self.frames)} frames x {len(self.states)} states)"
+
+    def position(self, frame):
+        """Row of `frame` in the arrays."""
+        return self._positions[frame]
+
+
+def build_frame_table(wide, states, bins, colors, missing_color="none"):
+    """
+    Bin and color every frame in one vectorized pass.
+
+    Parameters:
+    - wide (pd.DataFrame): Values indexed by frame with one column per state, e.g.
+      plot_data.pivot(index='year', columns='state', values='home_ownership') or the
+      date-indexed unemployment_state csv.
+    - states (list-like): State codes in the row order of the geometry. States missing
+      from `wide` get NaN values.
+    - bins (list): Bin edges, right-inclusive as in pd.cut.
+    - colors (list): One color per bin.
+    - missing_color: Color of missing values and values outside the bins.
+
+    Returns:
+    - FrameTable: See the class.
+    """
+    if len(colors) != len(bins) - 1:
+        raise ValueError(
+            f"Expected {len(bins) - 1} colors for {len(bins)} bin edges, got {len(colors)}"
+        )
+
+    values = wide.reindex(columns=pd.Index(states)).to_numpy(dtype="float64")
+    codes = pd.cut(values.ravel(), bins=bins, labels=False)
+    codes = np.where(np.isnan(codes), -1, codes).astype("int8").reshape(values.shape)
+
+    # Code -1 picks the last palette row, the missing color
+    palette = to_rgba_array(list(colors) + [missing_color])
+    return FrameTable(
+        frames=wide.index.to_numpy(),
+        states=np.asarray(states),
+        values=values,
+        codes=codes,
+        rgba=palette[codes],
+    )
+
+
+def tween_frame_table(table, steps):
+    """
+    `table` with `steps` in-between frames between each pair of consecutive frames.
+
+    Values and fill colors are interpolated linearly, for all states and frames in one
+    pass, so a state's color moves smoothly from one bin color to the next instead of
+    re-binning the interpolated value. Where a state has no value on either side it
+    keeps the nearer frame's value, code and color. The in-between frames' keys are
+    interpolated too (years become floats, dates stay dates).
+
+    Parameters:
+    - table (FrameTable): Observed frames, from build_frame_table.
+    - steps (int): In-between frames per interval, e.g. 23 for 24 frames per year.
+
+    Returns:
+    - FrameTable: (len(table) - 1) * (steps + 1) + 1 frames.
+    """
+    if steps <= 0 or len(table) < 2:
+        return table
+
+    # Position of every output frame on the observed frames' axis, split into the
+    # observation before it and the weight of the one after
+    position = np.arange((len(table) - 1) * (steps + 1) + 1) / (steps + 1)
+    before = np.minimum(position.astype("int64"), len(table) - 2)
+    weight = (position - before)[:, None]
+    after = before + 1
+    nearest = np.where(weight[:, 0] < 0.5, before, after)
+
+    values = table.values[before] * (1 - weight) + table.values[after] * weight
+    missing = np.isnan(table.values[before]) | np.isnan(table.values[after])
+    values = np.where(missing, table.values[nearest], values)
+    rgba = table.rgba[before] * (1 - weight[..., None]) + table.rgba[after] * weight[..., None]
+    rgba = np.where(missing[..., None], table.rgba[nearest], rgba)
+
+    return FrameTable(
+        frames=_interpolate_keys(table.frames, position),
+        states=table.states,
+        values=values,
+        codes=table.codes[nearest],
+        rgba=rgba,
+        keys=table.frames[np.floor(position).astype("int64")],
+    )
+
+
+def _interpolate_keys(frames, position):
+    if np.issubdtype(frames.dtype, np.datetime64):
+        ticks = np.interp(position, np.arange(len(frames)), frames.astype("int64"))
+        return np.round(ticks).astype("int64").astype(frames.dtype)
+    return np.interp(position, np.arange(len(frames)), frames.astype("float64"))
+
+
+if __name__ == "__main__":
+    import time
+
+    from processed_store import load_processed
+
+    bins = [35, 45, 55, 65, 75, float("inf")]
+    colors = ["#D6604DFF", "#F4A582FF", "#FDDBC7FF", "#92C5DEFF", "#4393C3FF"]
+
+    plot_data = load_processed(
+        "../data/processed/homeownership_state_processed_full_20241124.csv",
+        columns=["year", "state", "home_ownership"],
+    )
+    start = time.perf_counter()
+    wide = plot_data.pivot(index="year", columns="state", values="home_ownership")
+    table = build_frame_table(wide, sorted(plot_data["state"].unique()), bins, colors)
+    print(f"home ownership: {table} in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    tweened = tween_frame_table(table, 23)
+    print(f"  tweened:      {tweened} in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    wide = pd.read_csv("../data/raw/unemployment_state_20240901.csv", index_col=0, parse_dates=True)
+    table = build_frame_table(wide, list(wide.columns), [0, 3, 4, 5, 6, float("inf")], colors)
+    print(f"unemployment:   {table} in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    tweened = tween_frame_table(table, 23)
+    print(f"  tweened:      {tweened} in {(time.perf_counter() - start) * 1000:.1f} ms")
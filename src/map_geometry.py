@@ -0,0 +1,230 @@
+"""
+Preprocessed US state geometry, cached as GeoParquet.
+
+Parsing the TIGER shapefile and projecting it to compute centroids is the slow part of
+starting a map script, and its result only changes when the shapefile does. The cache is
+keyed by a hash of the shapefile's component files, so a new shapefile is picked up
+automatically.
+
+Build the cache once from src/:  python map_geometry.py
+"""
+
+import glob
+import hashlib
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+SHAPEFILE_PATH = "../data/raw/us_map_data/tl_2023_us_state.shp"
+DEFAULT_CACHE_DIR = "../data/cache/geometry"
+
+# Insets drawn on their own axes; every other state goes on the contiguous US map
+REGIONS = {"Alaska": "alaska", "Hawaii": "hawaii"}
+
+# Simplification tolerances, in degrees, of the precomputed levels of detail. At 300 dpi
+# a pixel covers about 0.02 degrees on the contiguous US map and 0.003 on Hawaii.
+LOD_TOLERANCES = [0.001, 0.004, 0.016, 0.064]
+
+
+def shapefile_hash(shapefile_path):
+    """
+    SHA-256 over the geometry, index, attribute and projection files of a shapefile, and
+    over the level of detail settings so that changing them invalidates the cache.
+    """
+    stem = os.path.splitext(shapefile_path)[0]
+    digest = hashlib.sha256(repr(LOD_TOLERANCES).encode())
+    for extension in [".shp", ".shx", ".dbf", ".prj"]:
+        path = stem + extension
+        if not os.path.exists(path):
+            continue
+        digest.update(extension.encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(shapefile_path, cache_dir=DEFAULT_CACHE_DIR):
+    name = os.path.splitext(os.path.basename(shapefile_path))[0]
+    return os.path.join(cache_dir, f"{name}_{shapefile_hash(shapefile_path)[:16]}.parquet")
+
+
+def prepare_state_geometry(shapefile_path):
+    """
+    Read the shapefile and add everything the map scripts derive from it.
+
+    Centroids are computed in EPSG:5070 (an equal-area projection, so they are true
+    geometric centers) and projected back to the shapefile's CRS. Simplified versions
+    of the polygons are added for every tolerance in LOD_TOLERANCES, see lod_column.
+
+    Parameters:
+    - shapefile_path (str): Path of the .shp file.
+
+    Returns:
+    - gpd.GeoDataFrame: The states with 'centroid', 'centroid_x', 'centroid_y' and
+      'region' ('contiguous', 'alaska' or 'hawaii') columns, plus one simplified
+      geometry column per level of detail.
+    """
+    gdf = gpd.read_file(shapefile_path)
+
+    data_projected = gdf.to_crs(epsg=5070)
+    gdf["centroid"] = data_projected.geometry.centroid.to_crs(gdf.crs)
+    gdf["centroid_x"] = gdf["centroid"].x
+    gdf["centroid_y"] = gdf["centroid"].y
+    gdf["region"] = gdf["NAME"].map(REGIONS).fillna("contiguous")
+    for tolerance in LOD_TOLERANCES:
+        gdf[lod_column(tolerance)] = gdf.geometry.simplify(tolerance, preserve_topology=True)
+    return gdf
+
+
+def lod_column(tolerance):
+    """Name of the geometry column simplified with `tolerance`, e.g. 'geometry_lod_0.004'."""
+    return f"geometry_lod_{tolerance:g}"
+
+
+def select_level_of_detail(data, ax, xlim, ylim, dpi=None):
+    """
+    Switch the active geometry to the coarsest level of detail that is still exact to
+    within half an output pixel for the given axes and limits.
+
+    Parameters:
+    - data (gpd.GeoDataFrame): State data with the level of detail columns.
+    - ax: Matplotlib axis the data will be drawn on.
+    - xlim: Tuple for x-axis limits.
+    - ylim: Tuple for y-axis limits.
+    - dpi (float): Output resolution, defaults to the figure's dpi.
+
+    Returns:
+    - gpd.GeoDataFrame: `data` with the chosen geometry column active.
+    """
+    bbox = ax.get_window_extent()
+    scale = (dpi or ax.figure.dpi) / ax.figure.dpi
+    width, height = bbox.width * scale, bbox.height * scale
+    pixel = min((xlim[1] - xlim[0]) / width, (ylim[1] - ylim[0]) / height)
+
+    column = "geometry"
+    for tolerance in LOD_TOLERANCES:
+        if tolerance <= pixel / 2 and lod_column(tolerance) in data.columns:
+            column = lod_column(tolerance)
+    if column == data.geometry.name:
+        return data
+    return data.set_geometry(column)
+
+
+def annotation_table(data, value_col, adjustments=None):
+    """
+    Label position, value and region of every state, indexed by state code.
+
+    Built with vectorized operations, so annotating n regions costs O(n) rather than a
+    boolean mask over the whole frame per region.
+
+    Parameters:
+    - data (gpd.GeoDataFrame): State data with 'STUSPS', 'centroid_x', 'centroid_y' and
+      'region' columns.
+    - value_col (str): Column holding the values to display.
+    - adjustments (dict): Optional (dx, dy) label offsets keyed by state code.
+
+    Returns:
+    - pd.DataFrame: Columns 'x', 'y', 'value' and 'region', indexed by 'STUSPS'.
+    """
+    table = pd.DataFrame(
+        {
+            "x": data["centroid_x"].to_numpy(),
+            "y": data["centroid_y"].to_numpy(),
+            "value": data[value_col].to_numpy(),
+            "region": data["region"].to_numpy(),
+        },
+        index=pd.Index(data["STUSPS"], name="STUSPS"),
+    )
+    # Keep the first row per state, as the label lookups always did
+    table = table[~table.index.duplicated()]
+
+    if adjustments:
+        offsets = pd.DataFrame.from_dict(adjustments, orient="index", columns=["dx", "dy"])
+        offsets = offsets.reindex(table.index, fill_value=0)
+        table["x"] += offsets["dx"].to_numpy()
+        table["y"] += offsets["dy"].to_numpy()
+    return table
+
+
+def polygon_part_index(data):
+    """
+    Row of `data` that each polygon part belongs to, in the order GeoDataFrame.plot draws
+    them: multipolygons are split into their parts and empty geometries are skipped.
+
+    Indexing per-row colors with it gives the face colors of the plotted collection.
+    """
+    return shapely.get_parts(data.geometry.values, return_index=True)[1]
+
+
+def vertex_count(data):
+    """Number of vertices in the active geometry of `data`."""
+    return int(shapely.get_num_coordinates(data.geometry.values).sum())
+
+
+def build_geometry_cache(shapefile_path=SHAPEFILE_PATH, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Write the prepared geometry to the cache, removing caches of older shapefile versions.
+
+    Returns:
+    - str: Path of the cache file.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(shapefile_path, cache_dir)
+    name = os.path.splitext(os.path.basename(shapefile_path))[0]
+    for stale in glob.glob(os.path.join(cache_dir, f"{name}_*.parquet")):
+        if stale != path:
+            os.remove(stale)
+
+    gdf = prepare_state_geometry(shapefile_path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    gdf.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_state_geometry(shapefile_path=SHAPEFILE_PATH, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Load the prepared state geometry, building the cache first if needed.
+
+    Parameters:
+    - shapefile_path (str): Path of the .shp file.
+    - cache_dir (str): Folder holding the GeoParquet cache.
+
+    Returns:
+    - gpd.GeoDataFrame: See prepare_state_geometry.
+    """
+    path = cache_path(shapefile_path, cache_dir)
+    if not os.path.exists(path):
+        path = build_geometry_cache(shapefile_path, cache_dir)
+    return gpd.read_parquet(path)
+
+
+def split_regions(data):
+    """Split state data into its (contiguous US, Alaska, Hawaii) parts."""
+    region = np.asarray(data["region"])
+    return (
+        data[region == "contiguous"],
+        data[region == "alaska"],
+        data[region == "hawaii"],
+    )
+
+
+if __name__ == "__main__":
+    import time
+
+    start = time.perf_counter()
+    path = build_geometry_cache()
+    print(f"Built {path} in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    gdf = load_state_geometry()
+    print(f"Loaded it in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    print(f"full resolution: {vertex_count(gdf):9d} vertices")
+    for tolerance in LOD_TOLERANCES:
+        simplified = gdf.set_geometry(lod_column(tolerance))
+        print(f"tolerance {tolerance:<6g}: {vertex_count(simplified):9d} vertices")
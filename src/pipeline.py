@@ -0,0 +1,216 @@
+import hashlib
+import inspect
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from http_cache import HttpCache
+
+DEFAULT_STATE_PATH = "../data/processed/.pipeline_state.json"
+
+
+class Stage:
+    """
+    A pipeline step that turns input files into output files.
+
+    Parameters:
+    - name (str): Stage name, used on the command line and in the state file.
+    - func (callable): Module-level function called as func(*inputs, *outputs).
+    - inputs (list): Local paths or http(s) urls the stage reads.
+    - outputs (list): Local paths the stage writes.
+    - code (list): Modules besides the one defining `func` whose code the outputs depend
+      on, e.g. the module of a helper writing them.
+    - artifacts (list): Local files or directories the stage writes besides `outputs`,
+      not passed to `func`, e.g. the Parquet twins of its csvs.
+    """
+
+    def __init__(self, name, func, inputs, outputs, code=(), artifacts=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.code = list(code)
+        self.artifacts = list(artifacts)
+
+    @property
+    def written(self):
+        """Every path the stage writes: its outputs and artifacts."""
+        return self.outputs + self.artifacts
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+
+def hash_input(path, cache=None):
+    """SHA-256 of a local file, or of a remote file as served by the HTTP cache."""
+    if path.startswith(("http://", "https://")):
+        cache = cache or HttpCache()
+        return hashlib.sha256(cache.fetch(path)).hexdigest()
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_output(path):
+    """SHA-256 of a file, or of the names and contents of the files in a directory."""
+    if not os.path.isdir(path):
+        return hash_input(path)
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode())
+            digest.update(hash_input(file_path).encode())
+    return digest.hexdigest()
+
+
+def is_up_to_date(stage, stage_fingerprint, recorded):
+    """
+    Whether a stage's last run, as recorded in the state file, is still valid: same
+    fingerprint, and every output and artifact still as it was written.
+    """
+    if not isinstance(recorded, dict) or recorded.get("fingerprint") != stage_fingerprint:
+        return False
+    written = recorded.get("written", {})
+    return all(
+        os.path.exists(path) and written.get(path) == hash_output(path) for path in stage.written
+    )
+
+
+def fingerprint(stage, cache=None):
+    """
+    Fingerprint of everything a stage's outputs depend on: its code and its inputs.
+
+    The code is the source of the whole module defining the stage function, so that
+    changes to its helpers and constants count, and of the stage's other `code` modules.
+
+    Parameters:
+    - stage (Stage): Stage to fingerprint.
+    - cache (HttpCache): Cache used for remote inputs.
+
+    Returns:
+    - str: Hex digest.
+    """
+    digest = hashlib.sha256(stage.name.encode())
+    for module in [inspect.getmodule(stage.func), *stage.code]:
+        digest.update(inspect.getsource(module).encode())
+    for path in stage.inputs:
+        digest.update(path.encode())
+        digest.update(hash_input(path, cache).encode())
+    return digest.hexdigest()
+
+
+def stage_dependencies(stages):
+    """Map each stage name to the names of the stages producing its inputs."""
+    producers = {output: stage.name for stage in stages for output in stage.written}
+    return {
+        stage.name: {producers[path] for path in stage.inputs if path in producers}
+        for stage in stages
+    }
+
+
+def load_state(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_state(state, state_path):
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def run_pipeline(stages, only=None, force=False, max_workers=None, state_path=DEFAULT_STATE_PATH):
+    """
+    Run the stages whose inputs or code changed since their last successful run.
+
+    A stage is started once the stages producing its inputs have finished; stages that
+    do not depend on each other run in parallel worker processes.
+
+    Parameters:
+    - stages (list): Stage objects.
+    - only (list): Optional names of the stages to consider.
+    - force (bool): Run stages even if they are up to date.
+    - max_workers (int): Number of worker processes, defaults to the CPU count.
+    - state_path (str): JSON file recording, for each stage's last run, its fingerprint
+      and the hashes of what it wrote.
+
+    Returns:
+    - dict: Stage name mapped to 'ran', 'skipped', 'failed' or 'blocked'.
+    """
+    if only is not None:
+        unknown = set(only) - {stage.name for stage in stages}
+        if unknown:
+            raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+        stages = [stage for stage in stages if stage.name in only]
+
+    state = load_state(state_path)
+    dependencies = stage_dependencies(stages)
+    pending = {stage.name: stage for stage in stages}
+    stages_by_name = dict(pending)
+    status = {}
+    cache = HttpCache()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while pending or running:
+            settled = len(status)
+            for name, stage in list(pending.items()):
+                if dependencies[name] & {n for n, s in status.items() if s in ("failed", "blocked")}:
+                    del pending[name]
+                    status[name] = "blocked"
+                    print(f"[{name}] blocked by a failed upstream stage")
+                elif all(dep in status for dep in dependencies[name]):
+                    del pending[name]
+                    # Fingerprint only now, after upstream stages have written our inputs
+                    try:
+                        stage_fingerprint = fingerprint(stage, cache)
+                    except Exception as e:
+                        status[name] = "failed"
+                        print(f"[{name}] failed reading inputs: {e!r}")
+                        continue
+                    up_to_date = is_up_to_date(stage, stage_fingerprint, state.get(name))
+                    if up_to_date and not force:
+                        status[name] = "skipped"
+                        print(f"[{name}] up to date")
+                        continue
+                    print(f"[{name}] running")
+                    future = executor.submit(stage.func, *stage.inputs, *stage.outputs)
+                    running[future] = (name, stage_fingerprint, time.perf_counter())
+
+            if not running:
+                if len(status) == settled:
+                    raise ValueError(f"Circular stage dependencies: {', '.join(pending)}")
+                # Every started stage was skipped or blocked; re-check dependents
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, stage_fingerprint, start = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    status[name] = "failed"
+                    print(f"[{name}] failed: {e!r}")
+                    continue
+                stage = stages_by_name[name]
+                try:
+                    written = {path: hash_output(path) for path in stage.written}
+                except FileNotFoundError as e:
+                    status[name] = "failed"
+                    print(f"[{name}] did not write {e.filename}")
+                    continue
+                status[name] = "ran"
+                state[name] = {"fingerprint": stage_fingerprint, "written": written}
+                save_state(state, state_path)
+                print(f"[{name}] done in {time.perf_counter() - start:.1f}s")
+
+    return status
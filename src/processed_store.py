@@ -0,0 +1,88 @@
+import operator
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+FILTER_OPERATORS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda column, values: column.isin(values),
+    "not in": lambda column, values: ~column.isin(values),
+}
+
+
+def dataset_path(csv_path):
+    """Parquet dataset directory stored next to a processed csv, e.g. foo.csv -> foo.parquet."""
+    return os.path.splitext(csv_path)[0] + ".parquet"
+
+
+def save_processed(df, csv_path, partition_cols=None):
+    """
+    Write a processed DataFrame as csv and as a typed, partitioned Parquet dataset.
+
+    Parameters:
+    - df (pd.DataFrame): Data to write.
+    - csv_path (str): Path of the csv; the dataset goes to dataset_path(csv_path).
+    - partition_cols (list): Optional columns to partition the dataset by, e.g. ['year'].
+    """
+    df.to_csv(csv_path, index=False)
+
+    path = dataset_path(csv_path)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    pq.write_to_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        root_path=path,
+        partition_cols=partition_cols,
+    )
+
+
+def load_processed(csv_path, columns=None, filters=None, parse_dates=None):
+    """
+    Load a processed dataset, reading only the requested columns and rows.
+
+    Reads the Parquet twin of `csv_path` when it exists, so that partitions not matching
+    `filters` are skipped and the remaining filters are pushed down to the row groups.
+    Falls back to the csv, filtered in pandas, for trees where the pipeline has not
+    written Parquet yet.
+
+    Parameters:
+    - csv_path (str): Path of the processed csv.
+    - columns (list): Columns to return, or None for all.
+    - filters (list): (column, operator, value) tuples that must all hold, e.g.
+      [('year', 'in', [1984, 2023])]. Operators: = == != < <= > >= in, not in.
+    - parse_dates (list): Date columns to parse when falling back to the csv.
+
+    Returns:
+    - pd.DataFrame: The selected data.
+    """
+    path = dataset_path(csv_path)
+    if os.path.isdir(path):
+        dataset = ds.dataset(path, format="parquet", partitioning="hive")
+        expression = pq.filters_to_expression(filters) if filters else None
+        df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+        if columns is None:
+            # Partition keys come back last; restore the column order that was written
+            written = [column["name"] for column in dataset.schema.pandas_metadata["columns"]]
+            df = df[[column for column in written if column in df.columns]]
+        # Partition keys are inferred as int32 from the directory names
+        for field in dataset.partitioning.schema:
+            if pa.types.is_integer(field.type) and field.name in df.columns:
+                df[field.name] = df[field.name].astype("int64")
+        return df
+
+    df = pd.read_csv(csv_path, parse_dates=parse_dates)
+    for column, op, value in filters or []:
+        df = df[FILTER_OPERATORS[op](df[column], value)]
+    if columns is not None:
+        df = df[columns]
+    return df.reset_index(drop=True)
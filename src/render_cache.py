@@ -0,0 +1,364 @@
+"""
+Content-addressed cache of rendered images.
+
+A figure is a function of its slice of the data, its style (colors, bins, fonts, label
+offsets, dpi, ...) and the code drawing it. render_key hashes all three, so the image
+stored under a key is the one a render would produce, and a script can save it without
+drawing anything when none of them changed. Any change to one of them gives a new key;
+the images of old keys are evicted, least recently used first, once the cache exceeds
+its size bound.
+
+The visualization scripts build their keys with their own render_key, e.g.
+us_map_vizualise.map_render_key, and save through RenderCache.savefig. Show the cache's
+hit/miss statistics or empty it from src/:
+
+    python render_cache.py stats
+    python render_cache.py clear
+"""
+
+import hashlib
+import inspect
+import io
+import json
+import os
+import threading
+import time
+import types
+
+import matplotlib
+import pandas as pd
+from matplotlib.font_manager import FontProperties
+
+from font_registry import LazyFont, default_registry, file_sha256
+
+DEFAULT_CACHE_DIR = "../data/cache/renders"
+
+
+def _update(digest, value):
+    """Feed `value` to `digest`, tagged with its type so that e.g. 1 and '1' differ."""
+    if isinstance(value, pd.DataFrame):
+        digest.update(b"frame")
+        digest.update(repr([(str(c), str(t)) for c, t in value.dtypes.items()]).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+    elif isinstance(value, pd.Series):
+        _update(digest, value.to_frame())
+    elif isinstance(value, types.ModuleType):
+        # The code version: a module's source
+        digest.update(b"module")
+        digest.update(inspect.getsource(value).encode())
+    elif isinstance(value, LazyFont):
+        # A font is its file's checksum, recorded when it was added to the registry.
+        # Resolve it first, so that a font not cached yet is downloaded and recorded now
+        # rather than hashed by name, which no later run would compute again
+        path = value.get_file()
+        entry = default_registry().cached().get(value.name, {})
+        digest.update(f"font:{entry.get('sha256') or file_sha256(path)}".encode())
+    elif isinstance(value, FontProperties):
+        digest.update(f"font:{value.get_fontconfig_pattern()}:{value.get_file()}".encode())
+    elif isinstance(value, dict):
+        digest.update(f"dict{len(value)}".encode())
+        for key in sorted(value, key=repr):
+            _update(digest, key)
+            _update(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            _update(digest, item)
+    else:
+        digest.update(f"{type(value).__name__}:{value!r}".encode())
+
+
+def render_key(data, style, code, **savefig_kwargs):
+    """
+    Cache key of an image: SHA-256 of everything it is rendered from.
+
+    Parameters:
+    - data: The data drawn, e.g. a DataFrame of one year's rows, in a canonical order.
+    - style (dict): Style parameters, e.g. colors, bins, fonts and label positions.
+    - code (list): Modules drawing the figure; their source is the code version.
+    - savefig_kwargs: Arguments of Figure.savefig, e.g. dpi and format.
+
+    Returns:
+    - str: Hex digest.
+    """
+    digest = hashlib.sha256()
+    for value in (data, style, list(code), matplotlib.__version__, savefig_kwargs):
+        _update(digest, value)
+    return digest.hexdigest()
+
+
+class FileLock:
+    """
+    Lock shared by processes through a file created exclusively, on any platform.
+
+    A lock file older than `stale` seconds is taken to be left over by a process that
+    died holding it, and is removed.
+
+    Parameters:
+    - path (str): Lock file.
+    - timeout (float): Seconds to wait for the lock before raising TimeoutError.
+    - stale (float): Age in seconds after which a lock file is removed.
+    """
+
+    def __init__(self, path, timeout=10, stale=60):
+        self.path = path
+        self.timeout = timeout
+        self.stale = stale
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.stale:
+                        os.remove(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Could not lock {self.path}") from None
+                time.sleep(0.01)
+
+    def __exit__(self, *exc_info):
+        os.remove(self.path)
+
+
+class RenderCache:
+    """
+    On-disk cache of rendered images, by render_key, shared by processes.
+
+    Images are stored once under their SHA-256 hash in `blobs/`. Each key has its own
+    small file in `entries/` naming its image, so processes add and read entries without
+    rewriting a shared index, and the entry file's modification time, touched on every
+    hit, records when it was last used. The least recently used entries are evicted once
+    the images exceed `max_bytes`, counting every blob on disk.
+
+    Hit, miss and eviction counts are kept per instance and added to `stats.json`, under
+    a lock, by flush; savefig flushes, and so does stats before reporting the totals.
+
+    Parameters:
+    - directory (str): Folder holding the cache.
+    - max_bytes (int): Size bound for the stored images.
+    """
+
+    # Blobs without an entry are only removed after this many seconds, so that a blob
+    # written by another process just before its entry is not taken for a leftover
+    ORPHAN_GRACE = 60
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "entries"), exist_ok=True)
+        self._stats_path = os.path.join(directory, "stats.json")
+        # Counts not yet added to stats.json
+        self._counts = dict.fromkeys(("hits", "misses", "evictions"), 0)
+
+    def get(self, key):
+        """The image stored under `key`, or None; counted as a hit or a miss."""
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+            with open(self._blob_path(entry["sha256"]), "rb") as f:
+                image = f.read()
+            # Marks the entry as recently used, without rewriting anything
+            os.utime(entry_path)
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            image = None
+        with self._lock:
+            self._counts["hits" if image is not None else "misses"] += 1
+        return image
+
+    def put(self, key, image):
+        """Store `image` (bytes) under `key`, evicting old entries beyond the size bound."""
+        digest = hashlib.sha256(image).hexdigest()
+        path = self._blob_path(digest)
+        try:
+            # Already stored: refresh it, so that it is not swept as a leftover
+            os.utime(path)
+        except FileNotFoundError:
+            self._write(path, image)
+        entry = {"sha256": digest, "size": len(image), "created_at": time.time()}
+        self._write(self._entry_path(key), json.dumps(entry).encode())
+        self._evict()
+
+    def savefig(self, key, draw, path, **savefig_kwargs):
+        """
+        Save the image of `key` to `path`, calling `draw` for the figure only on a miss.
+
+        Parameters:
+        - key (str): From render_key, including these savefig_kwargs.
+        - draw (callable): Returns the figure to render; not called on a hit.
+        - path (str): Output file. Like Figure.savefig, the format's extension is added
+          when it has none.
+        - savefig_kwargs: Arguments of Figure.savefig, e.g. dpi and bbox_inches.
+
+        Returns:
+        - The drawn figure, or None when the image came from the cache.
+        """
+        image_format = savefig_kwargs.pop("format", None) or (
+            os.path.splitext(path)[1][1:] or matplotlib.rcParams["savefig.format"]
+        )
+        if not os.path.splitext(path)[1]:
+            path = f"{path}.{image_format}"
+
+        fig = None
+        image = self.get(key)
+        if image is None:
+            fig = draw()
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format=image_format, **savefig_kwargs)
+            image = buffer.getvalue()
+            self.put(key, image)
+        self.flush()
+
+        self._write(path, image)
+        return fig
+
+    def flush(self):
+        """Add this instance's hit, miss and eviction counts to `stats.json`."""
+        with self._lock:
+            counts = self._counts
+            self._counts = dict.fromkeys(counts, 0)
+        if not any(counts.values()):
+            return
+        with FileLock(self._stats_path + ".lock"):
+            totals = self._load_stats()
+            for name, count in counts.items():
+                totals[name] = totals.get(name, 0) + count
+            self._write(self._stats_path, json.dumps(totals).encode())
+
+    def stats(self):
+        """Hit, miss and eviction counts of all runs, number of entries and size of the images."""
+        self.flush()
+        totals = self._load_stats()
+        counts = {name: totals.get(name, 0) for name in ("hits", "misses", "evictions")}
+        lookups = counts["hits"] + counts["misses"]
+        entries, blob_sizes = self._scan()
+        return {
+            **counts,
+            "hit_rate": round(counts["hits"] / lookups, 3) if lookups else None,
+            "entries": len(entries),
+            "bytes": sum(blob_sizes.values()),
+            "max_bytes": self.max_bytes,
+        }
+
+    def clear(self):
+        """Remove every entry and image and reset the statistics."""
+        for folder in ("entries", "blobs"):
+            folder = os.path.join(self.directory, folder)
+            for name in os.listdir(folder):
+                self._remove(os.path.join(folder, name))
+        with self._lock:
+            self._counts = dict.fromkeys(self._counts, 0)
+        with FileLock(self._stats_path + ".lock"):
+            self._remove(self._stats_path)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, "blobs", digest)
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, "entries", key)
+
+    def _scan(self):
+        """
+        Entries on disk, as (last access, key, blob) from least to most recently used,
+        and the size of every blob on disk.
+        """
+        entries = []
+        entry_dir = os.path.join(self.directory, "entries")
+        for key in os.listdir(entry_dir):
+            if key.endswith(".tmp"):
+                continue
+            try:
+                last_access = os.path.getmtime(os.path.join(entry_dir, key))
+                with open(os.path.join(entry_dir, key)) as f:
+                    entries.append((last_access, key, json.load(f)["sha256"]))
+            except (FileNotFoundError, json.JSONDecodeError, KeyError):
+                continue
+        blob_sizes = {}
+        blob_dir = os.path.join(self.directory, "blobs")
+        for digest in os.listdir(blob_dir):
+            try:
+                blob_sizes[digest] = os.path.getsize(os.path.join(blob_dir, digest))
+            except FileNotFoundError:
+                continue
+        return sorted(entries), blob_sizes
+
+    def _evict(self):
+        entries, blob_sizes = self._scan()
+        referenced = {}
+        for _, _, digest in entries:
+            referenced[digest] = referenced.get(digest, 0) + 1
+
+        # Blobs no entry refers to, e.g. left behind by an interrupted put
+        now = time.time()
+        for digest in set(blob_sizes) - set(referenced):
+            path = self._blob_path(digest)
+            if now - self._mtime(path) > self.ORPHAN_GRACE:
+                self._remove(path)
+                del blob_sizes[digest]
+
+        # Identical images share a blob, so it is only deleted once no entry refers to it
+        total = sum(blob_sizes.values())
+        evicted = 0
+        for _, key, digest in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(self._entry_path(key))
+            evicted += 1
+            referenced[digest] -= 1
+            if referenced[digest] == 0 and digest in blob_sizes:
+                self._remove(self._blob_path(digest))
+                total -= blob_sizes.pop(digest)
+        with self._lock:
+            self._counts["evictions"] += evicted
+
+    def _load_stats(self):
+        try:
+            with open(self._stats_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    @staticmethod
+    def _write(path, data):
+        # Atomically, so that other processes never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except FileNotFoundError:
+            return float("inf")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or empty the render cache.")
+    parser.add_argument("command", choices=["stats", "clear"])
+    parser.add_argument("--directory", default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+
+    cache = RenderCache(args.directory)
+    if args.command == "clear":
+        cache.clear()
+    for name, value in cache.stats().items():
+        print(f"{name:10s} {value}")
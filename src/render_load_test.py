@@ -0,0 +1,115 @@
+"""
+Load test for render_service.py: many concurrent map and facet requests, with latency
+percentiles, throughput and the share of requests served from the service's cache.
+
+Requests are drawn at random from what the service offers (GET /), a fraction of them
+facets of random citizenships, so that a run exercises both renders and cache hits.
+
+From src/, with the service running:
+
+    python render_load_test.py --url http://127.0.0.1:8765 --requests 200 --concurrency 8
+"""
+
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import numpy as np
+
+
+def request_urls(url, count, facet_share=0.25, dpi=100, seed=0):
+    """
+    `count` random request urls for the service at `url`.
+
+    Parameters:
+    - url (str): Base url of the service.
+    - count (int): Number of requests.
+    - facet_share (float): Fraction of facet requests; the others are maps.
+    - dpi (int): Resolution of every request.
+    - seed (int): Random seed, for repeatable runs.
+
+    Returns:
+    - list: Request urls.
+    """
+    with urlopen(f"{url}/", timeout=30) as response:
+        available = json.load(response)
+    rng = random.Random(seed)
+    urls = []
+    for _ in range(count):
+        if rng.random() < facet_share:
+            names = rng.sample(available["citizenships"], rng.randint(1, 9))
+            query = {"citizenships": ",".join(names), "dpi": dpi}
+            urls.append(f"{url}/facet?{urlencode(query)}")
+        else:
+            query = {"year": rng.choice(available["years"]), "dpi": dpi}
+            urls.append(f"{url}/map?{urlencode(query)}")
+    return urls
+
+
+def fetch(url):
+    """GET `url`; returns (seconds, status, cache outcome, body size)."""
+    start = time.perf_counter()
+    try:
+        with urlopen(url, timeout=300) as response:
+            body = response.read()
+            status, outcome = response.status, response.headers.get("X-Render-Cache")
+    except HTTPError as e:
+        body, status, outcome = e.read(), e.code, None
+    return time.perf_counter() - start, status, outcome, len(body)
+
+
+def run_load_test(url, count=200, concurrency=8, facet_share=0.25, dpi=100, seed=0):
+    """
+    Send `count` random requests, `concurrency` at a time, and print a summary.
+
+    Returns:
+    - dict: Request count, errors, throughput, latency percentiles (ms) and cache
+      outcome counts.
+    """
+    urls = request_urls(url, count, facet_share, dpi, seed)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(fetch, urls))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([seconds for seconds, _, _, _ in results]) * 1000
+    outcomes = [outcome for _, status, outcome, _ in results if status == 200]
+    summary = {
+        "requests": count,
+        "errors": sum(status != 200 for _, status, _, _ in results),
+        "requests_per_second": round(count / elapsed, 2),
+        "latency_ms": {
+            f"p{q}": round(float(np.percentile(latencies, q)), 1) for q in (50, 90, 99)
+        },
+        "cache": {outcome: outcomes.count(outcome) for outcome in ("hit", "coalesced", "miss")},
+    }
+    print(
+        f"{count} requests in {elapsed:.2f}s ({summary['requests_per_second']} req/s), "
+        f"{summary['errors']} errors"
+    )
+    print("latency " + ", ".join(f"{q} {ms} ms" for q, ms in summary["latency_ms"].items()))
+    print("cache " + ", ".join(f"{k} {n}" for k, n in summary["cache"].items()))
+    with urlopen(f"{url}/stats", timeout=30) as response:
+        print(f"service {json.load(response)}")
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load test the render service.")
+    parser.add_argument("--url", default="http://127.0.0.1:8765")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--facet-share", type=float, default=0.25)
+    parser.add_argument("--dpi", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    run_load_test(
+        args.url, args.requests, args.concurrency, args.facet_share, args.dpi, args.seed
+    )
@@ -0,0 +1,350 @@
+"""
+Local render service: PNGs of the state map or the migration facet over HTTP.
+
+Each run of a visualization script pays for importing matplotlib and geopandas, loading
+the geometry, fonts and processed data and the first draw's font setup before it renders
+anything. The service pays for them once: it loads everything, renders one map and one
+facet to warm matplotlib's caches, then forks a pool of worker processes that share all
+of it (without fork, on Windows, it renders in one thread of its own process). Requests are rendered by the warm workers into the render cache (render_cache.py),
+under the same keys as the scripts' own images, so a repeated request, even after a
+restart, costs a file read, and identical requests arriving together are rendered once.
+
+    GET /                                    years, metrics and citizenships available
+    GET /map?year=2023[&metric=home_ownership][&dpi=100]
+    GET /facet[?citizenships=India,China][&dpi=100]
+    GET /stats                               request, cache and render time counters
+
+From src/:
+
+    python render_service.py --port 8765 --workers 4
+    python render_load_test.py --url http://127.0.0.1:8765 --requests 200
+"""
+
+import hashlib
+import io
+import json
+import multiprocessing
+import multiprocessing.pool
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+
+import facet_vizualisation
+import us_map_vizualise
+from map_batch import DATA_PATH as MAP_DATA_PATH
+from map_batch import TITLES
+from map_geometry import SHAPEFILE_PATH, load_state_geometry
+from processed_store import load_processed
+from render_cache import DEFAULT_CACHE_DIR, RenderCache
+
+FACET_DATA_PATH = "../data/processed/nz_migration_facet_data_202312.csv"
+DEFAULT_DPI = 100
+MAX_DPI = 600
+
+# Set in the parent before the pool forks, read by the workers
+_geometry = None
+_map_data = None
+_facet_data = None
+_shapefile_path = None
+_catalog = None
+
+
+class BadRequest(ValueError):
+    """Raised for a request the service cannot render, answered with status 400."""
+
+
+def load_resources(
+    map_data_path=MAP_DATA_PATH,
+    facet_data_path=FACET_DATA_PATH,
+    shapefile_path=SHAPEFILE_PATH,
+):
+    """Load the data and geometry into this process, for the workers it forks."""
+    global _geometry, _map_data, _facet_data, _shapefile_path, _catalog
+
+    _map_data = load_processed(map_data_path, columns=["year", "state", *TITLES])
+    _facet_data = load_processed(
+        facet_data_path,
+        columns=["Month", "Citizenship", "arrivals_sum", "departures_sum", "net_sum"],
+        parse_dates=["Month"],
+    )
+    _geometry = load_state_geometry(shapefile_path)
+    _shapefile_path = shapefile_path
+    _catalog = {
+        "years": sorted(int(year) for year in _map_data["year"].unique()),
+        "metrics": sorted(TITLES),
+        "citizenships": facet_vizualisation.facet_names(_facet_data),
+    }
+
+
+def catalog():
+    """What can be requested: the years and metrics of the map, the facet citizenships."""
+    return _catalog
+
+
+def _parse_dpi(query):
+    try:
+        dpi = int(query.get("dpi", [DEFAULT_DPI])[-1])
+    except ValueError:
+        raise BadRequest("dpi must be an integer") from None
+    if not 10 <= dpi <= MAX_DPI:
+        raise BadRequest(f"dpi must be between 10 and {MAX_DPI}")
+    return dpi
+
+
+def parse_request(path, query):
+    """
+    The kind and canonical parameters of a render request.
+
+    Parameters:
+    - path (str): '/map' or '/facet'.
+    - query (dict): Query string parameters, as from urllib.parse.parse_qs.
+
+    Returns:
+    - tuple: (kind, params), params a dict of JSON values.
+    """
+    available = catalog()
+    if path == "/map":
+        try:
+            year = int(query["year"][-1])
+        except KeyError:
+            raise BadRequest("year is required") from None
+        except ValueError:
+            raise BadRequest("year must be an integer") from None
+        if year not in available["years"]:
+            raise BadRequest(f"No data for {year}")
+        metric = query.get("metric", ["home_ownership"])[-1]
+        if metric not in TITLES:
+            raise BadRequest(f"Unknown metric {metric!r}; available: {', '.join(TITLES)}")
+        return "map", {"year": year, "metric": metric, "dpi": _parse_dpi(query)}
+
+    if path == "/facet":
+        names = available["citizenships"]
+        if "citizenships" in query:
+            names = [name.strip() for name in query["citizenships"][-1].split(",") if name.strip()]
+            unknown = [name for name in names if name not in available["citizenships"]]
+            if unknown:
+                raise BadRequest(f"Unknown citizenships: {', '.join(unknown)}")
+            grid = facet_vizualisation.NROW * facet_vizualisation.NCOL
+            if not 0 < len(names) <= grid:
+                raise BadRequest(f"Request between 1 and {grid} citizenships")
+        # The panels are drawn in the order given
+        return "facet", {"citizenships": names, "dpi": _parse_dpi(query)}
+
+    raise BadRequest(f"Unknown path {path}")
+
+
+def request_hash(kind, params):
+    """SHA-256 of a request's kind and canonical parameters."""
+    return hashlib.sha256(json.dumps([kind, params], sort_keys=True).encode()).hexdigest()
+
+
+def content_key(kind, params):
+    """RenderCache key of a request's image: its data, style and drawing code."""
+    if kind == "map":
+        plot_data = _map_data[_map_data["year"] == params["year"]]
+        title = TITLES[params["metric"]].format(year=params["year"])
+        return us_map_vizualise.map_render_key(
+            plot_data, title, _shapefile_path, params["metric"], dpi=params["dpi"]
+        )
+    return facet_vizualisation.facet_render_key(
+        _facet_data, params["citizenships"], dpi=params["dpi"]
+    )
+
+
+def render_png(kind, params):
+    """Render one request in this process; returns (PNG bytes, seconds)."""
+    start = time.perf_counter()
+    if kind == "map":
+        plot_data = _map_data[_map_data["year"] == params["year"]]
+        title = TITLES[params["metric"]].format(year=params["year"])
+        fig = us_map_vizualise.draw_map(
+            _geometry, plot_data, title, column_to_plot=params["metric"]
+        )
+    else:
+        fig = facet_vizualisation.draw_facet(_facet_data, params["citizenships"])
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=params["dpi"], bbox_inches="tight")
+    plt.close(fig)
+    return buffer.getvalue(), time.perf_counter() - start
+
+
+class RenderService:
+    """
+    Warm worker pool rendering requests, with a RenderCache of the PNGs.
+
+    Load the resources (load_resources) before creating it: the workers are forked from
+    this process when it is created.
+
+    Parameters:
+    - workers (int): Number of worker processes, defaults to the CPU count. Without fork,
+      requests are rendered one at a time in a thread of this process instead.
+    - cache (RenderCache): Where the PNGs are kept, defaults to the default directory.
+    - timeout (float): Seconds a request may wait for its render.
+    """
+
+    def __init__(self, workers=None, cache=None, timeout=120):
+        self.cache = cache or RenderCache()
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # Request hash mapped to its cache key: the data and code do not change while
+        # the service runs, so each distinct request is hashed once
+        self._keys = {}
+        # Cache key mapped to the pending render, shared by identical requests
+        self._pending = {}
+        self._stats = {"requests": 0, "hits": 0, "coalesced": 0, "rendered": 0, "failed": 0}
+        self._render_seconds = 0.0
+
+        # Warm the fonts and matplotlib's text and path caches once, for every worker
+        render_png("map", {"year": catalog()["years"][-1], "metric": "home_ownership", "dpi": 20})
+        render_png("facet", {"citizenships": catalog()["citizenships"], "dpi": 20})
+        if "fork" in multiprocessing.get_all_start_methods():
+            self._pool = multiprocessing.get_context("fork").Pool(workers)
+        else:
+            # Spawned workers would not share the loaded resources, and matplotlib is not
+            # thread-safe: render in a single thread
+            self._pool = multiprocessing.pool.ThreadPool(1)
+
+    def render(self, kind, params):
+        """
+        PNG of a request, from the cache or rendered by a worker.
+
+        Returns:
+        - tuple: (PNG bytes, 'hit', 'coalesced' or 'miss').
+        """
+        digest = request_hash(kind, params)
+        with self._lock:
+            self._stats["requests"] += 1
+            key = self._keys.get(digest)
+        if key is None:
+            key = content_key(kind, params)
+            with self._lock:
+                self._keys[digest] = key
+
+        png = self.cache.get(key)
+        if png is not None:
+            with self._lock:
+                self._stats["hits"] += 1
+            return png, "hit"
+
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                self._stats["coalesced"] += 1
+                outcome = "coalesced"
+            else:
+                pending = self._pool.apply_async(render_png, (kind, params))
+                self._pending[key] = pending
+                outcome = "miss"
+
+        try:
+            png, seconds = pending.get(self.timeout)
+        except Exception:
+            with self._lock:
+                if self._pending.pop(key, None) is not None:
+                    self._stats["failed"] += 1
+            raise
+
+        with self._lock:
+            if self._pending.pop(key, None) is not None:
+                self._stats["rendered"] += 1
+                self._render_seconds += seconds
+                self.cache.put(key, png)
+        return png, outcome
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["render_seconds"] = round(self._render_seconds, 3)
+        stats["cache"] = self.cache.stats()
+        return stats
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        self.cache.flush()
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    """Routes GET requests to the server's RenderService."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        service = self.server.service
+        if url.path == "/":
+            return self._send_json(200, catalog())
+        if url.path == "/stats":
+            return self._send_json(200, service.stats())
+        if url.path not in ("/map", "/facet"):
+            return self._send_json(404, {"error": f"Unknown path {url.path}"})
+
+        start = time.perf_counter()
+        try:
+            kind, params = parse_request(url.path, parse_qs(url.query))
+            png, outcome = service.render(kind, params)
+        except BadRequest as e:
+            return self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            return self._send_json(500, {"error": repr(e)})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(png)))
+        self.send_header("X-Render-Cache", outcome)
+        self.send_header("X-Render-Time", f"{time.perf_counter() - start:.4f}")
+        self.end_headers()
+        self.wfile.write(png)
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def serve(host="127.0.0.1", port=8765, workers=None, cache=None, quiet=False):
+    """Load the resources, start the workers and serve until interrupted."""
+    start = time.perf_counter()
+    load_resources()
+    service = RenderService(workers=workers, cache=cache)
+    print(f"Loaded and warmed up in {time.perf_counter() - start:.2f}s")
+
+    server = ThreadingHTTPServer((host, port), RenderHandler)
+    server.service = service
+    server.quiet = quiet
+    print(f"Serving on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve map and facet PNGs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--cache-mb", type=int, default=256, help="size bound of the cache")
+    parser.add_argument("--quiet", action="store_true", help="do not log every request")
+    args = parser.parse_args()
+
+    cache = RenderCache(args.cache_dir, max_bytes=args.cache_mb * 1024 * 1024)
+    serve(args.host, args.port, args.workers, cache, args.quiet)
@@ -1,70 +1,109 @@
+import numpy as np
 import pandas as pd
-import geopandas as gpd
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from drawarrow import fig_arrow
 from highlight_text import fig_text, ax_text
-from pyfonts import load_font
 from matplotlib.animation import FuncAnimation
+from matplotlib.text import Text
+
+from map_geometry import (
+    annotation_table,
+    load_state_geometry,
+    polygon_part_index,
+    select_level_of_detail,
+)
+from map_frames import build_frame_table, tween_frame_table
+from frame_render import save_animation
+from label_raster import LabelImage
+from layer_composite import split_outlines
+from animation_writer import PaletteWriter, blend_palette
+from font_registry import get_font
+from processed_store import load_processed
+
+
+def label_text(state, rate):
+    """Annotation text of a state, with the state code highlighted."""
+    if state in ["NC", "VA", "TN", "KY", "NY", "HI"]:
+        return f"<{state.upper()}>: {rate:.1f}"
+    return f"<{state.upper()}>\n{rate:.1f}"
+
+
+def label_color(rate):
+    """Annotation color that stays readable on the fill color of `rate`."""
+    return "white" if rate <= 35 or rate >= 75 else text_color  # e.g., 'black'
+
+
+class LabelHandle:
+    """
+    Handles to the artists of a label drawn with ax_text, to update it in place.
+
+    highlight_text has no API to change a label once created, so the label's matplotlib
+    Text artists are looked up once, through the public artist tree of its
+    AnnotationBbox, and updated directly.
+
+    Parameters:
+    - label: HighlightText returned by ax_text.
+    """
+
+    def __init__(self, label):
+        self.artist = label.annotation_bbox
+        # In reading order: a highlighted state code first, the value last
+        self.texts = self.artist.findobj(Text, include_self=False)
+
+    def set_text(self, text, color=None):
+        """
+        Set the value of a state label, keeping its highlighted state code.
+
+        Parameters:
+        - text: str, the new text in the label's format, e.g. '<NC>: 65.1'.
+        - color: Optional new text color.
+        """
+        # The value is the text after the highlighted code, in the last text artist
+        self.texts[-1].set_text(text.split(">", 1)[1].lstrip("\n"))
+        if color is not None:
+            for text in self.texts:
+                text.set_color(color)
 
 
 # Function to annotate states
-def annotate_states(geo_df, ax, value_col, color_text, other_font, other_bold_font):
+def annotate_states(labels, ax, color_text, other_font, other_bold_font):
     """
     Annotates states on a geographic plot with their respective values.
 
     Parameters:
-    - geo_df: GeoDataFrame containing geographic data, including centroids and state codes.
+    - labels: DataFrame from annotation_table, indexed by state code, with the label
+      positions (already adjusted) and values.
     - ax: Matplotlib axis on which the annotations will be plotted.
-    - value_col: Column name containing the values to be displayed for each state.
 
     The function adds state annotations with custom positioning and color based on the value.
-    """
-    states_to_annotate = list(geo_df["STUSPS"].unique())
-
-    for state in states_to_annotate:
-        # Get the centroid coordinates and rate for each state
-        centroid = geo_df.loc[geo_df["STUSPS"] == state, "centroid"].values[0]
-        x, y = centroid.coords[0]
-        rate = geo_df.loc[geo_df["STUSPS"] == state, value_col].values[0]
-        # Make small adjustments to annotation locations
-        try:
-            x += adjustments[state][0]
-            y += adjustments[state][1]
-        except KeyError:
-            pass
-
-        # Determine text color based on rate value
-        color_text = (
-            "white" if rate <= 35 or rate >= 75 else text_color
-        )  # e.g., 'black'
-
-        # Set annotation text format based on state condition
-        if state in ["NC", "VA", "TN", "KY", "NY", "HI"]:
-            text = f"<{state.upper()}>: {rate:.1f}"
-        else:
-            text = f"<{state.upper()}>\n{rate:.1f}"
 
+    Returns:
+    - dict: The LabelHandle of each state, keyed by state code.
+    """
+    annotations = {}
+    for state, x, y, rate in labels[["x", "y", "value"]].itertuples():
         # Add the annotation
-        ax_text(
+        label = ax_text(
             x=x,
             y=y,
-            s=text,
+            s=label_text(state, rate),
             fontsize=8.5,
             ha="center",
             va="center",
             font=other_font,
-            color=color_text,
+            color=label_color(rate),
             ax=ax,
             highlight_textprops=[{"font": other_bold_font}],
         )
+        annotations[state] = LabelHandle(label)
+    return annotations
 
 
 def annotate_state_with_arrows(
-    data,
+    labels,
     ax,
     state_code,
-    column_name,
     tail_position,
     head_position,
     radius,
@@ -75,12 +114,14 @@ def annotate_state_with_arrows(
     Annotates a state on a plot with an arrow and text label.
 
     Parameters:
-    - data: DataFrame containing the data for states.
-    - fig: Plotly or matplotlib figure object.
+    - labels: DataFrame from annotation_table, indexed by state code.
+    - ax: Matplotlib axis on which the annotation will be plotted.
     - state_code: str, the two-letter code for the state to annotate (e.g., 'NJ').
-    - column_name: str, the column in the data containing the value to plot.
     - tail_position: tuple, (x, y) starting position of the arrow.
     - head_position: tuple, (x, y) end position of the arrow head.
+
+    Returns:
+    - LabelHandle: The text label.
     """
     # Define arrow properties
     arrow_props = dict(
@@ -95,19 +136,11 @@ def annotate_state_with_arrows(
         **arrow_props,
     )
 
-    # Get the centroid coordinates and rate for each state
-    centroid = data.loc[data["STUSPS"] == state_code, "centroid"].values[0]
-    x, y = centroid.coords[0]
-    state_value = data.loc[data["STUSPS"] == state_code, column_name].values[0]
-    # Make small adjustments to annotation locations
-    try:
-        x += adjustments[state_code][0]
-        y += adjustments[state_code][1]
-    except KeyError:
-        pass
+    # Get the adjusted label position and value for the state
+    x, y, state_value = labels.loc[state_code, ["x", "y", "value"]]
 
     # Add the text annotation
-    ax_text(
+    label = ax_text(
         s=f"<{state_code}>: {state_value:.1f}",
         x=x,
         y=y,
@@ -119,6 +152,7 @@ def annotate_state_with_arrows(
         va="center",
         ax=ax,
     )
+    return LabelHandle(label)
 
 
 def plot_with_legend(data, ax, xlim, ylim):
@@ -130,7 +164,13 @@ def plot_with_legend(data, ax, xlim, ylim):
     - ax: Matplotlib axis to plot on.
     - xlim: Tuple for x-axis limits.
     - ylim: Tuple for y-axis limits.
+
+    Returns:
+    - PatchCollection: The plotted polygons, one patch per polygon part of `data`.
     """
+    # Use the coarsest geometry that is still exact at the output resolution
+    data = select_level_of_detail(data, ax, xlim, ylim)
+
     # Plot data with custom color mapping
     data.plot(
         ax=ax,
@@ -142,20 +182,34 @@ def plot_with_legend(data, ax, xlim, ylim):
     )
     ax.set_xlim(xlim)
     ax.set_ylim(ylim)
+    return ax.collections[-1]
 
 
 # Load the fonts
-font = load_font(
-    "https://github.com/dharmatype/Bebas-Neue/blob/master/fonts/BebasNeue(2018)ByDhamraType/ttf/BebasNeue-Regular.ttf?raw=true"
-)
-other_font = load_font(
-    "https://github.com/bBoxType/FiraSans/blob/master/Fira_Sans_4_3/Fonts/Fira_Sans_TTF_4301/Normal/Roman/FiraSans-Light.ttf?raw=true"
-)
-other_bold_font = load_font(
-    "https://github.com/bBoxType/FiraSans/blob/master/Fira_Sans_4_3/Fonts/Fira_Sans_TTF_4301/Normal/Roman/FiraSans-Medium.ttf?raw=true"
-)
+font = get_font("BebasNeue-Regular")
+other_font = get_font("FiraSans-Light")
+other_bold_font = get_font("FiraSans-Medium")
 text_color = "black"
 
+# Processes rendering the animation frames: None for all cores, 1 for FuncAnimation.save;
+# without fork (Windows) the frames are rendered in this process either way
+render_workers = None
+# Rasterize the outlines, legend, title, captions and arrows once and composite the
+# fills and labels onto them per frame (parallel rendering only, see layer_composite.py).
+# Faster, but the output is NOT identical to the serial FuncAnimation.save path: shades
+# differ where fills or labels meet the static artists, and splitting off the outlines
+# draws every state outline above every fill instead of each with its own fill
+composite_layers = False
+# How the states are filled: "polygons" draws every polygon each frame, "label_image"
+# rasterizes them once into an image of state ids and colors it per frame by lookup
+# (faster for detailed geometry, without anti-aliased edges, see label_raster.py)
+choropleth = "polygons"
+# In-between frames per pair of consecutive keyframes (the years loaded below), blended
+# from the two; 0 for the keyframes only. Each keyframe and its in-between frames play
+# for one second
+tween_steps = 0
+fps = tween_steps + 1
+
 # Offsets for individual state annotations
 adjustments = {
     "HI": (+0.5, +1.5),
@@ -232,193 +286,252 @@ arrow_parameters = {
 }
 
 # Load plot data
-plot_data = pd.read_csv("../data/processed/homeownership_state_processed_20241124.csv")
-
-plot_data=plot_data[plot_data["year"].isin([1984,2023])]
+plot_data = load_processed(
+    "../data/processed/homeownership_state_processed_20241124.csv",
+    columns=["year", "state", "home_ownership"],
+    filters=[("year", "in", [1984, 2023])],
+)
 
-# Read the shapefile
+# Load the state geometry with centroids and the Alaska/Hawaii/contiguous split,
+# from a cache rebuilt whenever the shapefile changes (see map_geometry.py)
 shapefile_path = "../data/raw/us_map_data/tl_2023_us_state.shp"
-gdf = gpd.read_file(shapefile_path)
-
-# Project the data to EPSG:5070 and calculate centroids.
-# A projection is a way to represent the 3D surface of the Earth on a 2D map.
-# A centroid is the geometric center or “average” point of a shape.
-data_projected = gdf.to_crs(epsg=5070)
-data_projected["centroid"] = data_projected.geometry.centroid
-
-# Project centroids back to original CRS
-gdf["centroid"] = data_projected["centroid"].to_crs(gdf.crs)
+gdf = load_state_geometry(shapefile_path)
 
 # Define column for plotting
 column_to_plot = "home_ownership"
 
-# Set up a 2x2 grid layout with custom size ratios
-new_width = 20 * 0.5
-new_height = 15 * 0.5
-fig, axs = plt.subplots(
-    2,
-    2,
-    figsize=(new_width, new_height),
-    dpi=300,
-    gridspec_kw={"height_ratios": [4, 1], "width_ratios": [1, 1]},
+# Animate the states that have data, in geometry order as the per-year merge kept them
+data = gdf[gdf["STUSPS"].isin(plot_data["state"].unique())].reset_index(drop=True)
+
+
+# Values, bins and colors of every frame, as (frame x state) arrays in the row order of
+# data, with the in-between frames' values and colors blended from the years around them
+frame_table = build_frame_table(
+    plot_data.pivot(index="year", columns="state", values=column_to_plot),
+    data["STUSPS"],
+    bins=[35, 45, 55, 65, 75, float("inf")],
+    colors=colors,
 )
+frame_table = tween_frame_table(frame_table, tween_steps)
 
-def update(frame):
-    # Clear all the axes
-    for ax in axs.flatten():
-        ax.clear()
-    
-    current_data = plot_data[plot_data["year"] == frame]
-
-    # Merge data
-    data = gdf.merge(current_data, how="inner", left_on="STUSPS", right_on="state")
-
-    # Add a binned column based on specified ranges
-    data["binned"] = pd.cut(
-        data["home_ownership"],
-        bins=[35, 45, 55, 65, 75, float("inf")],
-        labels=["35-45%", "45-55%", "55-65%", "65-75%", "75%+"],
-    )
 
-    # Separate Alaska, Hawaii, and the contiguous U.S.
-    alaska = data[data["NAME"] == "Alaska"]
-    hawaii = data[data["NAME"] == "Hawaii"]
-    contiguous_us = data[(data["NAME"] != "Alaska") & (data["NAME"] != "Hawaii")]
-
-    # Plot contiguous U.S. on the main subplot (spanning both columns in the first row)
-    ax_main = plt.subplot2grid((2, 2), (0, 0), colspan=2, fig=fig)
-    plot_with_legend(contiguous_us, ax_main, xlim=(-130, -65), ylim=(24, 55))
-
-    # Alaska plot in the second row, first column
-    ax_alaska = plt.subplot2grid((2, 2), (1, 0), fig=fig)
-    plot_with_legend(alaska, ax_alaska, xlim=(-200, -100), ylim=(50, 73))
-
-    # Hawaii plot in the second row, second column
-    ax_hawaii = plt.subplot2grid((2, 2), (1, 1), fig=fig)
-    plot_with_legend(hawaii, ax_hawaii, xlim=(-162, -152), ylim=(18, 24))
-
-    # Loop through state codes and annotate each one
-    for state_code in state_codes_arrows:
-        params = arrow_parameters.get(state_code, {})
-        annotate_state_with_arrows(
-            data,
-            ax=ax_main,
-            state_code=state_code,
-            column_name=column_to_plot,
-            tail_position=params.get("tail_position"),
-            head_position=params.get("head_position"),
-            radius=params.get("radius"),
-            text_color=text_color,
-            other_font=other_font,
-        )
+# The figure is drawn once, in retained mode: each frame only updates the polygon
+# colors, the state labels and the year, so frame time does not grow over the sequence
+new_width = 20 * 0.5
+new_height = 15 * 0.5
+fig = plt.figure(figsize=(new_width, new_height), dpi=300)
+
+data[column_to_plot] = frame_table.values[0]
+data["binned"] = pd.Categorical.from_codes(frame_table.codes[0], categories=labels)
+region = data["region"].to_numpy()
+
+# Plot contiguous U.S. on the main subplot (spanning both columns in the first row)
+ax_main = plt.subplot2grid((2, 2), (0, 0), colspan=2, fig=fig)
+# Alaska plot in the second row, first column
+ax_alaska = plt.subplot2grid((2, 2), (1, 0), fig=fig)
+# Hawaii plot in the second row, second column
+ax_hawaii = plt.subplot2grid((2, 2), (1, 1), fig=fig)
+
+# Polygon collections with, for each polygon part, the row of `data` it belongs to
+polygons = []
+for name, ax, xlim, ylim in [
+    ("contiguous", ax_main, (-130, -65), (24, 55)),
+    ("alaska", ax_alaska, (-200, -100), (50, 73)),
+    ("hawaii", ax_hawaii, (-162, -152), (18, 24)),
+]:
+    rows = np.flatnonzero(region == name)
+    collection = plot_with_legend(data.iloc[rows], ax, xlim=xlim, ylim=ylim)
+    polygons.append((collection, rows[polygon_part_index(data.iloc[rows])]))
+
+# Label positions and values, indexed by state code
+state_labels = annotation_table(data, column_to_plot, adjustments)
+
+# Loop through state codes and annotate each one
+arrow_labels = {}
+for state_code in state_codes_arrows:
+    params = arrow_parameters.get(state_code, {})
+    arrow_labels[state_code] = annotate_state_with_arrows(
+        state_labels,
+        ax=ax_main,
+        state_code=state_code,
+        tail_position=params.get("tail_position"),
+        head_position=params.get("head_position"),
+        radius=params.get("radius"),
+        text_color=text_color,
+        other_font=other_font,
+    )
 
-    # Annotate the states
+# Annotate the states
+state_annotations = {}
+state_annotations.update(
     annotate_states(
-        contiguous_us[~contiguous_us["STUSPS"].isin(state_codes_arrows)],
+        state_labels[
+            (state_labels["region"] == "contiguous")
+            & ~state_labels.index.isin(state_codes_arrows)
+        ],
         ax_main,
-        value_col=column_to_plot,
         color_text=text_color,
         other_font=other_font,
         other_bold_font=other_bold_font,
     )
+)
+state_annotations.update(
     annotate_states(
-        alaska,
+        state_labels[state_labels["region"] == "alaska"],
         ax_alaska,
-        value_col=column_to_plot,
         color_text=text_color,
         other_font=other_font,
         other_bold_font=other_bold_font,
     )
+)
+state_annotations.update(
     annotate_states(
-        hawaii,
+        state_labels[state_labels["region"] == "hawaii"],
         ax_hawaii,
-        value_col=column_to_plot,
         color_text=text_color,
         other_font=other_font,
         other_bold_font=other_bold_font,
     )
+)
 
-    for ax in fig.axes:
-        ax.set_axis_off()
-
-    legend_handles = [
-        mpatches.Patch(color=color, label=label) for label, color in color_mapping.items()
-    ]
-
-    fig.legend(
-        handles=legend_handles,
-        loc="lower center",
-        bbox_to_anchor=(
-            0.5,
-            0.79,
-        ),  # Position the legend at the bottom center of the figure
-        ncol=len(color_mapping),  # Arrange items in a single row
-        frameon=False,
-    )
+for ax in fig.axes:
+    ax.set_axis_off()
+
+legend_handles = [
+    mpatches.Patch(color=color, label=label) for label, color in color_mapping.items()
+]
+
+fig.legend(
+    handles=legend_handles,
+    loc="lower center",
+    bbox_to_anchor=(
+        0.5,
+        0.79,
+    ),  # Position the legend at the bottom center of the figure
+    ncol=len(color_mapping),  # Arrange items in a single row
+    frameon=False,
+)
 
-    # title
-    fig_text(
-        s="Home ownership by State",
-        x=0.18,
-        y=0.9,
-        color=text_color,
-        fontsize=24,
-        font=font,
-        ha="left",
-        va="top",
-        ax=ax,
-    )
-    
-    # Year
-    ax_text(
-        s=f"{frame}",
-        x=-120,
-        y=29,
-        color=text_color,
-        fontsize=32,
-        font=other_font,
-        ha="left",
-        va="top",
-        ax=ax_main,
-        bbox=dict(
-            boxstyle="round,pad=0.3",
-            edgecolor="black",
-            facecolor="white",
-            linestyle="dotted",
-            alpha=0.8,
-        ),
-    )
+# title
+fig_text(
+    s="Home ownership by State",
+    x=0.18,
+    y=0.9,
+    color=text_color,
+    fontsize=24,
+    font=font,
+    ha="left",
+    va="top",
+    ax=ax,
+)
 
-    # caption
-    fig_text(
-        s="Source: U.S. Census Bureau",
-        x=0.93,
-        y=0.025,
-        color=text_color,
-        fontsize=8,
-        font=other_font,
-        ha="right",
-        va="top",
-        ax=ax,
-    )
+# Year
+year_text = ax_text(
+    s=f"{frame_table.keys[0]}",
+    x=-120,
+    y=29,
+    color=text_color,
+    fontsize=32,
+    font=other_font,
+    ha="left",
+    va="top",
+    ax=ax_main,
+    bbox=dict(
+        boxstyle="round,pad=0.3",
+        edgecolor="black",
+        facecolor="white",
+        linestyle="dotted",
+        alpha=0.8,
+    ),
+)
+year_label = LabelHandle(year_text)
+
+# caption
+fig_text(
+    s="Source: U.S. Census Bureau",
+    x=0.93,
+    y=0.025,
+    color=text_color,
+    fontsize=8,
+    font=other_font,
+    ha="right",
+    va="top",
+    ax=ax,
+)
 
-    # caption
-    fig_text(
-        s="autonomousecon.substack.com",
-        x=0.93,
-        y=0.045,
-        color=text_color,
-        fontsize=8,
-        font=other_font,
-        ha="right",
-        va="top",
-        ax=ax,
-    )
+# caption
+fig_text(
+    s="autonomousecon.substack.com",
+    x=0.93,
+    y=0.045,
+    color=text_color,
+    fontsize=8,
+    font=other_font,
+    ha="right",
+    va="top",
+    ax=ax,
+)
+
+# Adjust plot layout
+plt.subplots_adjust(hspace=0.04)
 
-    # Adjust plot layout
-    plt.subplots_adjust(hspace=0.04)
+if choropleth == "label_image":
+    # Rasterize each inset's polygons once, now that the layout is final; frames then
+    # recolor them with a palette lookup instead of filling every polygon again
+    polygons = [(LabelImage(collection), part_rows) for collection, part_rows in polygons]
 
-ani = FuncAnimation(fig, update, frames=plot_data['year'].unique())
-ani.save('us_map_home_ownership_1.gif', fps=1)
+
+def update(frame):
+    i = frame_table.position(frame)
+    values = frame_table.values[i]
+
+    # Recolor the polygons
+    for fill, part_rows in polygons:
+        fill.set_facecolor(frame_table.rgba[i, part_rows])
+
+    # Update the state labels, hiding those of states without data this frame
+    for state, rate in zip(data["STUSPS"], values):
+        if state in arrow_labels:
+            label, color = arrow_labels[state], None
+            text = f"<{state}>: {rate:.1f}"
+        elif state in state_annotations:
+            label, color = state_annotations[state], label_color(rate)
+            text = label_text(state, rate)
+        else:
+            continue
+        label.artist.set_visible(not np.isnan(rate))
+        if not np.isnan(rate):
+            label.set_text(text, color)
+
+    # Year
+    year_label.texts[0].set_text(f"{frame_table.keys[i]}")
+
+
+if composite_layers and render_workers != 1 and choropleth == "polygons":
+    # The state outlines never change: draw them in the static layers, above the fills
+    for collection, _ in polygons:
+        split_outlines(collection)
+
+# What update changes: the polygon fills, below the static outlines and arrows, and the
+# labels, on top of everything
+dynamic_artists = [fill for fill, _ in polygons]
+dynamic_labels = [label.artist for label in arrow_labels.values()]
+dynamic_labels += [label.artist for label in state_annotations.values()]
+dynamic_labels.append(year_label.artist)
+
+# The fill, edge and text colors and their anti-aliased blends, to quantize frames against
+palette = blend_palette(colors + [text_color, "white", "#666666"])
+
+if render_workers == 1:
+    ani = FuncAnimation(fig, update, frames=frame_table.frames)
+    ani.save('us_map_home_ownership_1.gif', writer=PaletteWriter(fps=fps, palette=palette))
+else:
+    # Same bytes as ani.save, with the frames drawn in parallel processes, unless the
+    # layers are composited (see composite_layers)
+    save_animation(
+        fig, update, frame_table.frames, 'us_map_home_ownership_1.gif', fps=fps,
+        workers=render_workers, palette=palette,
+        dynamic=dynamic_artists if composite_layers else None, on_top=dynamic_labels,
+    )
 # plt.savefig("home_ownership_map", dpi=300, bbox_inches="tight")
-plt.show()
\ No newline at end of file
+plt.show()
@@ -1,38 +1,50 @@
+import sys
+
 import pandas as pd
-import geopandas as gpd
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from drawarrow import fig_arrow
 from highlight_text import fig_text, ax_text
-from pyfonts import load_font
+
+from font_registry import get_font
+import map_geometry
+from map_geometry import (
+    annotation_table,
+    load_state_geometry,
+    select_level_of_detail,
+    shapefile_hash,
+    split_regions,
+)
+from processed_store import load_processed
+from render_cache import RenderCache, render_key
+
+
+def add_text(text_func, **kwargs):
+    """
+    Adds a highlight_text label, like calling `text_func` (ax_text or fig_text).
+
+    highlight_text redraws the whole figure for every label it adds, which it only needs
+    for highlight insets, so a map with 50 labels was drawn 50 times before being saved.
+    The label is added to its axis without that draw.
+    """
+    label = text_func(add_artist=False, **kwargs)
+    label.ax.add_artist(label.annotation_bbox)
+    return label
 
 
 # Function to annotate states
-def annotate_states(geo_df, ax, value_col, color_text, other_font, other_bold_font):
+def annotate_states(labels, ax, color_text, other_font, other_bold_font):
     """
     Annotates states on a geographic plot with their respective values.
 
     Parameters:
-    - geo_df: GeoDataFrame containing geographic data, including centroids and state codes.
+    - labels: DataFrame from annotation_table, indexed by state code, with the label
+      positions (already adjusted) and values.
     - ax: Matplotlib axis on which the annotations will be plotted.
-    - value_col: Column name containing the values to be displayed for each state.
 
     The function adds state annotations with custom positioning and color based on the value.
     """
-    states_to_annotate = list(geo_df["STUSPS"].unique())
-
-    for state in states_to_annotate:
-        # Get the centroid coordinates and rate for each state
-        centroid = geo_df.loc[geo_df["STUSPS"] == state, "centroid"].values[0]
-        x, y = centroid.coords[0]
-        rate = geo_df.loc[geo_df["STUSPS"] == state, value_col].values[0]
-        # Make small adjustments to annotation locations
-        try:
-            x += adjustments[state][0]
-            y += adjustments[state][1]
-        except KeyError:
-            pass
-
+    for state, x, y, rate in labels[["x", "y", "value"]].itertuples():
         # Determine text color based on rate value
         color_text = (
             "white" if rate <= 35 or rate >= 75 else text_color
@@ -45,7 +57,8 @@ def annotate_states(geo_df, ax, value_col, color_text, other_font, other_bold_fo
             text = f"<{state.upper()}>\n{rate:.1f}"
 
         # Add the annotation
-        ax_text(
+        add_text(
+            ax_text,
             x=x,
             y=y,
             s=text,
@@ -60,10 +73,9 @@ def annotate_states(geo_df, ax, value_col, color_text, other_font, other_bold_fo
 
 
 def annotate_state_with_arrows(
-    data,
+    labels,
     ax,
     state_code,
-    column_name,
     tail_position,
     head_position,
     radius,
@@ -75,10 +87,9 @@ def annotate_state_with_arrows(
     Annotates a state on a plot with an arrow and text label.
 
     Parameters:
-    - data: DataFrame containing the data for states.
-    - fig: Plotly or matplotlib figure object.
+    - labels: DataFrame from annotation_table, indexed by state code.
+    - ax: Matplotlib axis on which the annotation will be plotted.
     - state_code: str, the two-letter code for the state to annotate (e.g., 'NJ').
-    - column_name: str, the column in the data containing the value to plot.
     - tail_position: tuple, (x, y) starting position of the arrow.
     - head_position: tuple, (x, y) end position of the arrow head.
     """
@@ -95,19 +106,12 @@ def annotate_state_with_arrows(
         **arrow_props,
     )
 
-    # Get the centroid coordinates and rate for each state
-    centroid = data.loc[data["STUSPS"] == state_code, "centroid"].values[0]
-    x, y = centroid.coords[0]
-    state_value = data.loc[data["STUSPS"] == state_code, column_name].values[0]
-    # Make small adjustments to annotation locations
-    try:
-        x += adjustments[state_code][0]
-        y += adjustments[state_code][1]
-    except KeyError:
-        pass
+    # Get the adjusted label position and value for the state
+    x, y, state_value = labels.loc[state_code, ["x", "y", "value"]]
 
     # Add the text annotation
-    ax_text(
+    add_text(
+        ax_text,
         s=f"<{state_code}>: {state_value:.1f}",
         x=x,
         y=y,
@@ -131,11 +135,15 @@ def plot_with_legend(data, ax, xlim, ylim):
     - xlim: Tuple for x-axis limits.
     - ylim: Tuple for y-axis limits.
     """
-    # Plot data with custom color mapping
+    # Use the coarsest geometry that is still exact at the output resolution
+    data = select_level_of_detail(data, ax, xlim, ylim)
+
+    # Plot data with custom color mapping; states outside the bins (e.g. DC below 35% in
+    # 1986) are left unfilled, as in the animation
     data.plot(
         ax=ax,
         column="binned",
-        color=data["binned"].map(color_mapping),
+        color=data["binned"].map(color_mapping).astype(object).fillna("none"),
         edgecolor="white",
         linewidth=0.5,
         legend=False,  # Disable automatic legend
@@ -148,12 +156,8 @@ def plot_with_legend(data, ax, xlim, ylim):
 text_color = "#333333" # charcoal
 
 # Load the fonts
-font = load_font(
-    "https://github.com/google/fonts/blob/main/ofl/cabincondensed/CabinCondensed-SemiBold.ttf?raw=true"
-)
-other_font = load_font(
-    "https://github.com/google/fonts/blob/main/ofl/cabincondensed/CabinCondensed-Regular.ttf?raw=true"
-)
+font = get_font("CabinCondensed-SemiBold")
+other_font = get_font("CabinCondensed-Regular")
 
 # Offsets for individual state annotations
 adjustments = {
@@ -178,6 +182,7 @@ adjustments = {
 }
 
 # Define custom colors for each bin
+bins = [35, 45, 55, 65, 75, float("inf")]
 labels = ["35-45%", "45-55%", "55-65%", "65-75%", "75%+"]
 colors = ["#D6604DFF", "#F4A582FF", "#FDDBC7FF", "#92C5DEFF", "#4393C3FF"]
 color_mapping = dict(zip(labels, colors))
@@ -230,177 +235,226 @@ arrow_parameters = {
     },
 }
 
-# Load employment data
-plot_data = pd.read_csv("../data/processed/homeownership_state_processed_20241124.csv")
-plot_data = plot_data[plot_data["year"] == 2023]
-
-# Read the shapefile
-shapefile_path = "../data/raw/us_map_data/tl_2023_us_state.shp"
-gdf = gpd.read_file(shapefile_path)
 
-# Project the data to EPSG:5070 and calculate centroids.
-# A projection is a way to represent the 3D surface of the Earth on a 2D map.
-# A centroid is the geometric center or “average” point of a shape.
-data_projected = gdf.to_crs(epsg=5070)
-data_projected["centroid"] = data_projected.geometry.centroid
-
-# Project centroids back to original CRS
-gdf["centroid"] = data_projected["centroid"].to_crs(gdf.crs)
+def draw_map(gdf, plot_data, title, column_to_plot="home_ownership"):
+    """
+    Draws the choropleth of one year of data, with its insets, labels and legend.
 
-# Merge data
-data = gdf.merge(plot_data, how="inner", left_on="STUSPS", right_on="state")
-print(len(data), len(plot_data), len(gdf))
+    Parameters:
+    - gdf: State geometry from load_state_geometry.
+    - plot_data: DataFrame with a 'state' column and `column_to_plot`, one row per state.
+    - title: str, the figure title.
+    - column_to_plot: str, the column to bin and color the states by.
 
-# Get the set of states from both DataFrames
-states_in_df1 = set(gdf["STUSPS"])
-states_in_df2 = set(plot_data["state"])
+    Returns:
+    - The Matplotlib figure.
+    """
+    # Merge data
+    data = gdf.merge(plot_data, how="inner", left_on="STUSPS", right_on="state")
+
+    # Add a binned column based on specified ranges
+    data["binned"] = pd.cut(
+        data[column_to_plot],
+        bins=bins,
+        labels=labels,
+    )
 
-# Print states in df1 but not in df2
-states_not_in_intersect = states_in_df1.symmetric_difference(states_in_df2)
-print(states_not_in_intersect)
+    # Separate Alaska, Hawaii, and the contiguous U.S.
+    contiguous_us, alaska, hawaii = split_regions(data)
+
+    # Set up a 2x2 grid layout with custom size ratios
+    new_width = 20 * 0.5
+    new_height = 15 * 0.5
+    fig, ax = plt.subplots(
+        2,
+        2,
+        figsize=(new_width, new_height),
+        dpi=300,
+        gridspec_kw={"height_ratios": [4, 1], "width_ratios": [1, 1]},
+    )
 
-# Choropleth
+    # Plot contiguous U.S. on the main subplot (spanning both columns in the first row)
+    ax_main = plt.subplot2grid((2, 2), (0, 0), colspan=2, fig=fig)
+    plot_with_legend(contiguous_us, ax_main, xlim=(-130, -65), ylim=(24, 55))
+
+    # Alaska plot in the second row, first column
+    ax_alaska = plt.subplot2grid((2, 2), (1, 0), fig=fig)
+    plot_with_legend(alaska, ax_alaska, xlim=(-200, -100), ylim=(50, 73))
+
+    # Hawaii plot in the second row, second column
+    ax_hawaii = plt.subplot2grid((2, 2), (1, 1), fig=fig)
+    plot_with_legend(hawaii, ax_hawaii, xlim=(-162, -152), ylim=(18, 24))
+
+    # Label positions and values, indexed by state code
+    state_labels = annotation_table(data, column_to_plot, adjustments)
+
+    # Loop through state codes and annotate each one
+    for state_code in state_codes_arrows:
+        params = arrow_parameters.get(state_code, {})
+        annotate_state_with_arrows(
+            state_labels,
+            ax=ax_main,
+            state_code=state_code,
+            tail_position=params.get("tail_position"),
+            head_position=params.get("head_position"),
+            radius=params.get("radius"),
+            text_color=text_color,
+            other_font=other_font,
+            other_bold_font=other_font
+        )
 
-# Define column for plotting
-column_to_plot = "home_ownership"
+    # Annotate the states
+    annotate_states(
+        state_labels[
+            (state_labels["region"] == "contiguous")
+            & ~state_labels.index.isin(state_codes_arrows)
+        ],
+        ax_main,
+        color_text=text_color,
+        other_font=other_font,
+        other_bold_font=other_font,
+    )
+    annotate_states(
+        state_labels[state_labels["region"] == "alaska"],
+        ax_alaska,
+        color_text=text_color,
+        other_font=other_font,
+        other_bold_font=other_font,
+    )
+    annotate_states(
+        state_labels[state_labels["region"] == "hawaii"],
+        ax_hawaii,
+        color_text=text_color,
+        other_font=other_font,
+        other_bold_font=other_font,
+    )
 
-# Add a binned column based on specified ranges
-data["binned"] = pd.cut(
-    data["home_ownership"],
-    bins=[35, 45, 55, 65, 75, float("inf")],
-    labels=["35-45%", "45-55%", "55-65%", "65-75%", "75%+"],
-)
+    for ax in fig.axes:
+        ax.set_axis_off()
+
+    legend_handles = [
+        mpatches.Patch(color=color, label=label) for label, color in color_mapping.items()
+    ]
+
+    fig.legend(
+        handles=legend_handles,
+        loc="lower center",
+        bbox_to_anchor=(
+            0.5,
+            0.79,
+        ),  # Position the legend at the bottom center of the figure
+        ncol=len(color_mapping),  # Arrange items in a single row
+        frameon=False,
+        prop=other_font
+    )
 
+    # title
+    add_text(
+        fig_text,
+        s=title,
+        x=0.18,
+        y=0.9,
+        color=text_color,
+        fontsize=24,
+        font=font,
+        ha="left",
+        va="top",
+        ax=ax,
+    )
 
-# Separate Alaska, Hawaii, and the contiguous U.S.
-alaska = data[data["NAME"] == "Alaska"]
-hawaii = data[data["NAME"] == "Hawaii"]
-contiguous_us = data[(data["NAME"] != "Alaska") & (data["NAME"] != "Hawaii")]
-
-# Set up a 2x2 grid layout with custom size ratios
-new_width = 20 * 0.5
-new_height = 15 * 0.5
-fig, ax = plt.subplots(
-    2,
-    2,
-    figsize=(new_width, new_height),
-    dpi=300,
-    gridspec_kw={"height_ratios": [4, 1], "width_ratios": [1, 1]},
-)
+    # caption
+    add_text(
+        fig_text,
+        s="Source: U.S. Census Bureau",
+        x=0.93,
+        y=0.035,
+        color=text_color,
+        fontsize=10,
+        font=other_font,
+        ha="right",
+        va="top",
+        ax=ax,
+    )
 
-# Plot contiguous U.S. on the main subplot (spanning both columns in the first row)
-ax_main = plt.subplot2grid((2, 2), (0, 0), colspan=2, fig=fig)
-plot_with_legend(contiguous_us, ax_main, xlim=(-130, -65), ylim=(24, 55))
-
-# Alaska plot in the second row, first column
-ax_alaska = plt.subplot2grid((2, 2), (1, 0), fig=fig)
-plot_with_legend(alaska, ax_alaska, xlim=(-200, -100), ylim=(50, 73))
-
-# Hawaii plot in the second row, second column
-ax_hawaii = plt.subplot2grid((2, 2), (1, 1), fig=fig)
-plot_with_legend(hawaii, ax_hawaii, xlim=(-162, -152), ylim=(18, 24))
-
-# Loop through state codes and annotate each one
-for state_code in state_codes_arrows:
-    params = arrow_parameters.get(state_code, {})
-    annotate_state_with_arrows(
-        data,
-        ax=ax_main,
-        state_code=state_code,
-        column_name=column_to_plot,
-        tail_position=params.get("tail_position"),
-        head_position=params.get("head_position"),
-        radius=params.get("radius"),
-        text_color=text_color,
-        other_font=other_font,
-        other_bold_font=other_font
+    # caption
+    add_text(
+        fig_text,
+        s="autonomousecon.substack.com",
+        x=0.93,
+        y=0.055,
+        color=text_color,
+        fontsize=10,
+        font=other_font,
+        ha="right",
+        va="top",
+        ax=ax,
     )
 
-# Annotate the states
-annotate_states(
-    contiguous_us[~contiguous_us["STUSPS"].isin(state_codes_arrows)],
-    ax_main,
-    value_col=column_to_plot,
-    color_text=text_color,
-    other_font=other_font,
-    other_bold_font=other_font,
-)
-annotate_states(
-    alaska,
-    ax_alaska,
-    value_col=column_to_plot,
-    color_text=text_color,
-    other_font=other_font,
-    other_bold_font=other_font,
-)
-annotate_states(
-    hawaii,
-    ax_hawaii,
-    value_col=column_to_plot,
-    color_text=text_color,
-    other_font=other_font,
-    other_bold_font=other_font,
-)
+    # Adjust plot layout
+    fig.subplots_adjust(hspace=0.04)
+    return fig
 
-for ax in fig.axes:
-    ax.set_axis_off()
-
-legend_handles = [
-    mpatches.Patch(color=color, label=label) for label, color in color_mapping.items()
-]
-
-fig.legend(
-    handles=legend_handles,
-    loc="lower center",
-    bbox_to_anchor=(
-        0.5,
-        0.79,
-    ),  # Position the legend at the bottom center of the figure
-    ncol=len(color_mapping),  # Arrange items in a single row
-    frameon=False,
-    prop=other_font
-)
 
-# title
-fig_text(
-    s="Homeownership Rate by State: 2023",
-    x=0.18,
-    y=0.9,
-    color=text_color,
-    fontsize=24,
-    font=font,
-    ha="left",
-    va="top",
-    ax=ax,
-)
+def map_render_key(plot_data, title, shapefile_path, column_to_plot="home_ownership", dpi=300):
+    """
+    RenderCache key of the image of draw_map, saved with bbox_inches="tight".
 
-# caption
-fig_text(
-    s="Source: U.S. Census Bureau",
-    x=0.93,
-    y=0.035,
-    color=text_color,
-    fontsize=10,
-    font=other_font,
-    ha="right",
-    va="top",
-    ax=ax,
-)
+    Parameters:
+    - plot_data, title, column_to_plot: As for draw_map.
+    - shapefile_path (str): Shapefile the geometry was loaded from.
+    - dpi (int): Image resolution.
 
-# caption
-fig_text(
-    s="autonomousecon.substack.com",
-    x=0.93,
-    y=0.055,
-    color=text_color,
-    fontsize=10,
-    font=other_font,
-    ha="right",
-    va="top",
-    ax=ax,
-)
+    Returns:
+    - str: Hex digest over the mapped values, the style and the drawing code.
+    """
+    rows = plot_data[["state", column_to_plot]].sort_values("state").reset_index(drop=True)
+    style = {
+        "title": title,
+        "bins": bins,
+        "color_mapping": color_mapping,
+        "text_color": text_color,
+        "fonts": [font, other_font],
+        "adjustments": adjustments,
+        "state_codes_arrows": state_codes_arrows,
+        "arrow_parameters": arrow_parameters,
+        "geometry": shapefile_hash(shapefile_path),
+    }
+    code = [sys.modules[__name__], map_geometry]
+    return render_key(rows, style, code, dpi=dpi, bbox_inches="tight")
+
+
+if __name__ == "__main__":
+    # Load employment data
+    plot_data = load_processed(
+        "../data/processed/homeownership_state_processed_20241124.csv",
+        columns=["year", "state", "home_ownership"],
+        filters=[("year", "==", 2023)],
+    )
 
-# Adjust plot layout
-plt.subplots_adjust(hspace=0.04)
-plt.savefig("../reports/home_ownership_map_2023", dpi=300, bbox_inches="tight")
-plt.show()
+    # Load the state geometry with centroids and the Alaska/Hawaii/contiguous split,
+    # from a cache rebuilt whenever the shapefile changes (see map_geometry.py)
+    shapefile_path = "../data/raw/us_map_data/tl_2023_us_state.shp"
+    gdf = load_state_geometry(shapefile_path)
+
+    # Get the set of states from both DataFrames
+    states_in_df1 = set(gdf["STUSPS"])
+    states_in_df2 = set(plot_data["state"])
+    print(len(states_in_df1 & states_in_df2), len(plot_data), len(gdf))
+
+    # Print states in df1 but not in df2
+    states_not_in_intersect = states_in_df1.symmetric_difference(states_in_df2)
+    print(states_not_in_intersect)
+
+    # Choropleth, from the render cache when neither the data nor the style changed
+    title = "Homeownership Rate by State: 2023"
+    cache = RenderCache()
+    fig = cache.savefig(
+        map_render_key(plot_data, title, shapefile_path, dpi=300),
+        lambda: draw_map(gdf, plot_data, title=title),
+        "../reports/home_ownership_map_2023",
+        dpi=300,
+        bbox_inches="tight",
+    )
+    print(f"Render cache: {cache.stats()}")
+    if fig is not None:
+        plt.show()